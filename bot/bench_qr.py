@@ -0,0 +1,78 @@
+"""Micro-benchmark: legacy QR path (qrcode.make + PIL PNG + base64 data URL) vs services.qr_renderer.
+
+Example:
+    python bench_qr.py --count 200 --mask-pattern 0
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import time
+from io import BytesIO
+
+import qrcode
+
+from services.keypair_buffer import generate_keypairs
+from services.qr_renderer import render_qr_png
+
+
+def sample_configs(count: int) -> list[str]:
+    configs = []
+    for index, (public_key, private_key) in enumerate(generate_keypairs(count)):
+        configs.append("\n".join([
+            "[Interface]",
+            f"PrivateKey = {private_key}",
+            f"Address = 10.8.{index // 250}.{index % 250 + 1}/32",
+            "DNS = 1.1.1.1",
+            "",
+            "[Peer]",
+            f"PublicKey = {public_key}",
+            "AllowedIPs = 0.0.0.0/0, ::/0",
+            "Endpoint = vpn.example.com:51820",
+            "PersistentKeepalive = 25",
+        ]))
+    return configs
+
+
+def legacy_render(config_text: str) -> bytes:
+    # What create_wireguard_account + send_qr_code used to do
+    buffer = BytesIO()
+    qrcode.make(config_text).save(buffer, format="PNG")
+    data_url = f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+    return base64.b64decode(data_url.split(",")[1])
+
+
+def timed(label: str, count: int, func):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    size = sum(len(png) for png in result) / max(len(result), 1)
+    print(f"{label:<30} {elapsed * 1000:9.1f} ms total  {elapsed * 1000 / count:7.2f} ms/QR  {size:7.0f} B/PNG")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100, help="QR codes per run")
+    parser.add_argument(
+        "--mask-pattern", type=int, choices=range(8), default=None,
+        help="also time qr_renderer with this fixed mask instead of the penalty-scored one",
+    )
+    args = parser.parse_args()
+
+    configs = sample_configs(args.count)
+    render_qr_png(configs[0])  # warm up imports
+
+    timed("legacy (PIL + base64)", args.count, lambda: [legacy_render(text) for text in configs])
+    timed("qr_renderer (1-bit PNG)", args.count, lambda: [render_qr_png(text, mask_pattern=None) for text in configs])
+    if args.mask_pattern is not None:
+        timed(
+            f"qr_renderer (mask {args.mask_pattern})",
+            args.count,
+            lambda: [render_qr_png(text, mask_pattern=args.mask_pattern) for text in configs],
+        )
+
+
+if __name__ == "__main__":
+    main()
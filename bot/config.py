@@ -31,6 +31,68 @@ CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "route_net")
 ADMIN_IDS = [os.getenv("ADMIN_ID", "6245412936")]
 
 
+# ==================== RouterOS API ====================
+ROUTEROS_CONNECT_TIMEOUT = float(os.getenv("ROUTEROS_CONNECT_TIMEOUT", "5"))  # TCP connect + login
+ROUTEROS_CALL_TIMEOUT = float(os.getenv("ROUTEROS_CALL_TIMEOUT", "15"))  # Per API command
+
+# ==================== RouterOS Connection Pool ====================
+ROUTER_POOL_MAX_CONNECTIONS = int(os.getenv("ROUTER_POOL_MAX_CONNECTIONS", "4"))  # Per router
+ROUTER_POOL_IDLE_TIMEOUT = float(os.getenv("ROUTER_POOL_IDLE_TIMEOUT", "300"))  # Seconds before an idle connection is closed
+ROUTER_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("ROUTER_POOL_HEALTHCHECK_INTERVAL", "30"))  # Re-check idle connections older than this
+ROUTER_POOL_ACQUIRE_TIMEOUT = float(os.getenv("ROUTER_POOL_ACQUIRE_TIMEOUT", "20"))  # Max wait for a free connection slot
+
+# ==================== Client IP Pools ====================
+IP_POOL_MAX_SIZE = int(os.getenv("IP_POOL_MAX_SIZE", "65536"))  # Max addresses per server pool (caps IPv6 prefixes)
+
+# ==================== Peer Slots ====================
+PEER_SLOT_POOL_SIZE = int(os.getenv("PEER_SLOT_POOL_SIZE", "5"))  # Ready (pre-added, disabled) peers kept per server; 0 disables
+PEER_SLOT_REFILL_INTERVAL = float(os.getenv("PEER_SLOT_REFILL_INTERVAL", "60"))  # Max seconds between refill passes
+
+# ==================== Keypair Buffer ====================
+KEYPAIR_BUFFER_SIZE = int(os.getenv("KEYPAIR_BUFFER_SIZE", "64"))  # Pre-generated WireGuard keypairs kept in memory
+KEYPAIR_BUFFER_LOW_WATERMARK = int(os.getenv("KEYPAIR_BUFFER_LOW_WATERMARK", "16"))  # Refill in the background below this
+
+# ==================== Access Cache ====================
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))  # Users whose access flags are kept in memory; 0 disables
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "60"))  # Seconds before cached flags are re-read
+
+# ==================== QR Rendering ====================
+QR_MASK_PATTERN = os.getenv("QR_MASK_PATTERN", "auto")  # "auto" picks the mask by penalty score (keeps codes scannable); 0-7 forces one mask
+
+# ==================== Usage Sync ====================
+USAGE_SYNC_INTERVAL = float(os.getenv("USAGE_SYNC_INTERVAL", "180"))  # Retry delay for a router whose sync failed
+USAGE_SYNC_MIN_INTERVAL = float(os.getenv("USAGE_SYNC_MIN_INTERVAL", "30"))  # Shortest gap between syncs of one router
+USAGE_SYNC_MAX_INTERVAL = float(os.getenv("USAGE_SYNC_MAX_INTERVAL", "180"))  # Longest gap between syncs of one router
+USAGE_SYNC_REQUESTS_PER_SECOND = float(os.getenv("USAGE_SYNC_REQUESTS_PER_SECOND", "5"))  # Router syncs started per second, all routers (0 = no limit)
+USAGE_SYNC_PEAK_RATE = int(os.getenv("USAGE_SYNC_PEAK_RATE", "12500000"))  # Bytes/s a config can reach (client link speed, 100 Mbit/s); quota headroom is estimated at this rate
+USAGE_SYNC_CONCURRENCY = int(os.getenv("USAGE_SYNC_CONCURRENCY", "10"))  # Routers synced in parallel
+USAGE_SYNC_ROUTER_DEADLINE = float(os.getenv("USAGE_SYNC_ROUTER_DEADLINE", "60"))  # Hard limit for one router per cycle
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "300"))  # Seconds between usage writes to the DB (0 = every cycle)
+USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", "5000"))  # Flush early once this many configs have unsaved usage
+
+THRESHOLD_CHECK_INTERVAL = float(os.getenv("THRESHOLD_CHECK_INTERVAL", "180"))  # Seconds between low-traffic/expiry notice checks
+TEST_CLEANUP_INTERVAL = float(os.getenv("TEST_CLEANUP_INTERVAL", "180"))  # Seconds between expired test account cleanups
+
+# ==================== Usage History ====================
+USAGE_HISTORY_RETENTION_5M_HOURS = int(os.getenv("USAGE_HISTORY_RETENTION_5M_HOURS", "24"))  # Keep 5-minute samples this long
+USAGE_HISTORY_RETENTION_1H_DAYS = int(os.getenv("USAGE_HISTORY_RETENTION_1H_DAYS", "14"))  # Keep hourly rollups this long
+USAGE_HISTORY_RETENTION_1D_DAYS = int(os.getenv("USAGE_HISTORY_RETENTION_1D_DAYS", "400"))  # Keep daily rollups this long
+USAGE_HISTORY_MAINTENANCE_INTERVAL = float(os.getenv("USAGE_HISTORY_MAINTENANCE_INTERVAL", "600"))  # Seconds between rollup/retention runs
+
+# ==================== Database ====================
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Persistent connections per engine (sync workers, async handlers)
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))  # Extra connections allowed under bursts
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Max wait for a free connection
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))  # Per-statement limit on both engines (migrations excepted); 0 disables
+DB_LOCK_TIMEOUT_MS = int(os.getenv("DB_LOCK_TIMEOUT_MS", "3000"))  # Longest wait for a row lock on both engines (migrations excepted); 0 disables
+DB_PROFILE_UPDATES = _to_bool(os.getenv("DB_PROFILE_UPDATES", "false"))  # Log query count and DB time of every update
+DB_SLOW_UPDATE_MS = float(os.getenv("DB_SLOW_UPDATE_MS", "500"))  # Log updates spending at least this long in the DB; 0 disables
+
+# ==================== Database Migrations ====================
+AUTO_MIGRATE = _to_bool(os.getenv("AUTO_MIGRATE", "true"), default=True)  # Apply pending migrations on startup; false = run migrate.py separately
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))  # Rows per transaction in data backfills
+
+
 # ==================== Representative Bot Configuration ====================
 AGENT_BOT_DOCKER_IMAGE = os.getenv("AGENT_BOT_DOCKER_IMAGE", "vpn-agent-bot:latest")
 AGENT_BOT_CONTAINER_PREFIX = os.getenv("AGENT_BOT_CONTAINER_PREFIX", "vpn_agent")
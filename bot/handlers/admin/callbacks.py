@@ -2,7 +2,7 @@ from ..common import *
 from .servers import handle_server_management_callbacks
 from .plans import handle_plan_management_callbacks
 
-async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_id: int) -> bool:
+async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_id: int, db: Session, session: AsyncSession) -> bool:
     if data == "admin":
         pending_panel = load_pending_panel()
         await callback.message.answer(ADMIN_MESSAGE, reply_markup=get_admin_keyboard(pending_panel), parse_mode="HTML")
@@ -24,16 +24,12 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         await callback.message.answer(PANELS_MESSAGE, reply_markup=get_panels_keyboard(pending_panel), parse_mode="HTML")
 
     elif data == "admin_representatives":
-        db = SessionLocal()
-        try:
-            reps = db.query(Representative).order_by(Representative.created_at.desc()).all()
-            await callback.message.answer(
-                "🤝 مدیریت نمایندگی‌ها\n\nلیست نمایندگی‌ها را از پایین مدیریت کنید:",
-                reply_markup=get_representatives_keyboard(reps),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        reps = db.query(Representative).order_by(Representative.created_at.desc()).all()
+        await callback.message.answer(
+            "🤝 مدیریت نمایندگی‌ها\n\nلیست نمایندگی‌ها را از پایین مدیریت کنید:",
+            reply_markup=get_representatives_keyboard(reps),
+            parse_mode="HTML"
+        )
 
     elif data == "rep_add":
         admin_representative_state[user_id] = {"step": "name"}
@@ -41,77 +37,65 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
 
     elif data.startswith("rep_view_"):
         rep_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            rep = db.query(Representative).filter(Representative.id == rep_id).first()
-            if not rep:
-                await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
-                return
-
-            configs_count = db.query(WireGuardConfig).filter(WireGuardConfig.representative_id == rep.id).count()
-            payments_total = db.query(PaymentReceipt).filter(PaymentReceipt.representative_id == rep.id, PaymentReceipt.status == "approved").all()
-            dynamic_sales = sum(r.amount or 0 for r in payments_total)
-            traffic_rows = db.query(WireGuardConfig).filter(WireGuardConfig.representative_id == rep.id).all()
-            dynamic_traffic = sum((c.cumulative_rx_bytes or 0) + (c.cumulative_tx_bytes or 0) for c in traffic_rows)
-
-            total_configs = max(rep.total_configs or 0, configs_count)
-            total_sales = max(rep.total_sales_amount or 0, dynamic_sales)
-            total_traffic = max(rep.total_traffic_bytes or 0, dynamic_traffic)
+        rep = db.query(Representative).filter(Representative.id == rep_id).first()
+        if not rep:
+            await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
+            return
 
-            msg = (
-                f"🤝 نمایندگی: {rep.name}\n"
-                f"• وضعیت: {'🟢 فعال' if rep.is_active else '🔴 غیرفعال'}\n"
-                f"• کانال: {rep.channel_id}\n"
-                f"• ادمین نماینده: {rep.admin_telegram_id}\n"
-                f"• تعداد کانفیگ‌ها: {total_configs}\n"
-                f"• ترافیک مصرفی: {format_traffic(total_traffic)}\n"
-                f"• مجموع هزینه‌ها: {total_sales:,} تومان\n"
-                f"• کانتینر: {rep.docker_container_name or '-'}"
-            )
-            await callback.message.answer(msg, reply_markup=get_representative_action_keyboard(rep.id, rep.is_active), parse_mode="HTML")
-        finally:
-            db.close()
+        configs_count = db.query(WireGuardConfig).filter(WireGuardConfig.representative_id == rep.id).count()
+        payments_total = db.query(PaymentReceipt).filter(PaymentReceipt.representative_id == rep.id, PaymentReceipt.status == "approved").all()
+        dynamic_sales = sum(r.amount or 0 for r in payments_total)
+        traffic_rows = db.query(WireGuardConfig).filter(WireGuardConfig.representative_id == rep.id).all()
+        dynamic_traffic = sum((c.cumulative_rx_bytes or 0) + (c.cumulative_tx_bytes or 0) for c in traffic_rows)
+
+        total_configs = max(rep.total_configs or 0, configs_count)
+        total_sales = max(rep.total_sales_amount or 0, dynamic_sales)
+        total_traffic = max(rep.total_traffic_bytes or 0, dynamic_traffic)
+
+        msg = (
+            f"🤝 نمایندگی: {rep.name}\n"
+            f"• وضعیت: {'🟢 فعال' if rep.is_active else '🔴 غیرفعال'}\n"
+            f"• کانال: {rep.channel_id}\n"
+            f"• ادمین نماینده: {rep.admin_telegram_id}\n"
+            f"• تعداد کانفیگ‌ها: {total_configs}\n"
+            f"• ترافیک مصرفی: {format_traffic(total_traffic)}\n"
+            f"• مجموع هزینه‌ها: {total_sales:,} تومان\n"
+            f"• کانتینر: {rep.docker_container_name or '-'}"
+        )
+        await callback.message.answer(msg, reply_markup=get_representative_action_keyboard(rep.id, rep.is_active), parse_mode="HTML")
 
     elif data.startswith("rep_toggle_"):
         rep_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            rep = db.query(Representative).filter(Representative.id == rep_id).first()
-            if not rep:
-                await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
-                return
+        rep = db.query(Representative).filter(Representative.id == rep_id).first()
+        if not rep:
+            await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
+            return
 
-            if rep.is_active:
-                ok, output = stop_representative_container(rep.docker_container_name)
-                rep.is_active = False
-                status = "⏸️ نمایندگی غیرفعال شد." if ok else "⚠️ وضعیت ذخیره شد ولی توقف کانتینر خطا داشت."
-            else:
-                ok, output = start_representative_container(rep)
-                rep.is_active = ok
-                status = "▶️ نمایندگی فعال شد." if ok else "⚠️ اجرای کانتینر موفق نبود."
+        if rep.is_active:
+            ok, output = stop_representative_container(rep.docker_container_name)
+            rep.is_active = False
+            status = "⏸️ نمایندگی غیرفعال شد." if ok else "⚠️ وضعیت ذخیره شد ولی توقف کانتینر خطا داشت."
+        else:
+            ok, output = start_representative_container(rep)
+            rep.is_active = ok
+            status = "▶️ نمایندگی فعال شد." if ok else "⚠️ اجرای کانتینر موفق نبود."
 
-            db.commit()
-            await callback.message.answer(f"{status}\n{output[:400]}", parse_mode="HTML")
-        finally:
-            db.close()
+        db.commit()
+        await callback.message.answer(f"{status}\n{output[:400]}", parse_mode="HTML")
 
     elif data.startswith("rep_delete_"):
         rep_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            rep = db.query(Representative).filter(Representative.id == rep_id).first()
-            if not rep:
-                await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
-                return
+        rep = db.query(Representative).filter(Representative.id == rep_id).first()
+        if not rep:
+            await callback.message.answer("❌ نمایندگی یافت نشد.", parse_mode="HTML")
+            return
 
-            if rep.docker_container_name:
-                stop_representative_container(rep.docker_container_name)
+        if rep.docker_container_name:
+            stop_representative_container(rep.docker_container_name)
 
-            db.delete(rep)
-            db.commit()
-            await callback.message.answer("✅ نمایندگی حذف شد.", parse_mode="HTML")
-        finally:
-            db.close()
+        db.delete(rep)
+        db.commit()
+        await callback.message.answer("✅ نمایندگی حذف شد.", parse_mode="HTML")
 
     elif data == "admin_pending_panel":
         pending = load_pending_panel()
@@ -134,7 +118,6 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         if not pending:
             await callback.message.answer("❌ درخواست پنل جدیدی وجود ندارد.", parse_mode="HTML")
             return
-        db = SessionLocal()
         try:
             panel = Panel(name=pending.get('name', 'Unnamed'), ip_address=pending.get('ip', ''), local_ip=pending.get('local_ip', ''),
                         location=pending.get('location', ''), port=pending.get('port', 2053), path=pending.get('path', '/'),
@@ -149,8 +132,6 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
             await callback.message.answer(PANELS_MESSAGE, reply_markup=get_panels_keyboard(pending_panel), parse_mode="HTML")
         except Exception as e:
             await callback.message.answer(f"❌ خطا در ذخیره: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data == "panel_reject":
         delete_pending_panel()
@@ -159,17 +140,13 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         await callback.message.answer(PANELS_MESSAGE, reply_markup=get_panels_keyboard(pending_panel), parse_mode="HTML")
 
     elif data == "panel_list":
-        db = SessionLocal()
-        try:
-            panels = db.query(Panel).filter(Panel.status == "approved").all()
-            if panels:
-                for p in panels:
-                    msg = f"📋 {p.name}\n\n📍 لوکیشن: {p.location}\n🌐 آی پی: {p.ip_address}:{p.port}\n📁 مسیر: {p.path}\n👤 نام کاربری: {p.api_username}"
-                    await callback.message.answer(msg, parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ پنل تایید شده‌ای یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+        panels = db.query(Panel).filter(Panel.status == "approved").all()
+        if panels:
+            for p in panels:
+                msg = f"📋 {p.name}\n\n📍 لوکیشن: {p.location}\n🌐 آی پی: {p.ip_address}:{p.port}\n📁 مسیر: {p.path}\n👤 نام کاربری: {p.api_username}"
+                await callback.message.answer(msg, parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ پنل تایید شده‌ای یافت نشد.", parse_mode="HTML")
 
     elif data == "admin_search":
         admin_user_search_state.pop(user_id, None)
@@ -197,249 +174,188 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         "admin_user_finance_",
     )):
         target_user_id = int(data.replace("admin_user_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            msg, keyboard = get_admin_user_manage_view(db, user_obj)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        msg, keyboard = get_admin_user_manage_view(db, user_obj)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
 
     elif data.startswith("admin_user_block_toggle_"):
         target_user_id = int(data.replace("admin_user_block_toggle_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            user_obj.is_blocked = not bool(user_obj.is_blocked)
-            db.commit()
-            state_text = "مسدود شد" if user_obj.is_blocked else "از مسدودی خارج شد"
-            await callback.message.answer(f"✅ کاربر با موفقیت {state_text}.", parse_mode="HTML")
-            msg, keyboard = get_admin_user_manage_view(db, user_obj)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        user_obj.is_blocked = not bool(user_obj.is_blocked)
+        db.commit()
+        access_cache.invalidate(user_obj.telegram_id)
+        state_text = "مسدود شد" if user_obj.is_blocked else "از مسدودی خارج شد"
+        await callback.message.answer(f"✅ کاربر با موفقیت {state_text}.", parse_mode="HTML")
+        msg, keyboard = get_admin_user_manage_view(db, user_obj)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
 
     elif data.startswith("admin_user_org_toggle_"):
         target_user_id = int(data.replace("admin_user_org_toggle_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            user_obj.is_organization_customer = not bool(user_obj.is_organization_customer)
-            if user_obj.org_price_per_gb is None:
-                user_obj.org_price_per_gb = 3000
-            db.commit()
-            state_text = "مشتری سازمانی" if user_obj.is_organization_customer else "مشتری عادی"
-            await callback.message.answer(f"✅ نوع مشتری با موفقیت به «{state_text}» تغییر کرد.", parse_mode="HTML")
-            msg, keyboard = get_admin_user_manage_view(db, user_obj)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        user_obj.is_organization_customer = not bool(user_obj.is_organization_customer)
+        if user_obj.org_price_per_gb is None:
+            user_obj.org_price_per_gb = 3000
+        db.commit()
+        access_cache.invalidate(user_obj.telegram_id)
+        state_text = "مشتری سازمانی" if user_obj.is_organization_customer else "مشتری عادی"
+        await callback.message.answer(f"✅ نوع مشتری با موفقیت به «{state_text}» تغییر کرد.", parse_mode="HTML")
+        msg, keyboard = get_admin_user_manage_view(db, user_obj)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
 
 
     elif data.startswith("admin_user_wallet_actions_"):
         target_user_id = int(data.replace("admin_user_wallet_actions_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            msg, keyboard = get_admin_user_manage_view(db, user_obj, show_wallet_actions=True)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        msg, keyboard = get_admin_user_manage_view(db, user_obj, show_wallet_actions=True)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
 
     elif data.startswith("admin_user_finance_"):
         target_user_id = int(data.replace("admin_user_finance_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            msg, keyboard = get_admin_user_manage_view(db, user_obj, show_finance_panel=True)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        msg, keyboard = get_admin_user_manage_view(db, user_obj, show_finance_panel=True)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
     elif data.startswith("admin_user_org_total_traffic_"):
         target_user_id = int(data.replace("admin_user_org_total_traffic_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj or not user_obj.is_organization_customer:
-                await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
-                return
-            financials = calculate_org_user_financials(db, user_obj)
-            await callback.answer(f"مجموع ترافیک فعال: {financials['total_traffic_gb']:.2f} GB", show_alert=True)
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj or not user_obj.is_organization_customer:
+            await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
+            return
+        financials = calculate_org_user_financials(db, user_obj)
+        await callback.answer(f"مجموع ترافیک فعال: {financials['total_traffic_gb']:.2f} GB", show_alert=True)
 
     elif data.startswith("admin_user_org_price_edit_"):
         target_user_id = int(data.replace("admin_user_org_price_edit_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj or not user_obj.is_organization_customer:
-                await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
-                return
-            admin_plan_state[user_id] = {"action": "edit_org_price", "target_user_id": target_user_id}
-            await callback.message.answer(
-                f"مقدار جدید هزینه هر گیگ را وارد کنید.\n\nمقدار فعلی: {(user_obj.org_price_per_gb or 0):,} تومان",
-                parse_mode="HTML",
-            )
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj or not user_obj.is_organization_customer:
+            await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
+            return
+        admin_plan_state[user_id] = {"action": "edit_org_price", "target_user_id": target_user_id}
+        await callback.message.answer(
+            f"مقدار جدید هزینه هر گیگ را وارد کنید.\n\nمقدار فعلی: {(user_obj.org_price_per_gb or 0):,} تومان",
+            parse_mode="HTML",
+        )
 
     elif data.startswith("admin_user_org_debt_"):
         target_user_id = int(data.replace("admin_user_org_debt_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj or not user_obj.is_organization_customer:
-                await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
-                return
-            financials = calculate_org_user_financials(db, user_obj)
-            await callback.answer(f"مبلغ بدهکاری: {financials['debt_amount']:,} تومان", show_alert=True)
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj or not user_obj.is_organization_customer:
+            await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
+            return
+        financials = calculate_org_user_financials(db, user_obj)
+        await callback.answer(f"مبلغ بدهکاری: {financials['debt_amount']:,} تومان", show_alert=True)
 
     elif data.startswith("admin_user_org_last_settlement_"):
         target_user_id = int(data.replace("admin_user_org_last_settlement_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj or not user_obj.is_organization_customer:
-                await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
-                return
-            last_settlement = format_jalali_date(user_obj.org_last_settlement_at) if user_obj.org_last_settlement_at else "ثبت نشده"
-            await callback.answer(f"آخرین تسویه: {last_settlement}", show_alert=True)
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj or not user_obj.is_organization_customer:
+            await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
+            return
+        last_settlement = format_jalali_date(user_obj.org_last_settlement_at) if user_obj.org_last_settlement_at else "ثبت نشده"
+        await callback.answer(f"آخرین تسویه: {last_settlement}", show_alert=True)
 
     elif data.startswith("admin_user_org_settle_"):
         target_user_id = int(data.replace("admin_user_org_settle_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj or not user_obj.is_organization_customer:
-                await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
-                return
-            active_configs = db.query(WireGuardConfig).filter(
-                WireGuardConfig.user_telegram_id == user_obj.telegram_id,
-                WireGuardConfig.status == "active"
-            ).all()
-            reset_count = 0
-            for cfg in active_configs:
-                server = db.query(Server).filter(Server.id == cfg.server_id, Server.is_active == True).first() if cfg.server_id else None
-                if server:
-                    try:
-                        import wireguard
-                        if wireguard.reset_wireguard_peer_traffic(
-                            mikrotik_host=server.host,
-                            mikrotik_user=server.username,
-                            mikrotik_pass=server.password,
-                            mikrotik_port=server.api_port,
-                            wg_interface=server.wg_interface,
-                            client_ip=cfg.client_ip,
-                        ):
-                            reset_count += 1
-                    except Exception as e:
-                        print(f"Org settlement peer reset failed ({cfg.client_ip}): {e}")
-                cfg.cumulative_rx_bytes = 0
-                cfg.cumulative_tx_bytes = 0
-                cfg.last_rx_counter = 0
-                cfg.last_tx_counter = 0
-                cfg.counter_reset_flag = True
-            user_obj.org_last_settlement_at = datetime.utcnow()
-            db.commit()
-            await callback.message.answer(
-                f"✅ تسویه انجام شد. {reset_count} کانفیگ روی روتر ریست و مصرف در دیتابیس صفر شد.",
-                parse_mode="HTML",
-            )
-            msg, keyboard = get_admin_user_manage_view(db, user_obj, show_finance_panel=True)
-            await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
-        finally:
-            db.close()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj or not user_obj.is_organization_customer:
+            await callback.answer("این کاربر مشتری سازمانی نیست.", show_alert=True)
+            return
+        active_configs = db.query(WireGuardConfig).filter(
+            WireGuardConfig.user_telegram_id == user_obj.telegram_id,
+            WireGuardConfig.status == "active"
+        ).all()
+        reset_count = await reset_configs_on_routers(db, active_configs, "Org settlement peer reset failed")
+        for cfg in active_configs:
+            cfg.cumulative_rx_bytes = 0
+            cfg.cumulative_tx_bytes = 0
+            cfg.last_rx_counter = 0
+            cfg.last_tx_counter = 0
+            cfg.counter_reset_flag = True
+        user_obj.org_last_settlement_at = datetime.utcnow()
+        db.commit()
+        await callback.message.answer(
+            f"✅ تسویه انجام شد. {reset_count} کانفیگ روی روتر ریست و مصرف در دیتابیس صفر شد.",
+            parse_mode="HTML",
+        )
+        msg, keyboard = get_admin_user_manage_view(db, user_obj, show_finance_panel=True)
+        await callback.message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
 
     elif data.startswith("admin_user_configs_"):
         target_user_id = int(data.replace("admin_user_configs_", ""))
-        db = SessionLocal()
-        try:
-            user_obj = db.query(User).filter(User.id == target_user_id).first()
-            if not user_obj:
-                await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-                return
-            configs = db.query(WireGuardConfig).filter(
-                WireGuardConfig.user_telegram_id == user_obj.telegram_id
-            ).order_by(WireGuardConfig.created_at.desc()).all()
+        user_obj = db.query(User).filter(User.id == target_user_id).first()
+        if not user_obj:
+            await callback.message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
+            return
+        configs = db.query(WireGuardConfig).filter(
+            WireGuardConfig.user_telegram_id == user_obj.telegram_id
+        ).order_by(WireGuardConfig.created_at.desc()).all()
 
-            if configs:
-                await callback.message.answer(
-                    f"🔗 کانفیگ‌های کاربر {user_obj.first_name or ''}",
-                    reply_markup=get_admin_user_configs_keyboard(user_obj.id, configs),
-                    parse_mode="HTML"
-                )
-            else:
-                await callback.message.answer("❌ این کاربر کانفیگی ندارد.", parse_mode="HTML")
-        finally:
-            db.close()
+        if configs:
+            await callback.message.answer(
+                f"🔗 کانفیگ‌های کاربر {user_obj.first_name or ''}",
+                reply_markup=get_admin_user_configs_keyboard(user_obj.id, configs),
+                parse_mode="HTML"
+            )
+        else:
+            await callback.message.answer("❌ این کاربر کانفیگی ندارد.", parse_mode="HTML")
 
     elif data.startswith("admin_cfg_view_"):
         config_id = int(data.replace("admin_cfg_view_", ""))
-        db = SessionLocal()
-        try:
-            config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
-            if not config:
-                await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
-                return
-
-            plan = db.query(Plan).filter(Plan.id == config.plan_id).first() if config.plan_id else None
-            plan_traffic_bytes, remaining_bytes = get_config_remaining_bytes(config, plan)
-            consumed_bytes = get_config_consumed_bytes(config)
-            expires_at = get_config_expires_at(config, plan)
-            duration_days, traffic_limit_gb = get_config_limits(config, plan)
-
-            now = datetime.utcnow()
-            is_expired_by_date = bool(expires_at and expires_at <= now)
-            is_expired_by_traffic = bool(plan_traffic_bytes and remaining_bytes <= 0)
-            is_disabled = config.status in ["expired", "revoked", "disabled"]
-            can_renew = bool(is_expired_by_date or is_expired_by_traffic or is_disabled)
-
-            remaining_days = "نامشخص"
-            if expires_at:
-                days_left = int((expires_at - now).total_seconds() // 86400)
-                remaining_days = str(max(days_left, 0))
-
-            status_text = "🔴 غیرفعال" if config.status != "active" else "🟢 فعال"
+        config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
+        if not config:
+            await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
+            return
 
-            server = db.query(Server).filter(Server.id == config.server_id).first() if config.server_id else None
-            msg = (
-                f"📋 مدیریت کانفیگ {config.client_ip}\nبرای ویرایش، روی دکمه روز یا ترافیک بزنید."
-            )
-            await callback.message.answer(
-                msg,
-                reply_markup=get_admin_config_detail_keyboard(
-                    config.id,
-                    can_renew=can_renew,
-                    duration_days_text=(str(duration_days) if duration_days is not None else "نامشخص"),
-                    traffic_text=(f"{traffic_limit_gb} گیگ" if traffic_limit_gb is not None else "نامشخص"),
-                    consumed_text=format_traffic_size(consumed_bytes),
-                    remaining_text=(format_traffic_size(remaining_bytes) if plan_traffic_bytes else "نامحدود/نامشخص"),
-                    status_text=status_text,
-                ),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        limits = resolve_config_limits(db, [config])[config.id]
+        plan_traffic_bytes, remaining_bytes = limits["limit_bytes"], limits["remaining_bytes"]
+        consumed_bytes = limits["consumed_bytes"]
+        expires_at = limits["expires_at"]
+        duration_days, traffic_limit_gb = limits["duration_days"], limits["traffic_limit_gb"]
+
+        now = datetime.utcnow()
+        is_expired_by_date = bool(expires_at and expires_at <= now)
+        is_expired_by_traffic = bool(plan_traffic_bytes and remaining_bytes <= 0)
+        is_disabled = config.status in ["expired", "revoked", "disabled"]
+        can_renew = bool(is_expired_by_date or is_expired_by_traffic or is_disabled)
+
+        remaining_days = "نامشخص"
+        if expires_at:
+            days_left = int((expires_at - now).total_seconds() // 86400)
+            remaining_days = str(max(days_left, 0))
+
+        status_text = "🔴 غیرفعال" if config.status != "active" else "🟢 فعال"
+
+        server = db.query(Server).filter(Server.id == config.server_id).first() if config.server_id else None
+        msg = (
+            f"📋 مدیریت کانفیگ {config.client_ip}\nبرای ویرایش، روی دکمه روز یا ترافیک بزنید."
+        )
+        await callback.message.answer(
+            msg,
+            reply_markup=get_admin_config_detail_keyboard(
+                config.id,
+                can_renew=can_renew,
+                duration_days_text=(str(duration_days) if duration_days is not None else "نامشخص"),
+                traffic_text=(f"{traffic_limit_gb} گیگ" if traffic_limit_gb is not None else "نامشخص"),
+                consumed_text=format_traffic_size(consumed_bytes),
+                remaining_text=(format_traffic_size(remaining_bytes) if plan_traffic_bytes else "نامحدود/نامشخص"),
+                status_text=status_text,
+            ),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_cfg_set_traffic_"):
         config_id = int(data.replace("admin_cfg_set_traffic_", ""))
@@ -459,110 +375,103 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
             await callback.answer("❌ دسترسی ندارید.", show_alert=True)
             return
         config_id = int(data.replace("admin_cfg_disable_", ""))
-        db = SessionLocal()
-        try:
-            config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
-            if not config:
-                await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
-                return
-
-            # Disable in MikroTik
-            try:
-                import wireguard
-                server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
-                if server:
-                    wireguard.disable_wireguard_peer(
-                        mikrotik_host=server.host,
-                        mikrotik_user=server.username,
-                        mikrotik_pass=server.password,
-                        mikrotik_port=server.api_port,
-                        wg_interface=server.wg_interface,
-                        client_ip=config.client_ip
-                    )
-            except Exception as e:
-                print(f"MikroTik disable error: {e}")
+        config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
+        if not config:
+            await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
+            return
 
-            config.status = "disabled"
+        # Disable in MikroTik
+        try:
+            import wireguard
+            server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
+            # Don't idle in transaction while the router is called
             db.commit()
-            await callback.message.answer("✅ کانفیگ غیرفعال شد.", parse_mode="HTML")
-
-            # Show config detail again
-            msg = (
-                f"📋 جزئیات کانفیگ (مدیریت)\n\n"
-                f"• کاربر: {config.user_telegram_id}\n"
-                f"• پلن: {config.plan_name or 'نامشخص'}\n"
-                f"• آی پی: {config.client_ip}\n"
-                f"• وضعیت: 🔴 غیرفعال"
-            )
-            await callback.message.answer(
-                msg,
-                reply_markup=get_admin_config_detail_keyboard(config.id, can_renew=True),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+            if server:
+                await wireguard.disable_wireguard_peer(
+                    mikrotik_host=server.host,
+                    mikrotik_user=server.username,
+                    mikrotik_pass=server.password,
+                    mikrotik_port=server.api_port,
+                    wg_interface=server.wg_interface,
+                    client_ip=config.client_ip
+                )
+        except Exception as e:
+            print(f"MikroTik disable error: {e}")
+
+        config.status = "disabled"
+        db.commit()
+        await callback.message.answer("✅ کانفیگ غیرفعال شد.", parse_mode="HTML")
+
+        # Show config detail again
+        msg = (
+            f"📋 جزئیات کانفیگ (مدیریت)\n\n"
+            f"• کاربر: {config.user_telegram_id}\n"
+            f"• پلن: {config.plan_name or 'نامشخص'}\n"
+            f"• آی پی: {config.client_ip}\n"
+            f"• وضعیت: 🔴 غیرفعال"
+        )
+        await callback.message.answer(
+            msg,
+            reply_markup=get_admin_config_detail_keyboard(config.id, can_renew=True),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_cfg_delete_"):
         if not is_admin(user_id):
             await callback.answer("❌ دسترسی ندارید.", show_alert=True)
             return
         config_id = int(data.replace("admin_cfg_delete_", ""))
-        db = SessionLocal()
-        try:
-            config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
-            if not config:
-                await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
-                return
+        config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
+        if not config:
+            await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
+            return
 
-            await callback.message.answer(
-                f"⚠️ آیا از حذف کانفیگ {config.client_ip} اطمینان دارید؟\n\nاین عملیات غیرقابل بازگشت است و کانفیگ از میکروتیک حذف می‌شود.",
-                reply_markup=get_admin_config_confirm_delete_keyboard(config.id),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        await callback.message.answer(
+            f"⚠️ آیا از حذف کانفیگ {config.client_ip} اطمینان دارید؟\n\nاین عملیات غیرقابل بازگشت است و کانفیگ از میکروتیک حذف می‌شود.",
+            reply_markup=get_admin_config_confirm_delete_keyboard(config.id),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_cfg_delete_confirm_"):
         if not is_admin(user_id):
             await callback.answer("❌ دسترسی ندارید.", show_alert=True)
             return
         config_id = int(data.replace("admin_cfg_delete_confirm_", ""))
-        db = SessionLocal()
-        try:
-            config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
-            if not config:
-                await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
-                return
+        config = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
+        if not config:
+            await callback.message.answer("❌ کانفیگ یافت نشد.", parse_mode="HTML")
+            return
 
-            client_ip = config.client_ip
-            user_tg_id = config.user_telegram_id
-
-            # Delete from MikroTik
-            try:
-                import wireguard
-                server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
-                if server:
-                    wireguard.delete_wireguard_peer(
-                        mikrotik_host=server.host,
-                        mikrotik_user=server.username,
-                        mikrotik_pass=server.password,
-                        mikrotik_port=server.api_port,
-                        wg_interface=server.wg_interface,
-                        client_ip=client_ip
-                    )
-            except Exception as e:
-                print(f"MikroTik delete error: {e}")
+        client_ip = config.client_ip
+        user_tg_id = config.user_telegram_id
 
-            # Delete from database
-            db.delete(config)
+        # Delete from MikroTik
+        try:
+            import wireguard
+            server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
             db.commit()
+            if server:
+                await wireguard.delete_wireguard_peer(
+                    mikrotik_host=server.host,
+                    mikrotik_user=server.username,
+                    mikrotik_pass=server.password,
+                    mikrotik_port=server.api_port,
+                    wg_interface=server.wg_interface,
+                    client_ip=client_ip
+                )
+        except Exception as e:
+            print(f"MikroTik delete error: {e}")
 
-            await callback.message.answer(
-                f"✅ کانفیگ {client_ip} حذف شد.",
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        # Delete from database
+        release_ip(config.server_id, config.client_ip, db=db)
+        forget_config(config.id, db=db)
+        db.delete(config)
+        db.commit()
+
+        await callback.message.answer(
+            f"✅ کانفیگ {client_ip} حذف شد.",
+            parse_mode="HTML"
+        )
 
     elif data.startswith("wallet_inc_") or data.startswith("wallet_dec_"):
         if not is_admin(user_id):
@@ -583,121 +492,100 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         await callback.message.answer("کد تخفیف را وارد کنید (مثال: NEWYEAR):", parse_mode="HTML")
 
     elif data == "admin_service_types":
-        db = SessionLocal()
-        try:
-            rows = db.query(ServiceType).order_by(ServiceType.id.asc()).all()
-            await callback.message.answer("🧩 مدیریت انواع سرویس", reply_markup=get_service_types_keyboard(rows), parse_mode="HTML")
-        finally:
-            db.close()
+        await callback.message.answer("🧩 مدیریت انواع سرویس", reply_markup=catalog_cache.get().service_types_keyboard, parse_mode="HTML")
 
     # === TUTORIAL HANDLERS ===
     elif data == "admin_tutorials":
-        db = SessionLocal()
-        try:
-            service_types = db.query(ServiceType).filter(ServiceType.is_active == True).order_by(ServiceType.id.asc()).all()
-            if service_types:
-                await callback.message.answer(
-                    "📚 مدیریت آموزش\n\nنوع سرویس را برای ویرایش آموزش انتخاب کنید:",
-                    reply_markup=get_service_type_picker_keyboard(service_types, "admin_tutorial_edit_"),
-                    parse_mode="HTML"
-                )
-            else:
-                await callback.message.answer("❌ هیچ نوع سرویسی یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+        service_types = db.query(ServiceType).filter(ServiceType.is_active == True).order_by(ServiceType.id.asc()).all()
+        if service_types:
+            await callback.message.answer(
+                "📚 مدیریت آموزش\n\nنوع سرویس را برای ویرایش آموزش انتخاب کنید:",
+                reply_markup=get_service_type_picker_keyboard(service_types, "admin_tutorial_edit_"),
+                parse_mode="HTML"
+            )
+        else:
+            await callback.message.answer("❌ هیچ نوع سرویسی یافت نشد.", parse_mode="HTML")
 
     elif data.startswith("admin_tutorial_edit_"):
         service_type_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
-            if not service_type:
-                await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
-                return
+        service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
+        if not service_type:
+            await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
+            return
 
-            tutorial = db.query(ServiceTutorial).filter(
-                ServiceTutorial.service_type_id == service_type_id,
-                ServiceTutorial.is_active == True
-            ).first()
+        tutorial = db.query(ServiceTutorial).filter(
+            ServiceTutorial.service_type_id == service_type_id,
+            ServiceTutorial.is_active == True
+        ).first()
 
-            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-            if tutorial:
-                # Show existing tutorial with option to edit
-                msg = f"📚 آموزش {service_type.name}\n\n"
-                if tutorial.description:
-                    msg += f"متن: {tutorial.description[:200]}...\n"
-                if tutorial.media_type:
-                    msg += f"رسانه: {'عکس' if tutorial.media_type == 'photo' else 'ویدیو'} 📎"
+        if tutorial:
+            # Show existing tutorial with option to edit
+            msg = f"📚 آموزش {service_type.name}\n\n"
+            if tutorial.description:
+                msg += f"متن: {tutorial.description[:200]}...\n"
+            if tutorial.media_type:
+                msg += f"رسانه: {'عکس' if tutorial.media_type == 'photo' else 'ویدیو'} 📎"
 
-                await callback.message.answer(
-                    msg,
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="✏️ ویرایش آموزش", callback_data=f"admin_tutorial_create_{service_type_id}")],
-                        [InlineKeyboardButton(text="🗑️ حذف آموزش", callback_data=f"admin_tutorial_delete_{service_type_id}")],
-                        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="admin_tutorials")]
-                    ]),
-                    parse_mode="HTML"
-                )
-            else:
-                await callback.message.answer(
-                    f"📚 آموزش {service_type.name}\n\nآموزشی تعریف نشده است.",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="➕ افزودن آموزش", callback_data=f"admin_tutorial_create_{service_type_id}")],
-                        [InlineKeyboardButton(text="🔙 بازگشت", callback_data="admin_tutorials")]
-                    ]),
-                    parse_mode="HTML"
-                )
-        finally:
-            db.close()
+            await callback.message.answer(
+                msg,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="✏️ ویرایش آموزش", callback_data=f"admin_tutorial_create_{service_type_id}")],
+                    [InlineKeyboardButton(text="🗑️ حذف آموزش", callback_data=f"admin_tutorial_delete_{service_type_id}")],
+                    [InlineKeyboardButton(text="🔙 بازگشت", callback_data="admin_tutorials")]
+                ]),
+                parse_mode="HTML"
+            )
+        else:
+            await callback.message.answer(
+                f"📚 آموزش {service_type.name}\n\nآموزشی تعریف نشده است.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="➕ افزودن آموزش", callback_data=f"admin_tutorial_create_{service_type_id}")],
+                    [InlineKeyboardButton(text="🔙 بازگشت", callback_data="admin_tutorials")]
+                ]),
+                parse_mode="HTML"
+            )
 
     elif data.startswith("admin_tutorial_create_"):
         service_type_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
-            if not service_type:
-                await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
-                return
+        service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
+        if not service_type:
+            await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
+            return
 
-            # Start tutorial creation flow
-            admin_tutorial_state[user_id] = {
-                "service_type_id": service_type_id,
-                "step": "title"
-            }
+        # Start tutorial creation flow
+        admin_tutorial_state[user_id] = {
+            "service_type_id": service_type_id,
+            "step": "title"
+        }
 
-            await callback.message.answer(
-                f"📝 ایجاد آموزش برای {service_type.name}\n\n"
-                "لطفاً عنوان آموزش را وارد کنید:",
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        await callback.message.answer(
+            f"📝 ایجاد آموزش برای {service_type.name}\n\n"
+            "لطفاً عنوان آموزش را وارد کنید:",
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_tutorial_delete_"):
         service_type_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            tutorial = db.query(ServiceTutorial).filter(
-                ServiceTutorial.service_type_id == service_type_id
-            ).first()
-
-            if tutorial:
-                db.delete(tutorial)
-                db.commit()
-                await callback.message.answer("✅ آموزش حذف شد.", parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ آموزش یافت نشد.", parse_mode="HTML")
+        tutorial = db.query(ServiceTutorial).filter(
+            ServiceTutorial.service_type_id == service_type_id
+        ).first()
 
-            # Show service types again
-            service_types = db.query(ServiceType).filter(ServiceType.is_active == True).order_by(ServiceType.id.asc()).all()
-            await callback.message.answer(
-                "📚 مدیریت آموزش\n\nنوع سرویس را انتخاب کنید:",
-                reply_markup=get_service_type_picker_keyboard(service_types, "admin_tutorial_edit_"),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        if tutorial:
+            db.delete(tutorial)
+            db.commit()
+            await callback.message.answer("✅ آموزش حذف شد.", parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ آموزش یافت نشد.", parse_mode="HTML")
+
+        # Show service types again
+        service_types = db.query(ServiceType).filter(ServiceType.is_active == True).order_by(ServiceType.id.asc()).all()
+        await callback.message.answer(
+            "📚 مدیریت آموزش\n\nنوع سرویس را انتخاب کنید:",
+            reply_markup=get_service_type_picker_keyboard(service_types, "admin_tutorial_edit_"),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_tutorial_skip_media_"):
         service_type_id = int(data.split("_")[-1])
@@ -710,7 +598,6 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
             await callback.message.answer("❌ عملیات نامعتبر است.", parse_mode="HTML")
             return
 
-        db = SessionLocal()
         try:
             # Check if tutorial exists and update, or create new
             existing = db.query(ServiceTutorial).filter(
@@ -739,117 +626,108 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         except Exception as e:
             await callback.message.answer(f"❌ خطا: {e}", parse_mode="HTML")
         finally:
-            db.close()
             del admin_tutorial_state[user_id]
 
     # === USER TUTORIAL VIEW ===
     elif data == "user_tutorials":
-        db = SessionLocal()
-        try:
-            # Get all active tutorials
-            tutorials = db.query(ServiceTutorial).filter(ServiceTutorial.is_active == True).all()
-
-            if not tutorials:
-                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-                await callback.message.answer(
-                    "📚 آموزش\n\nآموزشی یافت نشد.",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
-                    ]),
-                    parse_mode="HTML"
-                )
-                return
+        # Get all active tutorials
+        tutorials = db.query(ServiceTutorial).filter(ServiceTutorial.is_active == True).all()
 
-            # Send each tutorial
+        if not tutorials:
             from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-
-            for i, tutorial in enumerate(tutorials):
-                service_type = db.query(ServiceType).filter(ServiceType.id == tutorial.service_type_id).first()
-                service_name = service_type.name if service_type else ""
-
-                # Send tutorial with media if available
-                if tutorial.media_file_id:
-                    if tutorial.media_type == "photo":
-                        await callback.message.answer_photo(
-                            photo=tutorial.media_file_id,
-                            caption=f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or ''}",
-                            parse_mode="HTML"
-                        )
-                    elif tutorial.media_type == "video":
-                        await callback.message.answer_video(
-                            video=tutorial.media_file_id,
-                            caption=f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or ''}",
-                            parse_mode="HTML"
-                        )
-                else:
-                    # No media, just send text
-                    await callback.message.answer(
-                        f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or 'بدون توضیحات'}",
-                        parse_mode="HTML"
-                    )
-
-            # Send back button after all tutorials
             await callback.message.answer(
-                "برای بازگشت به منوی اصلی از دکمه زیر استفاده کنید:",
+                "📚 آموزش\n\nآموزشی یافت نشد.",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
                 ]),
                 parse_mode="HTML"
             )
-        finally:
-            db.close()
-
-    elif data.startswith("user_tutorial_view_"):
-        service_type_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
-            if not service_type:
-                await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
-                return
+            return
 
-            tutorial = db.query(ServiceTutorial).filter(
-                ServiceTutorial.service_type_id == service_type_id,
-                ServiceTutorial.is_active == True
-            ).first()
+        # Send each tutorial
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-            if not tutorial:
-                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-                await callback.message.answer(
-                    f"📚 آموزش {service_type.name}\n\nآموزشی یافت نشد.",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
-                    ]),
-                    parse_mode="HTML"
-                )
-                return
+        for i, tutorial in enumerate(tutorials):
+            service_type = db.query(ServiceType).filter(ServiceType.id == tutorial.service_type_id).first()
+            service_name = service_type.name if service_type else ""
 
             # Send tutorial with media if available
             if tutorial.media_file_id:
                 if tutorial.media_type == "photo":
                     await callback.message.answer_photo(
                         photo=tutorial.media_file_id,
-                        caption=f"📚 {tutorial.title}\n\n{tutorial.description or ''}",
+                        caption=f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or ''}",
                         parse_mode="HTML"
                     )
                 elif tutorial.media_type == "video":
                     await callback.message.answer_video(
                         video=tutorial.media_file_id,
-                        caption=f"📚 {tutorial.title}\n\n{tutorial.description or ''}",
+                        caption=f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or ''}",
                         parse_mode="HTML"
                     )
             else:
                 # No media, just send text
-                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
                 await callback.message.answer(
-                    f"📚 {tutorial.title}\n\n{tutorial.description or 'بدون توضیحات'}",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
-                    ]),
+                    f"📚 {tutorial.title}\n\n{service_name}\n\n{tutorial.description or 'بدون توضیحات'}",
                     parse_mode="HTML"
                 )
-        finally:
-            db.close()
+
+        # Send back button after all tutorials
+        await callback.message.answer(
+            "برای بازگشت به منوی اصلی از دکمه زیر استفاده کنید:",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
+            ]),
+            parse_mode="HTML"
+        )
+
+    elif data.startswith("user_tutorial_view_"):
+        service_type_id = int(data.split("_")[-1])
+        service_type = db.query(ServiceType).filter(ServiceType.id == service_type_id).first()
+        if not service_type:
+            await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
+            return
+
+        tutorial = db.query(ServiceTutorial).filter(
+            ServiceTutorial.service_type_id == service_type_id,
+            ServiceTutorial.is_active == True
+        ).first()
+
+        if not tutorial:
+            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+            await callback.message.answer(
+                f"📚 آموزش {service_type.name}\n\nآموزشی یافت نشد.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
+                ]),
+                parse_mode="HTML"
+            )
+            return
+
+        # Send tutorial with media if available
+        if tutorial.media_file_id:
+            if tutorial.media_type == "photo":
+                await callback.message.answer_photo(
+                    photo=tutorial.media_file_id,
+                    caption=f"📚 {tutorial.title}\n\n{tutorial.description or ''}",
+                    parse_mode="HTML"
+                )
+            elif tutorial.media_type == "video":
+                await callback.message.answer_video(
+                    video=tutorial.media_file_id,
+                    caption=f"📚 {tutorial.title}\n\n{tutorial.description or ''}",
+                    parse_mode="HTML"
+                )
+        else:
+            # No media, just send text
+            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+            await callback.message.answer(
+                f"📚 {tutorial.title}\n\n{tutorial.description or 'بدون توضیحات'}",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 بازگشت به منوی اصلی", callback_data="back_to_main")]
+                ]),
+                parse_mode="HTML"
+            )
 
     elif data == "service_type_add":
         admin_service_type_state[user_id] = {"step": "name"}
@@ -857,180 +735,162 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
 
     elif data.startswith("service_type_view_"):
         st_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            st = db.query(ServiceType).filter(ServiceType.id == st_id).first()
-            if not st:
-                await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
-                return
-            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-            await callback.message.answer(
-                f"🧩 {st.name} ({st.code})",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🗑️ حذف", callback_data=f"service_type_delete_{st.id}")]]),
-                parse_mode="HTML",
-            )
-        finally:
-            db.close()
+        st = db.query(ServiceType).filter(ServiceType.id == st_id).first()
+        if not st:
+            await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
+            return
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        await callback.message.answer(
+            f"🧩 {st.name} ({st.code})",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🗑️ حذف", callback_data=f"service_type_delete_{st.id}")]]),
+            parse_mode="HTML",
+        )
 
     elif data.startswith("service_type_delete_"):
         st_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            st = db.query(ServiceType).filter(ServiceType.id == st_id).first()
-            if not st:
-                await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
-                return
-            has_plan = db.query(Plan).filter(Plan.service_type_id == st.id).first()
-            has_server = db.query(Server).filter(Server.service_type_id == st.id).first()
-            if has_plan or has_server:
-                await callback.message.answer("❌ ابتدا پلن‌ها و سرورهای این نوع سرویس را حذف کنید.", parse_mode="HTML")
-                return
-            db.delete(st)
-            db.commit()
-            await callback.message.answer("✅ نوع سرویس حذف شد.", parse_mode="HTML")
-        finally:
-            db.close()
+        st = db.query(ServiceType).filter(ServiceType.id == st_id).first()
+        if not st:
+            await callback.message.answer("❌ نوع سرویس یافت نشد.", parse_mode="HTML")
+            return
+        has_plan = db.query(Plan).filter(Plan.service_type_id == st.id).first()
+        has_server = db.query(Server).filter(Server.service_type_id == st.id).first()
+        if has_plan or has_server:
+            await callback.message.answer("❌ ابتدا پلن‌ها و سرورهای این نوع سرویس را حذف کنید.", parse_mode="HTML")
+            return
+        db.delete(st)
+        db.commit()
+        catalog_cache.invalidate()
+        await callback.message.answer("✅ نوع سرویس حذف شد.", parse_mode="HTML")
 
-    elif await handle_server_management_callbacks(callback, bot, data, user_id):
+    elif await handle_server_management_callbacks(callback, bot, data, user_id, db):
         return True
 
-    elif await handle_plan_management_callbacks(callback, bot, data, user_id):
+    elif await handle_plan_management_callbacks(callback, bot, data, user_id, db):
         return True
 
     # === PAYMENT CALLBACKS ===
     elif data.startswith("buy_plan_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
-            if not plan:
-                await callback.message.answer("❌ پلن یافت نشد یا غیرفعال است.", parse_mode="HTML")
-                return
-            available_servers = get_available_servers_for_plan(db, plan.id)
-            if available_servers:
-                user_payment_state[user_id] = {"plan_id": plan_id, "plan_name": plan.name, "price": plan.price}
-                if len(available_servers) > 1:
-                    await callback.message.answer("ابتدا سرور را انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(available_servers, f"buy_pick_server_{plan.id}_"), parse_mode="HTML")
-                    return
-                user_payment_state[user_id]["server_id"] = available_servers[0].id
-            else:
-                await callback.message.answer("❌ ظرفیت سرورهای این پلن تکمیل است.", parse_mode="HTML")
+        plan = catalog_cache.get().active_plan(plan_id)
+        if not plan:
+            await callback.message.answer("❌ پلن یافت نشد یا غیرفعال است.", parse_mode="HTML")
+            return
+        available_servers = catalog_cache.available_servers(db, plan.id)
+        if available_servers:
+            user_payment_state[user_id] = {"plan_id": plan_id, "plan_name": plan.name, "price": plan.price}
+            if len(available_servers) > 1:
+                await callback.message.answer("ابتدا سرور را انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(available_servers, f"buy_pick_server_{plan.id}_"), parse_mode="HTML")
                 return
+            user_payment_state[user_id]["server_id"] = available_servers[0].id
+        else:
+            await callback.message.answer("❌ ظرفیت سرورهای این پلن تکمیل است.", parse_mode="HTML")
+            return
 
-            msg = (
-                f'💳 پرداخت پلن "{plan.name}"\n\n'
-                f"• حجم: {plan.traffic_gb} گیگ\n"
-                f"• مدت: {plan.duration_days} روز\n"
-                f"• قیمت: {plan.price} تومان\n\n"
-                "روش پرداخت را انتخاب کنید:"
-            )
-            await callback.message.answer(msg, reply_markup=get_payment_method_keyboard(plan_id), parse_mode="HTML")
-        finally:
-            db.close()
+        msg = (
+            f'💳 پرداخت پلن "{plan.name}"\n\n'
+            f"• حجم: {plan.traffic_gb} گیگ\n"
+            f"• مدت: {plan.duration_days} روز\n"
+            f"• قیمت: {plan.price} تومان\n\n"
+            "روش پرداخت را انتخاب کنید:"
+        )
+        await callback.message.answer(msg, reply_markup=get_payment_method_keyboard(plan_id), parse_mode="HTML")
 
     elif data.startswith("buy_pick_server_"):
         parts = data.split("_")
         plan_id = int(parts[3])
         server_id = int(parts[4])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
-            if not plan:
-                await callback.message.answer("❌ پلن معتبر نیست.", parse_mode="HTML")
-                return
-            state = user_payment_state.get(user_id, {})
-            state.update({"plan_id": plan_id, "plan_name": plan.name, "price": plan.price, "server_id": server_id})
-            user_payment_state[user_id] = state
-            await callback.message.answer("✅ سرور انتخاب شد. حالا روش پرداخت را انتخاب کنید:", reply_markup=get_payment_method_keyboard(plan_id), parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
+        if not plan:
+            await callback.message.answer("❌ پلن معتبر نیست.", parse_mode="HTML")
+            return
+        state = user_payment_state.get(user_id, {})
+        state.update({"plan_id": plan_id, "plan_name": plan.name, "price": plan.price, "server_id": server_id})
+        user_payment_state[user_id] = state
+        await callback.message.answer("✅ سرور انتخاب شد. حالا روش پرداخت را انتخاب کنید:", reply_markup=get_payment_method_keyboard(plan_id), parse_mode="HTML")
 
     elif data.startswith("pay_card_"):
         payload = data.replace("pay_card_", "")
         parts = payload.split("_")
         plan_id = int(parts[0])
         renew_config_id = int(parts[1]) if len(parts) > 1 else None
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id).first()
-            if plan:
-                current = user_payment_state.get(user_id, {})
-                discount_amount = int(current.get("discount_amount", 0) or 0)
-                final_price = max(plan.price - discount_amount, 0)
-                user_payment_state[user_id] = {
-                    "plan_id": plan_id,
-                    "plan_name": plan.name,
-                    "price": final_price,
-                    "method": "card_to_card",
-                    "renew_config_id": renew_config_id,
-                    "gift_code": current.get("gift_code"),
-                    "server_id": current.get("server_id")
-                }
-                card_number, card_holder = get_card_info()
-                card_text = card_number if card_number else "هنوز شماره کارتی داده نشده"
-                holder_text = card_holder if card_holder else "نام صاحب حساب"
-                msg = (
-                    f"💳 پرداخت کارت به کارت\n\n"
-                    f"پلن: {plan.name} ( {final_price:,} تومان )\n\n\n"
-                    f" لطفاً مبلغ {final_price:,} تومان به شماره کارت زیر واریز کنید و تصویر فیش واریزی رو در همین مرحله آپلود کنید .\n\n"
-                    f"<code>{card_text}</code>\n\n"
-                    f"{holder_text}"
-                )
-                await callback.message.answer(msg, parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        if plan:
+            current = user_payment_state.get(user_id, {})
+            discount_amount = int(current.get("discount_amount", 0) or 0)
+            final_price = max(plan.price - discount_amount, 0)
+            user_payment_state[user_id] = {
+                "plan_id": plan_id,
+                "plan_name": plan.name,
+                "price": final_price,
+                "method": "card_to_card",
+                "renew_config_id": renew_config_id,
+                "gift_code": current.get("gift_code"),
+                "server_id": current.get("server_id")
+            }
+            card_number, card_holder = get_card_info()
+            card_text = card_number if card_number else "هنوز شماره کارتی داده نشده"
+            holder_text = card_holder if card_holder else "نام صاحب حساب"
+            msg = (
+                f"💳 پرداخت کارت به کارت\n\n"
+                f"پلن: {plan.name} ( {final_price:,} تومان )\n\n\n"
+                f" لطفاً مبلغ {final_price:,} تومان به شماره کارت زیر واریز کنید و تصویر فیش واریزی رو در همین مرحله آپلود کنید .\n\n"
+                f"<code>{card_text}</code>\n\n"
+                f"{holder_text}"
+            )
+            await callback.message.answer(msg, parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
 
     elif data.startswith("pay_wallet_"):
         payload = data.replace("pay_wallet_", "")
         parts = payload.split("_")
         plan_id = int(parts[0])
         renew_config_id = int(parts[1]) if len(parts) > 1 else None
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id).first()
-            user = get_user(db, str(user_id))
-            if plan and user:
-                current = user_payment_state.get(user_id, {})
-                discount_amount = int(current.get("discount_amount", 0) or 0)
-                final_price = max(plan.price - discount_amount, 0)
-                if user.wallet_balance >= final_price:
-                    user.wallet_balance -= final_price
-                    db.commit()
-                    await callback.message.answer(
-                        f"✅ پرداخت موفق!\n\nپلن: {plan.name}\nقیمت نهایی: {final_price} تومان",
-                        parse_mode="HTML"
-                    )
-                else:
-                    await callback.message.answer(
-                        f"❌ موجودی کیف پول کافی نیست!\n\nموجودی فعلی: {user.wallet_balance} تومان\nقیمت پلن: {final_price} تومان\n\nبرای شارژ کیف پول با پشتیبانی تماس بگیرید.",
-                        parse_mode="HTML"
-                    )
+        plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        user = get_user(db, str(user_id))
+        if plan and user:
+            current = user_payment_state.get(user_id, {})
+            discount_amount = int(current.get("discount_amount", 0) or 0)
+            final_price = max(plan.price - discount_amount, 0)
+            if user.wallet_balance >= final_price:
+                user.wallet_balance -= final_price
+                db.commit()
+                await callback.message.answer(
+                    f"✅ پرداخت موفق!\n\nپلن: {plan.name}\nقیمت نهایی: {final_price} تومان",
+                    parse_mode="HTML"
+                )
             else:
-                await callback.message.answer("❌ پلن یا کاربر یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+                await callback.message.answer(
+                    f"❌ موجودی کیف پول کافی نیست!\n\nموجودی فعلی: {user.wallet_balance} تومان\nقیمت پلن: {final_price} تومان\n\nبرای شارژ کیف پول با پشتیبانی تماس بگیرید.",
+                    parse_mode="HTML"
+                )
+        else:
+            await callback.message.answer("❌ پلن یا کاربر یافت نشد.", parse_mode="HTML")
 
     elif data.startswith("receipt_approve_"):
         if not is_admin(user_id):
             await callback.answer("❌ دسترسی ندارید.", show_alert=True)
             return
         receipt_id = int(data.split("_")[-1])
-        db = SessionLocal()
         try:
-            receipt = db.query(PaymentReceipt).filter(PaymentReceipt.id == receipt_id).first()
-            if receipt:
+            # Row lock so a double tap (or two admins) cannot approve and credit twice
+            receipt = await session.scalar(
+                select(PaymentReceipt).where(PaymentReceipt.id == receipt_id).with_for_update()
+            )
+            if receipt and receipt.status == "approved":
+                await session.rollback()
+                await callback.answer("این فیش قبلاً تایید شده است.", show_alert=True)
+            elif receipt:
                 receipt.status = "approved"
                 receipt.approved_at = datetime.utcnow()
                 receipt.approved_by = str(user_id)
-                db.commit()
+                await session.commit()
 
                 if receipt.payment_method == "wallet_topup":
-                    wallet_user = get_user(db, receipt.user_telegram_id)
+                    wallet_user = await get_user_async(session, receipt.user_telegram_id)
                     if wallet_user:
                         wallet_user.wallet_balance = (wallet_user.wallet_balance or 0) + (receipt.amount or 0)
-                        db.commit()
+                        await session.commit()
                         try:
                             await callback.message.bot.send_message(
                                 chat_id=int(receipt.user_telegram_id),
@@ -1053,38 +913,25 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                     return True
 
                 if receipt.payment_method == "org_settlement":
-                    target_user = get_user(db, receipt.user_telegram_id)
+                    target_user = await get_user_async(session, receipt.user_telegram_id)
                     if not target_user or not target_user.is_organization_customer:
                         await callback.message.answer("❌ کاربر سازمانی یافت نشد.", parse_mode="HTML")
                         return True
-                    active_configs = db.query(WireGuardConfig).filter(
-                        WireGuardConfig.user_telegram_id == target_user.telegram_id,
-                        WireGuardConfig.status == "active",
-                    ).all()
-                    reset_count = 0
+                    active_configs = (await session.scalars(
+                        select(WireGuardConfig).where(
+                            WireGuardConfig.user_telegram_id == target_user.telegram_id,
+                            WireGuardConfig.status == "active",
+                        )
+                    )).all()
+                    reset_count = await reset_configs_on_routers_async(session, active_configs, "Org settlement approve reset error")
                     for cfg in active_configs:
-                        server = db.query(Server).filter(Server.id == cfg.server_id, Server.is_active == True).first() if cfg.server_id else None
-                        if server:
-                            try:
-                                import wireguard
-                                if wireguard.reset_wireguard_peer_traffic(
-                                    mikrotik_host=server.host,
-                                    mikrotik_user=server.username,
-                                    mikrotik_pass=server.password,
-                                    mikrotik_port=server.api_port,
-                                    wg_interface=server.wg_interface,
-                                    client_ip=cfg.client_ip,
-                                ):
-                                    reset_count += 1
-                            except Exception as e:
-                                print(f"Org settlement approve reset error ({cfg.client_ip}): {e}")
                         cfg.cumulative_rx_bytes = 0
                         cfg.cumulative_tx_bytes = 0
                         cfg.last_rx_counter = 0
                         cfg.last_tx_counter = 0
                         cfg.counter_reset_flag = True
                     target_user.org_last_settlement_at = datetime.utcnow()
-                    db.commit()
+                    await session.commit()
 
                     await callback.message.answer(
                         f"✅ تسویه سازمانی تایید شد.\n• کاربر: {receipt.user_telegram_id}\n• تعداد ریست روتر: {reset_count}",
@@ -1106,11 +953,13 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                     return True
 
                 if receipt.renew_config_id:
-                    renew_config = db.query(WireGuardConfig).filter(
-                        WireGuardConfig.id == receipt.renew_config_id,
-                        WireGuardConfig.user_telegram_id == receipt.user_telegram_id,
-                    ).first()
-                    plan = db.query(Plan).filter(Plan.id == receipt.plan_id).first() if receipt.plan_id else None
+                    renew_config = await session.scalar(
+                        select(WireGuardConfig).where(
+                            WireGuardConfig.id == receipt.renew_config_id,
+                            WireGuardConfig.user_telegram_id == receipt.user_telegram_id,
+                        )
+                    )
+                    plan = await session.get(Plan, receipt.plan_id) if receipt.plan_id else None
                     if not renew_config or not plan:
                         await callback.message.answer(
                             "❌ کانفیگ/پلن تمدید یافت نشد.",
@@ -1125,18 +974,20 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                             pass
                         return True
 
-                    server = db.query(Server).filter(Server.id == renew_config.server_id).first() if renew_config.server_id else None
+                    server = await session.get(Server, renew_config.server_id) if renew_config.server_id else None
                     if not server:
-                        server = db.query(Server).filter(Server.id == receipt.server_id).first() if receipt.server_id else None
+                        server = await session.get(Server, receipt.server_id) if receipt.server_id else None
                     if not server:
-                        available = get_available_servers_for_plan(db, plan.id)
+                        available = await session.run_sync(get_available_servers_for_plan, plan.id)
                         server = available[0] if available else None
 
+                    # Don't idle in transaction while the router is called
+                    await session.commit()
                     reset_ok = False
                     if server:
                         try:
                             import wireguard
-                            reset_ok = wireguard.reset_wireguard_peer_traffic(
+                            reset_ok = await wireguard.reset_wireguard_peer_traffic(
                                 mikrotik_host=server.host,
                                 mikrotik_user=server.username,
                                 mikrotik_pass=server.password,
@@ -1160,7 +1011,9 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                     renew_config.low_traffic_alert_sent = False
                     renew_config.expiry_alert_sent = False
                     renew_config.threshold_alert_sent = False
-                    db.commit()
+                    await session.flush()
+                    await session.run_sync(refresh_effective_limits, config_ids=[renew_config.id])
+                    await session.commit()
 
                     try:
                         await callback.message.bot.send_message(
@@ -1188,17 +1041,18 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                 # Create WireGuard account
                 wg_created = False
                 client_ip = "N/A"
+                plan = await session.get(Plan, receipt.plan_id) if receipt.plan_id else None
 
                 try:
                     import wireguard
-                    plan = db.query(Plan).filter(Plan.id == receipt.plan_id).first()
-                    server = db.query(Server).filter(Server.id == receipt.server_id).first() if receipt.server_id else None
+                    server = await session.get(Server, receipt.server_id) if receipt.server_id else None
                     if not server and plan:
-                        available = get_available_servers_for_plan(db, plan.id)
+                        available = await session.run_sync(get_available_servers_for_plan, plan.id)
                         server = available[0] if available else None
                     if not server:
                         raise ValueError("سرور در دسترس برای این پلن وجود ندارد")
-                    wg_result = wireguard.create_wireguard_account(**build_wg_kwargs(server, receipt.user_telegram_id, plan, receipt.plan_name, plan.duration_days if plan else None))
+                    await session.commit()
+                    wg_result = await wireguard.create_wireguard_account(**build_wg_kwargs(server, receipt.user_telegram_id, plan, receipt.plan_name, plan.duration_days if plan else None))
 
                     if wg_result.get("success"):
                         wg_created = True
@@ -1210,37 +1064,28 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
                             config = wg_result.get("config", "")
 
                             # Send config as file
-                            if config:
-                                import tempfile
-                                import os
-                                tmp_path = None
-                                try:
-                                    with tempfile.NamedTemporaryFile(mode="w", suffix=".conf", delete=False, encoding="utf-8") as tmp:
-                                        tmp.write(config)
-                                        tmp_path = tmp.name
-
-                                    await callback.message.bot.send_document(
-                                        chat_id=user_tg_id,
-                                        document=FSInputFile(tmp_path, filename="wireguard.conf"),
-                                        caption="📄 فایل کانفیگ WireGuard"
-                                    )
-                                finally:
-                                    if tmp_path and os.path.exists(tmp_path):
-                                        os.remove(tmp_path)
+                            await send_wireguard_config_file(
+                                callback.message.bot,
+                                config,
+                                caption="📄 فایل کانفیگ WireGuard",
+                                chat_id=user_tg_id,
+                                config_id=wg_result.get("config_id"),
+                            )
 
-                            # Send QR code if available
-                            if wg_result.get("qr_code"):
+                            # Send QR code (rendered on first send)
+                            if config:
                                 try:
                                     await send_qr_code(
                                         callback.message.bot,
-                                        wg_result.get("qr_code"),
+                                        config,
                                         (
                                             "📷 QR Code WireGuard\n\n"
                                             "➕ این تصویر را در نرم‌افزار WireGuard اضافه کنید\n\n"
                                             f"🏷 نام کانفیگ: {wg_result.get('peer_comment', 'نامشخص')}\n"
                                             f"📦 پلن انتخابی: {receipt.plan_name}"
                                         ),
-                                        chat_id=user_tg_id
+                                        chat_id=user_tg_id,
+                                        config_id=wg_result.get("config_id"),
                                     )
                                 except Exception as e:
                                     print(f"Error sending QR code to user: {e}")
@@ -1253,7 +1098,6 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
 
                 # Send confirmation to admin
                 if wg_created:
-                    plan = db.query(Plan).filter(Plan.id == receipt.plan_id).first()
                     plan_info = f"• پلن: {receipt.plan_name}\n"
                     if plan:
                         plan_info += f"• مدت: {plan.duration_days} روز\n• حجم: {plan.traffic_gb} گیگ\n• قیمت: {plan.price:,} تومان\n"
@@ -1283,9 +1127,8 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
             else:
                 await callback.message.answer("❌ فیش پرداخت یافت نشد.", parse_mode="HTML")
         except Exception as e:
+            await session.rollback()
             await callback.message.answer(f"❌ خطا: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data.startswith("receipt_reject_"):
         if not is_admin(user_id):
@@ -1300,12 +1143,8 @@ async def handle_admin_callbacks(callback: CallbackQuery, bot, data: str, user_i
         await callback.message.answer("❌ لطفاً دلیل رد کردن فیش را بنویسید:", parse_mode="HTML")
 
     elif data == "back_to_main":
-        db = SessionLocal()
-        try:
-            user = get_user(db, str(user_id))
-            await callback.message.answer(WELCOME_MESSAGE, reply_markup=get_main_keyboard(user.is_admin if user else False), parse_mode="HTML")
-        finally:
-            db.close()
+        user = get_user(db, str(user_id))
+        await callback.message.answer(WELCOME_MESSAGE, reply_markup=get_main_keyboard(user.is_admin if user else False), parse_mode="HTML")
 
     elif data == "receipt_done":
         await callback.answer("این فیش قبلاً تایید شده است.", show_alert=True)
@@ -2,7 +2,7 @@ from aiogram.types import Message
 from ..common import *
 
 @dp.message(lambda message: is_admin(message.from_user.id))
-async def handle_admin_input(message: Message):
+async def handle_admin_input(message: Message, db: Session):
     user_id = message.from_user.id
     text = message.text.strip()
     
@@ -33,7 +33,6 @@ async def handle_admin_input(message: Message):
         if amount is None or amount < 0:
             await message.answer("❌ لطفاً عدد معتبر وارد کنید.", parse_mode="HTML")
             return
-        db = SessionLocal()
         try:
             user = db.query(User).filter(User.id == state["target_user_id"]).first()
             if not user:
@@ -46,7 +45,6 @@ async def handle_admin_input(message: Message):
             db.commit()
             await message.answer(f"✅ موجودی جدید کاربر: {user.wallet_balance} تومان", parse_mode="HTML")
         finally:
-            db.close()
             del admin_wallet_adjust_state[user_id]
         return
 
@@ -90,7 +88,6 @@ async def handle_admin_input(message: Message):
             if num is None or num <= 0:
                 await message.answer("❌ مقدار نامعتبر", parse_mode="HTML")
                 return
-            db = SessionLocal()
             try:
                 gift = GiftCode(
                     code=state["code"],
@@ -104,7 +101,6 @@ async def handle_admin_input(message: Message):
                 db.commit()
                 await message.answer("✅ کد تخفیف ساخته شد.", parse_mode="HTML")
             finally:
-                db.close()
                 del admin_discount_state[user_id]
             return
 
@@ -116,7 +112,6 @@ async def handle_admin_input(message: Message):
         source_message_id = state.get("message_id")
         reject_reason = text.strip()
         
-        db = SessionLocal()
         try:
             receipt = db.query(PaymentReceipt).filter(PaymentReceipt.id == receipt_id).first()
             if receipt:
@@ -158,7 +153,6 @@ async def handle_admin_input(message: Message):
         except Exception as e:
             await message.answer(f"❌ خطا: {str(e)}", parse_mode="HTML")
         finally:
-            db.close()
             del admin_receipt_reject_state[user_id]
         return
     
@@ -171,7 +165,6 @@ async def handle_admin_input(message: Message):
                 await message.answer("❌ نام نوع سرویس نامعتبر است.", parse_mode="HTML")
                 return
             code = slugify_service_code(name)
-            db = SessionLocal()
             try:
                 exists = db.query(ServiceType).filter(ServiceType.code == code).first()
                 if exists:
@@ -180,9 +173,9 @@ async def handle_admin_input(message: Message):
                 row = ServiceType(name=name, code=code, is_active=True)
                 db.add(row)
                 db.commit()
+                catalog_cache.invalidate()
                 await message.answer(f"✅ نوع سرویس {name} اضافه شد.", parse_mode="HTML")
             finally:
-                db.close()
                 admin_service_type_state.pop(user_id, None)
             return
 
@@ -259,7 +252,6 @@ async def handle_admin_input(message: Message):
                 await message.answer("❌ آیدی کانال نامعتبر است.", parse_mode="HTML")
                 return
 
-            db = SessionLocal()
             try:
                 rep = Representative(
                     name=state.get("name") or "نمایندگی",
@@ -286,7 +278,6 @@ async def handle_admin_input(message: Message):
                     parse_mode="HTML"
                 )
             finally:
-                db.close()
                 admin_representative_state.pop(user_id, None)
             return
 
@@ -301,7 +292,6 @@ async def handle_admin_input(message: Message):
             return
         
         if state.get("step") == "edit_field":
-            db = SessionLocal()
             try:
                 srv = db.query(Server).filter(Server.id == state.get("server_id")).first()
                 if not srv:
@@ -309,24 +299,28 @@ async def handle_admin_input(message: Message):
                     return
                 field = state.get("field")
                 value = text.strip()
+                previous_host, previous_port = srv.host, srv.api_port
                 if field == "wg_client_network_base":
                     parsed = parse_ip_range(value)
                     if not parsed:
                         await message.answer(
-                            "❌ فرمت رنج IP نامعتبر است.\n• CIDR: 192.168.30.0/24\n• رنج: 192.168.30.10-192.168.30.220\n• در حالت رنج فقط بازه 10 تا 250 مجاز است.",
+                            f"❌ فرمت رنج IP نامعتبر است.\n• CIDR: 192.168.30.0/24 یا 10.8.0.0/16 یا fd00::/64\n• رنج: 192.168.30.10-192.168.31.220\n• حداکثر {IP_POOL_MAX_SIZE} آدرس در هر رنج مجاز است.",
                             parse_mode="HTML",
                         )
                         return
                     srv.wg_client_network_base = parsed["base_ip"]
-                    srv.wg_ip_range_start = parsed.get("start_last", 1)
-                    srv.wg_ip_range_end = parsed.get("end_last", 254)
+                    srv.wg_ip_range_start = parsed["start_offset"]
+                    srv.wg_ip_range_end = parsed["end_offset"]
                     srv.wg_is_ip_range = parsed.get("is_range", False)
                 else:
                     if field in {"api_port", "wg_server_port", "capacity"}:
                         value = int(normalize_numbers(value) or 0)
                     setattr(srv, field, value)
                 db.commit()
-                statuses = evaluate_server_parameters(srv)
+                catalog_cache.invalidate()
+                if field in {"host", "api_port", "username", "password"}:
+                    await router_pool.invalidate(previous_host, previous_port)
+                statuses = await evaluate_server_parameters(srv)
                 await message.answer("✅ پارامتر سرور ویرایش شد.", parse_mode="HTML")
                 await message.answer(
                     "🖧 مدیریت سرور (برای تغییر، روی هر پارامتر بزنید):",
@@ -334,7 +328,6 @@ async def handle_admin_input(message: Message):
                     parse_mode="HTML"
                 )
             finally:
-                db.close()
                 admin_server_state.pop(user_id, None)
             return
 
@@ -347,7 +340,7 @@ async def handle_admin_input(message: Message):
                 if not parsed:
                     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
                     await message.answer(
-                        "❌ فرمت رنج IP نامعتبر است.\n• CIDR: 192.168.30.0/24\n• رنج: 192.168.30.10-192.168.30.220\n• در حالت رنج فقط بازه 10 تا 250 مجاز است.",
+                        f"❌ فرمت رنج IP نامعتبر است.\n• CIDR: 192.168.30.0/24 یا 10.8.0.0/16 یا fd00::/64\n• رنج: 192.168.30.10-192.168.31.220\n• حداکثر {IP_POOL_MAX_SIZE} آدرس در هر رنج مجاز است.",
                         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                             [InlineKeyboardButton(text="❌ انصراف", callback_data="server_add_cancel")]
                         ]),
@@ -356,8 +349,8 @@ async def handle_admin_input(message: Message):
                     return
                 # Store the parsed info
                 state["wg_client_network_base"] = parsed["base_ip"]
-                state["wg_ip_range_start"] = parsed.get("start_last", 1)
-                state["wg_ip_range_end"] = parsed.get("end_last", 254)
+                state["wg_ip_range_start"] = parsed["start_offset"]
+                state["wg_ip_range_end"] = parsed["end_offset"]
                 state["wg_is_ip_range"] = parsed.get("is_range", False)
             else:
                 state[current] = text.strip()
@@ -371,7 +364,6 @@ async def handle_admin_input(message: Message):
                 ]), parse_mode="HTML")
                 return
 
-            db = SessionLocal()
             try:
                 srv = Server(
                     name=state.get("name"),
@@ -394,6 +386,7 @@ async def handle_admin_input(message: Message):
                 )
                 db.add(srv)
                 db.commit()
+                catalog_cache.invalidate()
                 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
                 await message.answer(
                     f"✅ سرور {srv.name} ثبت شد.",
@@ -406,7 +399,6 @@ async def handle_admin_input(message: Message):
             except Exception as e:
                 await message.answer(f"❌ خطا در ثبت سرور: {e}", parse_mode="HTML")
             finally:
-                db.close()
                 admin_server_state.pop(user_id, None)
             return
 
@@ -451,19 +443,15 @@ async def handle_admin_input(message: Message):
                 state["traffic"] = traffic
                 state["step"] = "server"
 
-                db = SessionLocal()
-                try:
-                    wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
-                    if not wireguard_type:
-                        await message.answer("❌ نوع سرویس WireGuard در دیتابیس تعریف نشده است.", parse_mode="HTML")
-                        return
-                    servers = db.query(Server).filter(Server.service_type_id == wireguard_type.id, Server.is_active == True).all()
-                    if not servers:
-                        await message.answer("❌ هیچ سرور فعالی برای WireGuard ثبت نشده است.", parse_mode="HTML")
-                        return
-                    await message.answer("سرور را برای ساخت اکانت انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(servers, "create_acc_custom_server_"), parse_mode="HTML")
-                finally:
-                    db.close()
+                wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
+                if not wireguard_type:
+                    await message.answer("❌ نوع سرویس WireGuard در دیتابیس تعریف نشده است.", parse_mode="HTML")
+                    return
+                servers = db.query(Server).filter(Server.service_type_id == wireguard_type.id, Server.is_active == True).all()
+                if not servers:
+                    await message.answer("❌ هیچ سرور فعالی برای WireGuard ثبت نشده است.", parse_mode="HTML")
+                    return
+                await message.answer("سرور را برای ساخت اکانت انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(servers, "create_acc_custom_server_"), parse_mode="HTML")
             except ValueError:
                 await message.answer("❌ لطفاً عدد معتبر وارد کنید.", parse_mode="HTML")
                 return
@@ -478,7 +466,6 @@ async def handle_admin_input(message: Message):
         if not value_text.isdigit() or int(value_text) <= 0:
             await message.answer("❌ لطفاً مبلغ معتبر وارد کنید.", parse_mode="HTML")
             return
-        db = SessionLocal()
         try:
             user_obj = db.query(User).filter(User.id == target_user_id).first()
             if not user_obj or not user_obj.is_organization_customer:
@@ -490,7 +477,6 @@ async def handle_admin_input(message: Message):
             msg, keyboard = get_admin_user_manage_view(db, user_obj, show_finance_panel=True)
             await message.answer(msg, reply_markup=keyboard, parse_mode="HTML")
         finally:
-            db.close()
             admin_plan_state.pop(user_id, None)
         return
 
@@ -498,7 +484,6 @@ async def handle_admin_input(message: Message):
         state = admin_plan_state[user_id]
         field = state.get("field")
         config_id = state.get("config_id")
-        db = SessionLocal()
         try:
             cfg = db.query(WireGuardConfig).filter(WireGuardConfig.id == config_id).first()
             if not cfg:
@@ -518,13 +503,14 @@ async def handle_admin_input(message: Message):
             cfg.threshold_alert_sent = False
             cfg.low_traffic_alert_sent = False
             cfg.expiry_alert_sent = False
+            db.flush()
+            refresh_effective_limits(db, config_ids=[cfg.id])
             db.commit()
             await message.answer("✅ مقدار کانفیگ بروزرسانی شد.", parse_mode="HTML")
         except ValueError:
             await message.answer("❌ مقدار وارد شده معتبر نیست.", parse_mode="HTML")
             return
         finally:
-            db.close()
             admin_plan_state.pop(user_id, None)
         return
 
@@ -554,7 +540,6 @@ async def handle_admin_input(message: Message):
                     return
 
                 days = state.get("days", 1)
-                db = SessionLocal()
                 try:
                     test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
                     if test_plan:
@@ -575,7 +560,10 @@ async def handle_admin_input(message: Message):
                         )
                         db.add(test_plan)
                         action_text = "ایجاد شد"
+                    db.flush()
+                    refresh_effective_limits(db, plan_ids=[test_plan.id])
                     db.commit()
+                    catalog_cache.invalidate()
                     await message.answer(f"✅ اکانت تست با موفقیت {action_text}.", parse_mode="HTML")
                     await message.answer(
                         "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
@@ -588,7 +576,6 @@ async def handle_admin_input(message: Message):
                         parse_mode="HTML",
                     )
                 finally:
-                    db.close()
                     admin_plan_state.pop(user_id, None)
                 return
 
@@ -602,7 +589,6 @@ async def handle_admin_input(message: Message):
                         await message.answer("❌ لطفاً تعداد روز را به‌صورت عدد صحیح بزرگ‌تر از صفر وارد کنید.", parse_mode="HTML")
                     return
 
-                db = SessionLocal()
                 try:
                     test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
                     if not test_plan:
@@ -614,7 +600,10 @@ async def handle_admin_input(message: Message):
                         test_plan.traffic_gb = float(value)
                     test_plan.price = 0
                     test_plan.description = "پلن تست یک‌بار مصرف"
+                    db.flush()
+                    refresh_effective_limits(db, plan_ids=[test_plan.id])
                     db.commit()
+                    catalog_cache.invalidate()
                     await message.answer("✅ مقدار جدید ذخیره شد.", parse_mode="HTML")
                     await message.answer(
                         "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
@@ -627,7 +616,6 @@ async def handle_admin_input(message: Message):
                         parse_mode="HTML",
                     )
                 finally:
-                    db.close()
                     admin_plan_state.pop(user_id, None)
                 return
 
@@ -659,19 +647,15 @@ async def handle_admin_input(message: Message):
             else:
                 state.pop("step", None)
                 if state.get("action") == "create" and state.get("plan_id") == "new":
-                    db = SessionLocal()
-                    try:
-                        service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
-                        if not service_types:
-                            await message.answer("❌ هیچ نوع سرویس فعالی یافت نشد. ابتدا نوع سرویس اضافه کنید.", parse_mode="HTML")
-                            return
-                        await message.answer(
-                            "✅ اطلاعات پایه پلن ثبت شد. حالا نوع سرویس را انتخاب کنید:",
-                            reply_markup=get_service_type_picker_keyboard(service_types, "plan_pick_service_new_"),
-                            parse_mode="HTML"
-                        )
-                    finally:
-                        db.close()
+                    service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
+                    if not service_types:
+                        await message.answer("❌ هیچ نوع سرویس فعالی یافت نشد. ابتدا نوع سرویس اضافه کنید.", parse_mode="HTML")
+                        return
+                    await message.answer(
+                        "✅ اطلاعات پایه پلن ثبت شد. حالا نوع سرویس را انتخاب کنید:",
+                        reply_markup=get_service_type_picker_keyboard(service_types, "plan_pick_service_new_"),
+                        parse_mode="HTML"
+                    )
                 else:
                     await message.answer(
                         get_plan_creation_summary(state["data"]),
@@ -731,7 +715,6 @@ async def handle_admin_input(message: Message):
     if user_id in admin_user_search_state:
         query = normalize_numbers(text.strip())
         mode = admin_user_search_state[user_id].get("mode", "user")
-        db = SessionLocal()
         try:
             if mode == "config":
                 like_q = f"%{query}%"
@@ -751,18 +734,13 @@ async def handle_admin_input(message: Message):
                 else:
                     await message.answer("❌ کاربری یافت نشد.", parse_mode="HTML")
         finally:
-            db.close()
             del admin_user_search_state[user_id]
         return
 
-    db = SessionLocal()
-    try:
-        user = get_user(db, text) or db.query(User).filter(User.username == text).first()
-        if user:
-            joined_date = format_jalali_date(user.joined_at) if user.joined_at else "نامشخص"
-            msg = f"👤 اطلاعات کاربر:\n\nشناسه: {user.telegram_id}\nنام: {user.first_name}\nنام کاربری: @{user.username}\nموجودی: {user.wallet_balance} تومان\nتاریخ عضویت: {joined_date}\nوضعیت: {'✅ فعال' if user.is_member else '❌ غیرفعال'}\nادمین: {'✅ بله' if user.is_admin else '❌ خیر'}"
-            await message.answer(msg, parse_mode="HTML")
-        else:
-            await message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
-    finally:
-        db.close()
+    user = get_user(db, text) or db.query(User).filter(User.username == text).first()
+    if user:
+        joined_date = format_jalali_date(user.joined_at) if user.joined_at else "نامشخص"
+        msg = f"👤 اطلاعات کاربر:\n\nشناسه: {user.telegram_id}\nنام: {user.first_name}\nنام کاربری: @{user.username}\nموجودی: {user.wallet_balance} تومان\nتاریخ عضویت: {joined_date}\nوضعیت: {'✅ فعال' if user.is_member else '❌ غیرفعال'}\nادمین: {'✅ بله' if user.is_admin else '❌ خیر'}"
+        await message.answer(msg, parse_mode="HTML")
+    else:
+        await message.answer("❌ کاربر یافت نشد.", parse_mode="HTML")
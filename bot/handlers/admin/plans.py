@@ -1,79 +1,58 @@
 from ..common import *
 
-async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: str, user_id: int) -> bool:
+async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: str, user_id: int, db: Session) -> bool:
     if data == "admin_plans":
         admin_server_state.pop(user_id, None)
-        db = SessionLocal()
-        try:
-            plans = db.query(Plan).all()
-            await callback.message.answer(PLANS_MESSAGE, reply_markup=get_plans_keyboard(plans), parse_mode="HTML")
-        finally:
-            db.close()
+        await callback.message.answer(PLANS_MESSAGE, reply_markup=catalog_cache.get().plans_keyboard, parse_mode="HTML")
 
     elif data == "admin_receipts":
-        db = SessionLocal()
-        try:
-            pending_receipts = db.query(PaymentReceipt).filter(PaymentReceipt.status == "pending").all()
-            if pending_receipts:
-                for receipt in pending_receipts:
-                    msg = f"💳 فیش پرداخت\n\n• پلن: {receipt.plan_name}\n• مبلغ: {receipt.amount} تومان\n• کاربر: {receipt.user_telegram_id}\n• تاریخ: {receipt.created_at}"
-                    await callback.message.answer(msg, reply_markup=get_receipt_action_keyboard(receipt.id), parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ فیش پرداخت در انتظار تاییدی وجود ندارد.", parse_mode="HTML")
-        finally:
-            db.close()
+        pending_receipts = db.query(PaymentReceipt).filter(PaymentReceipt.status == "pending").all()
+        if pending_receipts:
+            for receipt in pending_receipts:
+                msg = f"💳 فیش پرداخت\n\n• پلن: {receipt.plan_name}\n• مبلغ: {receipt.amount} تومان\n• کاربر: {receipt.user_telegram_id}\n• تاریخ: {receipt.created_at}"
+                await callback.message.answer(msg, reply_markup=get_receipt_action_keyboard(receipt.id), parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ فیش پرداخت در انتظار تاییدی وجود ندارد.", parse_mode="HTML")
 
     # === CREATE ACCOUNT HANDLERS ===
     elif data == "admin_create_account":
-        db = SessionLocal()
-        try:
-            plans = db.query(Plan).filter(Plan.is_active == True).all()
-            if plans:
-                await callback.message.answer("🔗 ساخت اکانت وایرگارد\n\nیکی از پلن‌های زیر را انتخاب کنید و یا پلن دلخواه بسازید:", reply_markup=get_create_account_keyboard(plans), parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ پلن فعالی وجود ندارد. می‌توانید پلن دلخواه بسازید.", reply_markup=get_create_account_keyboard([]), parse_mode="HTML")
-        finally:
-            db.close()
+        plans = db.query(Plan).filter(Plan.is_active == True).all()
+        if plans:
+            await callback.message.answer("🔗 ساخت اکانت وایرگارد\n\nیکی از پلن‌های زیر را انتخاب کنید و یا پلن دلخواه بسازید:", reply_markup=get_create_account_keyboard(plans), parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ پلن فعالی وجود ندارد. می‌توانید پلن دلخواه بسازید.", reply_markup=get_create_account_keyboard([]), parse_mode="HTML")
 
     elif data.startswith("create_acc_plan_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
-            if not plan:
-                await callback.message.answer("❌ پلن یافت نشد یا غیرفعال است.", parse_mode="HTML")
-                return
-            available_servers = get_available_servers_for_plan(db, plan.id)
-            if not available_servers:
-                await callback.message.answer("❌ ظرفیت سرورهای این پلن تکمیل است.", parse_mode="HTML")
-                return
-            await callback.message.answer("سرور را برای ساخت اکانت انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(available_servers, f"create_acc_server_{plan.id}_"), parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
+        if not plan:
+            await callback.message.answer("❌ پلن یافت نشد یا غیرفعال است.", parse_mode="HTML")
+            return
+        available_servers = get_available_servers_for_plan(db, plan.id)
+        if not available_servers:
+            await callback.message.answer("❌ ظرفیت سرورهای این پلن تکمیل است.", parse_mode="HTML")
+            return
+        await callback.message.answer("سرور را برای ساخت اکانت انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(available_servers, f"create_acc_server_{plan.id}_"), parse_mode="HTML")
 
     elif data.startswith("create_acc_server_"):
         parts = data.split("_")
         plan_id = int(parts[3])
         server_id = int(parts[4])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
-            server = db.query(Server).filter(Server.id == server_id, Server.is_active == True).first()
-            if not plan or not server:
-                await callback.message.answer("❌ پلن/سرور نامعتبر است.", parse_mode="HTML")
-                return
-            import wireguard
-            wg_result = wireguard.create_wireguard_account(**build_wg_kwargs(server, str(user_id), plan, plan.name, plan.duration_days, traffic_limit_gb=plan.traffic_gb))
-            if wg_result.get("success"):
-                await callback.message.answer(f"✅ اکانت روی سرور {server.name} ایجاد شد.", parse_mode="HTML")
-                if wg_result.get("config"):
-                    await send_wireguard_config_file(callback.message, wg_result.get("config"), caption="📄 فایل کانفیگ WireGuard")
-                if wg_result.get("qr_code"):
-                    await send_qr_code(callback.message, wg_result.get("qr_code"), f"QR Code - {plan.name}")
-            else:
-                await callback.message.answer(f"❌ خطا در ایجاد اکانت: {wg_result.get('error', 'خطای نامشخص')}", parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id, Plan.is_active == True).first()
+        server = db.query(Server).filter(Server.id == server_id, Server.is_active == True).first()
+        if not plan or not server:
+            await callback.message.answer("❌ پلن/سرور نامعتبر است.", parse_mode="HTML")
+            return
+        import wireguard
+        # Don't idle in transaction while the router is provisioning
+        db.commit()
+        wg_result = await wireguard.create_wireguard_account(**build_wg_kwargs(server, str(user_id), plan, plan.name, plan.duration_days, traffic_limit_gb=plan.traffic_gb))
+        if wg_result.get("success"):
+            await callback.message.answer(f"✅ اکانت روی سرور {server.name} ایجاد شد.", parse_mode="HTML")
+            await send_wireguard_config_file(callback.message, wg_result.get("config"), caption="📄 فایل کانفیگ WireGuard", config_id=wg_result.get("config_id"))
+            await send_qr_code(callback.message, wg_result.get("config"), f"QR Code - {plan.name}", config_id=wg_result.get("config_id"))
+        else:
+            await callback.message.answer(f"❌ خطا در ایجاد اکانت: {wg_result.get('error', 'خطای نامشخص')}", parse_mode="HTML")
 
 
     elif data.startswith("create_acc_custom_server_"):
@@ -86,7 +65,6 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         if not state or state.get("step") != "server":
             await callback.message.answer("❌ ابتدا فرایند ساخت پلن دلخواه را تکمیل کنید.", parse_mode="HTML")
             return
-        db = SessionLocal()
         try:
             server = db.query(Server).filter(Server.id == server_id, Server.is_active == True).first()
             if not server:
@@ -97,7 +75,8 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
             traffic = float(state.get("traffic") or 0)
             owner_tg = str(user_id)
             import wireguard
-            wg_result = wireguard.create_wireguard_account(
+            db.commit()
+            wg_result = await wireguard.create_wireguard_account(
                 **build_wg_kwargs(
                     server,
                     owner_tg,
@@ -110,14 +89,11 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
             )
             if wg_result.get("success"):
                 await callback.message.answer(f"✅ اکانت دلخواه روی سرور {server.name} ایجاد شد.", parse_mode="HTML")
-                if wg_result.get("config"):
-                    await send_wireguard_config_file(callback.message, wg_result.get("config"), caption="📄 فایل کانفیگ WireGuard")
-                if wg_result.get("qr_code"):
-                    await send_qr_code(callback.message, wg_result.get("qr_code"), f"QR Code - {account_name}")
+                await send_wireguard_config_file(callback.message, wg_result.get("config"), caption="📄 فایل کانفیگ WireGuard", config_id=wg_result.get("config_id"))
+                await send_qr_code(callback.message, wg_result.get("config"), f"QR Code - {account_name}", config_id=wg_result.get("config_id"))
             else:
                 await callback.message.answer(f"❌ خطا در ایجاد اکانت: {wg_result.get('error', 'خطای نامشخص')}", parse_mode="HTML")
         finally:
-            db.close()
             if source_state == "admin":
                 admin_create_account_state.pop(user_id, None)
             else:
@@ -133,39 +109,31 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
 
     # === PLAN CALLBACKS ===
     elif data == "plan_list":
-        db = SessionLocal()
-        try:
-            plans = db.query(Plan).all()
-            if plans:
-                await callback.message.answer("📋 لیست پلن‌ها:", reply_markup=get_plan_list_keyboard(plans), parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ پلنی یافت نشد.\n\nبرای ایجاد پلن جدید، دکمه «➕ پلن جدید» را بزنید.", parse_mode="HTML")
-        finally:
-            db.close()
+        plans = db.query(Plan).all()
+        if plans:
+            await callback.message.answer("📋 لیست پلن‌ها:", reply_markup=get_plan_list_keyboard(plans), parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ پلنی یافت نشد.\n\nبرای ایجاد پلن جدید، دکمه «➕ پلن جدید» را بزنید.", parse_mode="HTML")
 
     elif data == "plan_test_account":
-        db = SessionLocal()
-        try:
-            test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
-            if test_plan:
-                await callback.message.answer(
-                    "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
-                    reply_markup=get_test_account_keyboard(
-                        days_text=str(test_plan.duration_days),
-                        traffic_text=format_gb_value(test_plan.traffic_gb),
-                        is_active=bool(test_plan.is_active),
-                        has_plan=True,
-                    ),
-                    parse_mode="HTML",
-                )
-            else:
-                await callback.message.answer(
-                    "🧪 اکانت تست هنوز تعریف نشده است.",
-                    reply_markup=get_test_account_keyboard(has_plan=False),
-                    parse_mode="HTML",
-                )
-        finally:
-            db.close()
+        test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
+        if test_plan:
+            await callback.message.answer(
+                "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
+                reply_markup=get_test_account_keyboard(
+                    days_text=str(test_plan.duration_days),
+                    traffic_text=format_gb_value(test_plan.traffic_gb),
+                    is_active=bool(test_plan.is_active),
+                    has_plan=True,
+                ),
+                parse_mode="HTML",
+            )
+        else:
+            await callback.message.answer(
+                "🧪 اکانت تست هنوز تعریف نشده است.",
+                reply_markup=get_test_account_keyboard(has_plan=False),
+                parse_mode="HTML",
+            )
 
     elif data == "test_account_ro":
         await callback.answer("این گزینه فقط جهت نمایش است.", show_alert=False)
@@ -183,27 +151,24 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         await callback.message.answer("🌐 مقدار جدید ترافیک اکانت تست (گیگ) را وارد کنید:\nمثال: <code>1</code> یا <code>0.5</code>", parse_mode="HTML")
 
     elif data == "plan_test_toggle":
-        db = SessionLocal()
-        try:
-            test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
-            if not test_plan:
-                await callback.answer("اکانت تست هنوز ایجاد نشده است.", show_alert=True)
-                return
-            test_plan.is_active = not bool(test_plan.is_active)
-            db.commit()
-            await callback.answer("وضعیت اکانت تست تغییر کرد.", show_alert=False)
-            await callback.message.answer(
-                "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
-                reply_markup=get_test_account_keyboard(
-                    days_text=str(test_plan.duration_days),
-                    traffic_text=format_gb_value(test_plan.traffic_gb),
-                    is_active=bool(test_plan.is_active),
-                    has_plan=True,
-                ),
-                parse_mode="HTML",
-            )
-        finally:
-            db.close()
+        test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
+        if not test_plan:
+            await callback.answer("اکانت تست هنوز ایجاد نشده است.", show_alert=True)
+            return
+        test_plan.is_active = not bool(test_plan.is_active)
+        db.commit()
+        catalog_cache.invalidate()
+        await callback.answer("وضعیت اکانت تست تغییر کرد.", show_alert=False)
+        await callback.message.answer(
+            "🧪 مدیریت اکانت تست\n\nروی هر پارامتر بزنید تا مقدار جدید را وارد کنید.",
+            reply_markup=get_test_account_keyboard(
+                days_text=str(test_plan.duration_days),
+                traffic_text=format_gb_value(test_plan.traffic_gb),
+                is_active=bool(test_plan.is_active),
+                has_plan=True,
+            ),
+            parse_mode="HTML",
+        )
 
     elif data == "plan_create":
         admin_server_state.pop(user_id, None)
@@ -221,73 +186,65 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
 
     elif data.startswith("plan_view_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id).first()
-            if plan:
-                selected_server_ids = [m.server_id for m in db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id).all()]
-                admin_plan_state[user_id] = {
-                    "action": "edit",
-                    "plan_id": plan_id,
-                    "data": {
-                        "name": plan.name,
-                        "days": str(plan.duration_days),
-                        "traffic": str(plan.traffic_gb),
-                        "price": str(plan.price),
-                        "description": plan.description or "",
-                        "service_type_id": plan.service_type_id,
-                        "server_ids": selected_server_ids,
-                    },
-                }
-                service_type_name = db.query(ServiceType).filter(ServiceType.id == plan.service_type_id).first()
-                service_text = service_type_name.name if service_type_name else "-"
-                mapped_servers = db.query(Server).join(PlanServerMap, PlanServerMap.server_id == Server.id).filter(PlanServerMap.plan_id == plan.id).all()
-                has_server_mapping = bool(mapped_servers)
-                server_text = mapped_servers[0].name if has_server_mapping else "بدون سرور"
-                await callback.message.answer(
-                    "📦 مدیریت پلن\n\nروی هر پارامتر بزنید تا در صورت نیاز مقدار جدید وارد کنید.",
-                    reply_markup=get_plan_action_keyboard(
-                        plan_id=plan.id,
-                        plan_name=plan.name,
-                        days_text=str(plan.duration_days),
-                        traffic_text=format_gb_value(plan.traffic_gb),
-                        price_text=f"{plan.price:,}",
-                        description_text=(plan.description or "ندارد")[:40],
-                        is_active=bool(plan.is_active),
-                        service_text=service_text,
-                        server_text=server_text,
-                        has_server_mapping=has_server_mapping,
-                    ),
-                    parse_mode="HTML",
-                )
-            else:
-                await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        if plan:
+            selected_server_ids = [m.server_id for m in db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id).all()]
+            admin_plan_state[user_id] = {
+                "action": "edit",
+                "plan_id": plan_id,
+                "data": {
+                    "name": plan.name,
+                    "days": str(plan.duration_days),
+                    "traffic": str(plan.traffic_gb),
+                    "price": str(plan.price),
+                    "description": plan.description or "",
+                    "service_type_id": plan.service_type_id,
+                    "server_ids": selected_server_ids,
+                },
+            }
+            service_type_name = db.query(ServiceType).filter(ServiceType.id == plan.service_type_id).first()
+            service_text = service_type_name.name if service_type_name else "-"
+            mapped_servers = db.query(Server).join(PlanServerMap, PlanServerMap.server_id == Server.id).filter(PlanServerMap.plan_id == plan.id).all()
+            has_server_mapping = bool(mapped_servers)
+            server_text = mapped_servers[0].name if has_server_mapping else "بدون سرور"
+            await callback.message.answer(
+                "📦 مدیریت پلن\n\nروی هر پارامتر بزنید تا در صورت نیاز مقدار جدید وارد کنید.",
+                reply_markup=get_plan_action_keyboard(
+                    plan_id=plan.id,
+                    plan_name=plan.name,
+                    days_text=str(plan.duration_days),
+                    traffic_text=format_gb_value(plan.traffic_gb),
+                    price_text=f"{plan.price:,}",
+                    description_text=(plan.description or "ندارد")[:40],
+                    is_active=bool(plan.is_active),
+                    service_text=service_text,
+                    server_text=server_text,
+                    has_server_mapping=has_server_mapping,
+                ),
+                parse_mode="HTML",
+            )
+        else:
+            await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
 
     elif data.startswith("plan_edit_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            plan = db.query(Plan).filter(Plan.id == plan_id).first()
-            if plan:
-                selected_server_ids = [m.server_id for m in db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id).all()]
-                admin_plan_state[user_id] = {"action": "edit", "plan_id": plan_id, "data": {"name": plan.name, "days": str(plan.duration_days), "traffic": str(plan.traffic_gb), "price": str(plan.price), "description": plan.description or "", "service_type_id": plan.service_type_id, "server_ids": selected_server_ids}}
-                msg = f"✏️ ویرایش پلن: {plan.name}\n\nمی‌توانید هر فیلدی را که می‌خواهید تغییر دهید:"
-                await callback.message.answer(msg, reply_markup=get_plan_edit_keyboard(plan_id), parse_mode="HTML")
-            else:
-                await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
-        finally:
-            db.close()
+        plan = db.query(Plan).filter(Plan.id == plan_id).first()
+        if plan:
+            selected_server_ids = [m.server_id for m in db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id).all()]
+            admin_plan_state[user_id] = {"action": "edit", "plan_id": plan_id, "data": {"name": plan.name, "days": str(plan.duration_days), "traffic": str(plan.traffic_gb), "price": str(plan.price), "description": plan.description or "", "service_type_id": plan.service_type_id, "server_ids": selected_server_ids}}
+            msg = f"✏️ ویرایش پلن: {plan.name}\n\nمی‌توانید هر فیلدی را که می‌خواهید تغییر دهید:"
+            await callback.message.answer(msg, reply_markup=get_plan_edit_keyboard(plan_id), parse_mode="HTML")
+        else:
+            await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
 
     elif data.startswith("plan_toggle_") and not data.startswith("plan_toggle_server_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
         try:
             plan = db.query(Plan).filter(Plan.id == plan_id).first()
             if plan:
                 plan.is_active = not plan.is_active
                 db.commit()
+                catalog_cache.invalidate()
                 status_text = "فعال" if plan.is_active else "غیرفعال"
                 await callback.message.answer(f"✅ پلن «{plan.name}» {status_text} شد.", parse_mode="HTML")
                 service_type_name = db.query(ServiceType).filter(ServiceType.id == plan.service_type_id).first()
@@ -315,28 +272,23 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
                 await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
         except Exception as e:
             await callback.message.answer(f"❌ خطا: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data.startswith("plan_delete_"):
         plan_id = int(data.split("_")[-1])
-        db = SessionLocal()
         try:
             plan = db.query(Plan).filter(Plan.id == plan_id).first()
             if plan:
                 plan_name = plan.name
                 db.delete(plan)
                 db.commit()
+                catalog_cache.invalidate()
                 await callback.message.answer(f"✅ پلن «{plan_name}» با موفقیت حذف شد.", parse_mode="HTML")
                 # Show the plans list with remaining plans
-                all_plans = db.query(Plan).all()
-                await callback.message.answer(PLANS_MESSAGE, reply_markup=get_plans_keyboard(all_plans), parse_mode="HTML")
+                await callback.message.answer(PLANS_MESSAGE, reply_markup=catalog_cache.get().plans_keyboard, parse_mode="HTML")
             else:
                 await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
         except Exception as e:
             await callback.message.answer(f"❌ خطا در حذف: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data.startswith("plan_set_name_"):
         plan_id = data.split("_")[-1]
@@ -375,12 +327,8 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
 
     elif data.startswith("plan_set_service_"):
         plan_id = data.split("_")[-1]
-        db = SessionLocal()
-        try:
-            service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
-            await callback.message.answer("نوع سرویس پلن را انتخاب کنید:", reply_markup=get_service_type_picker_keyboard(service_types, f"plan_pick_service_{plan_id}_"), parse_mode="HTML")
-        finally:
-            db.close()
+        service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
+        await callback.message.answer("نوع سرویس پلن را انتخاب کنید:", reply_markup=get_service_type_picker_keyboard(service_types, f"plan_pick_service_{plan_id}_"), parse_mode="HTML")
 
     elif data.startswith("plan_pick_service_"):
         parts = data.split("_")
@@ -393,22 +341,18 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         admin_plan_state[user_id] = current_state
         await callback.message.answer("✅ نوع سرویس ثبت شد.", parse_mode="HTML")
 
-        db = SessionLocal()
-        try:
-            servers = db.query(Server).filter(Server.service_type_id == service_type_id, Server.is_active == True).all()
-            if not servers:
-                await callback.message.answer(
-                    "❌ سروری اضافه نشده است. ابتدا سرور را اضافه کنید و سپس پلن را ایجاد کنید.",
-                    parse_mode="HTML"
-                )
-                return
+        servers = db.query(Server).filter(Server.service_type_id == service_type_id, Server.is_active == True).all()
+        if not servers:
             await callback.message.answer(
-                "سرور/سرورهای پلن را انتخاب کنید. با انتخاب سرور، پلن فوراً ذخیره می‌شود.",
-                reply_markup=get_plan_servers_picker_keyboard(servers, plan_id),
+                "❌ سروری اضافه نشده است. ابتدا سرور را اضافه کنید و سپس پلن را ایجاد کنید.",
                 parse_mode="HTML"
             )
-        finally:
-            db.close()
+            return
+        await callback.message.answer(
+            "سرور/سرورهای پلن را انتخاب کنید. با انتخاب سرور، پلن فوراً ذخیره می‌شود.",
+            reply_markup=get_plan_servers_picker_keyboard(servers, plan_id),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("plan_set_servers_"):
         plan_id = data.split("_")[-1]
@@ -417,18 +361,14 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         if not service_type_id:
             await callback.message.answer("❌ ابتدا نوع سرویس را انتخاب کنید.", parse_mode="HTML")
             return
-        db = SessionLocal()
-        try:
-            servers = db.query(Server).filter(Server.service_type_id == service_type_id, Server.is_active == True).all()
-            if not servers:
-                await callback.message.answer(
-                    "❌ سروری اضافه نشده است. ابتدا سرور را اضافه کنید و سپس پلن را ایجاد کنید.",
-                    parse_mode="HTML"
-                )
-                return
-            await callback.message.answer("سرور/سرورهای پلن را انتخاب کنید. با انتخاب سرور، پلن فوراً ذخیره می‌شود.", reply_markup=get_plan_servers_picker_keyboard(servers, plan_id), parse_mode="HTML")
-        finally:
-            db.close()
+        servers = db.query(Server).filter(Server.service_type_id == service_type_id, Server.is_active == True).all()
+        if not servers:
+            await callback.message.answer(
+                "❌ سروری اضافه نشده است. ابتدا سرور را اضافه کنید و سپس پلن را ایجاد کنید.",
+                parse_mode="HTML"
+            )
+            return
+        await callback.message.answer("سرور/سرورهای پلن را انتخاب کنید. با انتخاب سرور، پلن فوراً ذخیره می‌شود.", reply_markup=get_plan_servers_picker_keyboard(servers, plan_id), parse_mode="HTML")
 
     elif data.startswith("plan_toggle_server_"):
         _, _, _, plan_id_token, server_id_s = data.split("_", 4)
@@ -445,7 +385,6 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         traffic = normalize_numbers(plan_data.get("traffic", "0"))
         price = normalize_numbers(plan_data.get("price", "0"))
 
-        db = SessionLocal()
         try:
             plan_id = state.get("plan_id")
             if plan_id_token == "new" or str(plan_id) == "new":
@@ -460,6 +399,7 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
                 )
                 db.add(plan)
                 db.commit()
+                catalog_cache.invalidate()
                 state["plan_id"] = plan.id
                 state["action"] = "edit"
                 admin_plan_state[user_id] = state
@@ -474,7 +414,10 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
                 plan.price = int(price)
                 plan.description = plan_data.get("description", "")
                 plan.service_type_id = int(plan_data.get("service_type_id") or 0) or plan.service_type_id
+                db.flush()
+                refresh_effective_limits(db, plan_ids=[plan.id])
                 db.commit()
+                catalog_cache.invalidate()
 
             existing = db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id, PlanServerMap.server_id == server_id).first()
             if existing:
@@ -483,6 +426,7 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
 
             db.add(PlanServerMap(plan_id=plan.id, server_id=server_id))
             db.commit()
+            catalog_cache.invalidate()
             await callback.message.answer(
                 f"✅ پلن «{plan.name}» با موفقیت اضافه شد.",
                 reply_markup=get_plan_created_actions_keyboard(str(plan.id)),
@@ -490,24 +434,18 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
             )
         except Exception as e:
             await callback.message.answer(f"❌ خطا در ذخیره پلن: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data.startswith("plan_back_service_select_"):
         plan_id = data.split("_")[-1]
-        db = SessionLocal()
-        try:
-            service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
-            if not service_types:
-                await callback.message.answer("❌ هیچ نوع سرویس فعالی یافت نشد.", parse_mode="HTML")
-                return
-            await callback.message.answer(
-                "نوع سرویس پلن را انتخاب کنید:",
-                reply_markup=get_service_type_picker_keyboard(service_types, f"plan_pick_service_{plan_id}_"),
-                parse_mode="HTML",
-            )
-        finally:
-            db.close()
+        service_types = db.query(ServiceType).filter(ServiceType.is_active == True).all()
+        if not service_types:
+            await callback.message.answer("❌ هیچ نوع سرویس فعالی یافت نشد.", parse_mode="HTML")
+            return
+        await callback.message.answer(
+            "نوع سرویس پلن را انتخاب کنید:",
+            reply_markup=get_service_type_picker_keyboard(service_types, f"plan_pick_service_{plan_id}_"),
+            parse_mode="HTML",
+        )
 
     elif data == "plan_save_new":
         state = admin_plan_state.get(user_id, {})
@@ -522,7 +460,6 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         days = normalize_numbers(plan_data.get("days", "0"))
         traffic = normalize_numbers(plan_data.get("traffic", "0"))
         price = normalize_numbers(plan_data.get("price", "0"))
-        db = SessionLocal()
         try:
             plan = Plan(name=plan_data["name"], duration_days=int(days), traffic_gb=float(traffic),
                        price=int(price), description=plan_data.get("description", ""), is_active=True,
@@ -533,16 +470,14 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
             for sid in selected_servers:
                 db.add(PlanServerMap(plan_id=plan.id, server_id=int(sid)))
             db.commit()
+            catalog_cache.invalidate()
             if user_id in admin_plan_state:
                 del admin_plan_state[user_id]
             await callback.message.answer(f"✅ پلن «{plan.name}» با موفقیت ایجاد شد!", parse_mode="HTML")
             # Show the plans list with all plans
-            all_plans = db.query(Plan).all()
-            await callback.message.answer(PLANS_MESSAGE, reply_markup=get_plans_keyboard(all_plans), parse_mode="HTML")
+            await callback.message.answer(PLANS_MESSAGE, reply_markup=catalog_cache.get().plans_keyboard, parse_mode="HTML")
         except Exception as e:
             await callback.message.answer(f"❌ خطا در ذخیره: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
 
     elif data.startswith("plan_save_") and data != "plan_save_new":
         plan_id = int(data.split("_")[-1])
@@ -558,7 +493,6 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
         days = normalize_numbers(plan_data.get("days", "0"))
         traffic = normalize_numbers(plan_data.get("traffic", "0"))
         price = normalize_numbers(plan_data.get("price", "0"))
-        db = SessionLocal()
         try:
             plan = db.query(Plan).filter(Plan.id == plan_id).first()
             if plan:
@@ -571,19 +505,19 @@ async def handle_plan_management_callbacks(callback: CallbackQuery, bot, data: s
                 db.query(PlanServerMap).filter(PlanServerMap.plan_id == plan.id).delete()
                 for sid in plan_data.get("server_ids", []):
                     db.add(PlanServerMap(plan_id=plan.id, server_id=int(sid)))
+                db.flush()
+                refresh_effective_limits(db, plan_ids=[plan.id])
                 db.commit()
+                catalog_cache.invalidate()
                 if user_id in admin_plan_state:
                     del admin_plan_state[user_id]
                 await callback.message.answer(f"✅ پلن «{plan.name}» با موفقیت ویرایش شد!", parse_mode="HTML")
                 # Show the plans list with all plans
-                all_plans = db.query(Plan).all()
-                await callback.message.answer(PLANS_MESSAGE, reply_markup=get_plans_keyboard(all_plans), parse_mode="HTML")
+                await callback.message.answer(PLANS_MESSAGE, reply_markup=catalog_cache.get().plans_keyboard, parse_mode="HTML")
             else:
                 await callback.message.answer("❌ پلن یافت نشد.", parse_mode="HTML")
         except Exception as e:
             await callback.message.answer(f"❌ خطا در ذخیره: {str(e)}", parse_mode="HTML")
-        finally:
-            db.close()
     else:
         return False
     return True
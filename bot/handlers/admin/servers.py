@@ -1,35 +1,28 @@
 from ..common import *
 
 
-async def handle_server_management_callbacks(callback: CallbackQuery, bot, data: str, user_id: int) -> bool:
+async def handle_server_management_callbacks(callback: CallbackQuery, bot, data: str, user_id: int, db: Session) -> bool:
     if data == "admin_servers":
-        db = SessionLocal()
-        try:
-            rows = db.query(ServiceType).filter(ServiceType.is_active == True).all()
-            await callback.message.answer(
-                "🖧 مدیریت سرورها\n\nابتدا نوع سرویس را انتخاب کنید:",
-                reply_markup=get_servers_service_type_keyboard(rows),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        await callback.message.answer(
+            "🖧 مدیریت سرورها\n\nابتدا نوع سرویس را انتخاب کنید:",
+            reply_markup=catalog_cache.get().servers_service_type_keyboard,
+            parse_mode="HTML"
+        )
 
     elif data.startswith("admin_servers_type_"):
         service_type_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            servers = db.query(Server).filter(Server.service_type_id == service_type_id).all()
-            server_health_map = {}
-            for srv in servers:
-                statuses = evaluate_server_parameters(srv)
-                server_health_map[srv.id] = statuses.get("all_ok")
-            await callback.message.answer(
-                "📋 لیست سرورها:",
-                reply_markup=get_servers_keyboard(servers, service_type_id, server_health_map),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        servers = db.query(Server).filter(Server.service_type_id == service_type_id).all()
+        # Don't idle in transaction while the routers are probed
+        db.commit()
+        server_health_map = {}
+        for srv in servers:
+            statuses = await evaluate_server_parameters(srv)
+            server_health_map[srv.id] = statuses.get("all_ok")
+        await callback.message.answer(
+            "📋 لیست سرورها:",
+            reply_markup=get_servers_keyboard(servers, service_type_id, server_health_map),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("server_add_"):
         service_type_id = int(data.split("_")[-1])
@@ -43,20 +36,17 @@ async def handle_server_management_callbacks(callback: CallbackQuery, bot, data:
 
     elif data.startswith("server_view_"):
         server_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            srv = db.query(Server).filter(Server.id == server_id).first()
-            if not srv:
-                await callback.message.answer("❌ سرور یافت نشد.", parse_mode="HTML")
-                return
-            statuses = evaluate_server_parameters(srv)
-            await callback.message.answer(
-                "🖧 مدیریت سرور (برای تغییر، روی هر پارامتر بزنید):",
-                reply_markup=get_server_detail_keyboard(srv, srv.service_type_id, statuses),
-                parse_mode="HTML"
-            )
-        finally:
-            db.close()
+        srv = db.query(Server).filter(Server.id == server_id).first()
+        if not srv:
+            await callback.message.answer("❌ سرور یافت نشد.", parse_mode="HTML")
+            return
+        db.commit()
+        statuses = await evaluate_server_parameters(srv)
+        await callback.message.answer(
+            "🖧 مدیریت سرور (برای تغییر، روی هر پارامتر بزنید):",
+            reply_markup=get_server_detail_keyboard(srv, srv.service_type_id, statuses),
+            parse_mode="HTML"
+        )
 
     elif data.startswith("server_field_"):
         parts = data.split("_", 3)
@@ -71,7 +61,7 @@ async def handle_server_management_callbacks(callback: CallbackQuery, bot, data:
             "wg_interface": "اینترفیس جدید را وارد کنید:",
             "wg_server_endpoint": "Endpoint جدید را وارد کنید:",
             "wg_server_port": "پورت WireGuard جدید را وارد کنید:",
-            "wg_client_network_base": "رنج IP کاربران را وارد کنید:\n• فرمت CIDR: 192.168.30.0/24\n• فرمت رنج: 192.168.30.10-192.168.30.220",
+            "wg_client_network_base": "رنج IP کاربران را وارد کنید:\n• فرمت CIDR: 192.168.30.0/24 یا 10.8.0.0/16 یا fd00::/64\n• فرمت رنج: 192.168.30.10-192.168.31.220",
             "wg_client_dns": "DNS جدید را وارد کنید:",
             "capacity": "ظرفیت جدید را وارد کنید:",
         }
@@ -84,18 +74,19 @@ async def handle_server_management_callbacks(callback: CallbackQuery, bot, data:
 
     elif data.startswith("server_delete_"):
         server_id = int(data.split("_")[-1])
-        db = SessionLocal()
-        try:
-            srv = db.query(Server).filter(Server.id == server_id).first()
-            if not srv:
-                await callback.message.answer("❌ سرور یافت نشد.", parse_mode="HTML")
-                return
-            db.query(PlanServerMap).filter(PlanServerMap.server_id == srv.id).delete()
-            db.delete(srv)
-            db.commit()
-            await callback.message.answer("✅ سرور حذف شد.", parse_mode="HTML")
-        finally:
-            db.close()
+        srv = db.query(Server).filter(Server.id == server_id).first()
+        if not srv:
+            await callback.message.answer("❌ سرور یافت نشد.", parse_mode="HTML")
+            return
+        host, api_port = srv.host, srv.api_port
+        db.query(PlanServerMap).filter(PlanServerMap.server_id == srv.id).delete()
+        db.query(IpAllocation).filter(IpAllocation.server_id == srv.id).delete()
+        db.query(PeerSlot).filter(PeerSlot.server_id == srv.id).delete()
+        db.delete(srv)
+        db.commit()
+        catalog_cache.invalidate()
+        await router_pool.invalidate(host, api_port)
+        await callback.message.answer("✅ سرور حذف شد.", parse_mode="HTML")
     else:
         return False
     return True
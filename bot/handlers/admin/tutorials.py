@@ -3,7 +3,7 @@ from ..common import *
 
 # Admin tutorial media handler (photo/video)
 @dp.message(lambda message: message.from_user.id in admin_tutorial_state and admin_tutorial_state.get(message.from_user.id, {}).get("step") == "media")
-async def handle_tutorial_media(message: Message):
+async def handle_tutorial_media(message: Message, db: Session):
     user_id = message.from_user.id
     
     if user_id not in admin_tutorial_state:
@@ -27,7 +27,6 @@ async def handle_tutorial_media(message: Message):
         await message.answer("❌ لطفاً عکس یا ویدیو ارسال کنید.", parse_mode="HTML")
         return
     
-    db = SessionLocal()
     try:
         # Check if tutorial exists and update, or create new
         existing = db.query(ServiceTutorial).filter(
@@ -59,6 +58,5 @@ async def handle_tutorial_media(message: Message):
     except Exception as e:
         await message.answer(f"❌ خطا: {e}", parse_mode="HTML")
     finally:
-        db.close()
         del admin_tutorial_state[user_id]
 
@@ -3,7 +3,7 @@ from .user.callbacks import handle_user_callbacks
 from .admin.callbacks import handle_admin_callbacks
 
 @dp.callback_query()
-async def callback_handler(callback: CallbackQuery, bot):
+async def callback_handler(callback: CallbackQuery, bot, db: Session, session: AsyncSession):
     data = callback.data
     user_id = callback.from_user.id
 
@@ -13,18 +13,16 @@ async def callback_handler(callback: CallbackQuery, bot):
             return
 
     if not is_admin(user_id):
-        db_guard = SessionLocal()
-        try:
-            current_user = get_user(db_guard, str(user_id))
-            if current_user and current_user.is_blocked:
-                await callback.answer("⛔ حساب شما مسدود است.", show_alert=True)
-                return
-        finally:
-            db_guard.close()
+        access = await access_cache.lookup(session, user_id)
+        if access.blocked:
+            await callback.answer("⛔ حساب شما مسدود است.", show_alert=True)
+            return
+        # End the read so the guard does not pin a connection while the branch runs
+        await session.commit()
 
-    handled = await handle_user_callbacks(callback, bot, data, user_id)
+    handled = await handle_user_callbacks(callback, bot, data, user_id, db, session)
     if not handled:
-        handled = await handle_admin_callbacks(callback, bot, data, user_id)
+        handled = await handle_admin_callbacks(callback, bot, data, user_id, db, session)
 
     if not handled:
         await callback.answer("دستور نامعتبر است.", show_alert=False)
@@ -9,8 +9,12 @@ from datetime import datetime, timedelta
 from aiogram import Dispatcher
 from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
 from database import SessionLocal, engine
-from models import User, Panel, Plan, PaymentReceipt, WireGuardConfig, GiftCode, ServiceType, Server, PlanServerMap, ServiceTutorial, Representative
+from models import User, Panel, Plan, PaymentReceipt, WireGuardConfig, GiftCode, ServiceType, Server, PlanServerMap, ServiceTutorial, Representative, IpAllocation, PeerSlot
 from config import (
     CHANNEL_ID, CHANNEL_USERNAME, ADMIN_IDS,
     admin_plan_state, admin_create_account_state, user_payment_state,
@@ -18,7 +22,8 @@ from config import (
     admin_service_type_state, admin_server_state, admin_tutorial_state, admin_representative_state,
     admin_card_state,
     org_user_state,
-    AGENT_BOT_DOCKER_IMAGE, AGENT_BOT_CONTAINER_PREFIX, AGENT_BOT_DOCKER_NETWORK
+    AGENT_BOT_DOCKER_IMAGE, AGENT_BOT_CONTAINER_PREFIX, AGENT_BOT_DOCKER_NETWORK,
+    IP_POOL_MAX_SIZE,
 )
 
 from keyboards import (
@@ -44,7 +49,10 @@ from texts import (
 
 from services.user_service import (
     get_or_create_user,
+    get_or_create_user_async,
     get_user,
+    get_user_async,
+    list_user_configs_async,
     is_admin,
     calculate_org_user_financials as _calculate_org_user_financials,
     search_users,
@@ -56,9 +64,20 @@ from services.plan_service import (
     build_wg_kwargs,
 )
 from services.card_service import get_card_info, set_card_info
-from services.server_service import evaluate_server_parameters
+from services.server_service import evaluate_server_parameters, reset_configs_on_routers, reset_configs_on_routers_async
+from services.router_pool import router_pool
+from services.access_cache import access_cache
+from services.catalog import catalog_cache
+from services.ip_allocator import parse_ip_pool, release_ip
+from services.config_limits import config_limits, refresh_effective_limits, resolve_config_limits
+from services.config_artifacts import content_hash, forget_config, get_file_id, store_file_id
+from services.qr_renderer import render_qr_png_async
+
+from .middleware import DbSessionMiddleware
 
 dp = Dispatcher()
+db_session_middleware = DbSessionMiddleware()
+dp.update.outer_middleware(db_session_middleware)
 
 
 # Helper functions
@@ -157,17 +176,12 @@ def format_traffic(total_bytes: int) -> str:
 
 
 def get_config_limits(config: WireGuardConfig, plan: Plan | None):
-    duration_days = config.duration_days if config.duration_days is not None else (plan.duration_days if plan else None)
-    traffic_limit_gb = config.traffic_limit_gb if config.traffic_limit_gb is not None else (plan.traffic_gb if plan else None)
-    return duration_days, traffic_limit_gb
+    limits = config_limits(config, plan)
+    return limits["duration_days"], limits["traffic_limit_gb"]
 
 
 def get_config_expires_at(config: WireGuardConfig, plan: Plan | None):
-    expires_at = config.expires_at
-    duration_days, _ = get_config_limits(config, plan)
-    if not expires_at and duration_days:
-        expires_at = config.created_at + timedelta(days=duration_days)
-    return expires_at
+    return config_limits(config, plan)["expires_at"]
 
 
 def get_config_consumed_bytes(config: WireGuardConfig) -> int:
@@ -175,24 +189,22 @@ def get_config_consumed_bytes(config: WireGuardConfig) -> int:
 
 
 def get_config_remaining_bytes(config: WireGuardConfig, plan: Plan | None) -> tuple[int, int]:
-    _, traffic_limit_gb = get_config_limits(config, plan)
-    limit_bytes = int((traffic_limit_gb or 0) * (1024 ** 3)) if traffic_limit_gb else 0
-    consumed = get_config_consumed_bytes(config)
-    remaining = max(limit_bytes - consumed, 0) if limit_bytes else 0
-    return limit_bytes, remaining
+    limits = config_limits(config, plan)
+    return limits["limit_bytes"], limits["remaining_bytes"]
 
 def can_renew_config_now(config: WireGuardConfig, plan: Plan | None) -> bool:
     """Return True when config is eligible for direct renew action."""
     if not config:
         return False
+    return can_renew_with_limits(config, config_limits(config, plan))
 
-    now = datetime.utcnow()
-    plan_traffic_bytes, _ = get_config_remaining_bytes(config, plan)
-    consumed_bytes = get_config_consumed_bytes(config)
-    expires_at = get_config_expires_at(config, plan)
 
+def can_renew_with_limits(config: WireGuardConfig, limits: dict) -> bool:
+    """can_renew_config_now() for limits already resolved by resolve_config_limits()."""
+    now = datetime.utcnow()
+    expires_at = limits["expires_at"]
     is_expired_by_date = bool(expires_at and expires_at <= now)
-    is_expired_by_traffic = bool(plan_traffic_bytes and consumed_bytes >= plan_traffic_bytes)
+    is_expired_by_traffic = bool(limits["limit_bytes"] and limits["consumed_bytes"] >= limits["limit_bytes"])
     is_disabled = config.status in ["expired", "revoked", "disabled"]
     is_notified = bool(
         config.low_traffic_alert_sent
@@ -270,160 +282,68 @@ def get_admin_user_manage_view(db, user_obj: User, show_wallet_actions: bool = F
     )
 
 
-async def send_qr_code(sender, qr_base64: str, caption: str = None, chat_id: int = None):
+async def send_qr_code(sender, config_text: str, caption: str = None, chat_id: int = None, config_id: int = None):
     """
-    Send QR code image from base64 string.
+    Send QR code image of a config.
     Can use with message, callback.message, or bot.
+    With config_id the uploaded photo's file_id is reused on later sends,
+    so the QR is only rendered and uploaded once per config content.
     """
-    import base64
+    if not config_text:
+        return
     try:
-        # Remove data:image/png;base64, prefix if present
-        if ',' in qr_base64:
-            qr_base64 = qr_base64.split(',')[1]
-        
-        # Decode base64
-        image_data = base64.b64decode(qr_base64)
-        
-        # Create BufferedInputFile from bytes
-        photo_file = BufferedInputFile(image_data, filename="qr_code.png")
-        
-        # Send photo
+        digest = content_hash(config_text)
+        photo = get_file_id(config_id, "qr", digest)
+        if not photo:
+            image_data = await render_qr_png_async(config_text)
+            if not image_data:
+                return
+            photo = BufferedInputFile(image_data, filename="qr_code.png")
+
         if chat_id:
             # Using bot.send_photo
-            await sender.send_photo(chat_id=chat_id, photo=photo_file, caption=caption)
+            sent = await sender.send_photo(chat_id=chat_id, photo=photo, caption=caption)
         else:
             # Using message.answer_photo
-            await sender.answer_photo(photo=photo_file, caption=caption)
-                
+            sent = await sender.answer_photo(photo=photo, caption=caption)
+
+        if isinstance(photo, BufferedInputFile) and sent.photo:
+            store_file_id(config_id, "qr", digest, sent.photo[-1].file_id)
     except Exception as e:
         print(f"Error sending QR code: {e}")
 
 
-async def send_wireguard_config_file(sender, config_text: str, caption: str = None, chat_id: int = None):
-    """Send wireguard config as .conf file."""
-    import tempfile
-    import os
-
+async def send_wireguard_config_file(sender, config_text: str, caption: str = None, chat_id: int = None, config_id: int = None):
+    """Send wireguard config as .conf file; with config_id the uploaded file_id is reused on later sends."""
     if not config_text:
         return
 
-    tmp_path = None
     try:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".conf", delete=False, encoding="utf-8") as tmp:
-            tmp.write(config_text)
-            tmp_path = tmp.name
-
-        document = FSInputFile(tmp_path, filename="wireguard.conf")
+        digest = content_hash(config_text)
+        document = get_file_id(config_id, "conf", digest) or BufferedInputFile(
+            config_text.encode("utf-8"), filename="wireguard.conf"
+        )
         if chat_id:
-            await sender.send_document(chat_id=chat_id, document=document, caption=caption or "📄 فایل کانفیگ WireGuard")
+            sent = await sender.send_document(chat_id=chat_id, document=document, caption=caption or "📄 فایل کانفیگ WireGuard")
         else:
-            await sender.answer_document(document=document, caption=caption or "📄 فایل کانفیگ WireGuard")
+            sent = await sender.answer_document(document=document, caption=caption or "📄 فایل کانفیگ WireGuard")
+
+        if isinstance(document, BufferedInputFile) and sent.document:
+            store_file_id(config_id, "conf", digest, sent.document.file_id)
     except Exception as e:
         print(f"Error sending config file: {e}")
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
 
 
 def parse_ip_range(input_str: str) -> dict:
     """
-    Parse IP range input in two formats:
-    1. CIDR: x.y.z.0/24
-    2. Range: x.y.z.10-x.y.z.220 or x.y.z.10-220
-    
-    Returns dict with keys: base_ip, start_ip, end_ip, cidr, is_range
+    Parse IP range input in these formats (IPv4 or IPv6):
+    1. CIDR: x.y.0.0/16, fd00::/64
+    2. Range: x.y.z.10-x.y.w.220, x.y.z.10-220 or fd00::10-fd00::ffff
+
+    Returns dict with keys: base_ip, start_ip, end_ip, cidr, is_range,
+    start_offset, end_offset (host offsets from base_ip)
     """
-    input_str = input_str.strip()
-    
-    # Check if it's a range format (contains -)
-    if '-' in input_str and '/' not in input_str:
-        # Format: x.y.z.10-x.y.z.220 or x.y.z.10-220
-        parts = input_str.split('-')
-        if len(parts) == 2:
-            try:
-                start_ip = parts[0].strip()
-                end_part = parts[1].strip()
-
-                # Parse start IP
-                start_parts = start_ip.split('.')
-                if len(start_parts) != 4:
-                    return None
-                base_prefix = '.'.join(start_parts[:3])
-                start_last = int(start_parts[3])
-
-                # Parse end IP - could be full IP or just last octet
-                if '.' in end_part:
-                    # Full IP like 192.168.30.220
-                    end_parts = end_part.split('.')
-                    if len(end_parts) != 4:
-                        return None
-                    end_base = '.'.join(end_parts[:3])
-                    if end_base != base_prefix:
-                        return None
-                    end_last = int(end_parts[3])
-                else:
-                    # Just last octet like 220
-                    end_last = int(end_part)
-
-                # Required bounds for custom range mode
-                if not (10 <= start_last <= 250 and 10 <= end_last <= 250 and start_last <= end_last):
-                    return None
-
-                return {
-                    # Persist as full network-base IP to keep octets intact later
-                    # (e.g. 192.168.30.0 instead of 192.168.30)
-                    'base_ip': f"{base_prefix}.0",
-                    'start_ip': start_ip,
-                    'end_ip': f"{base_prefix}.{end_last}",
-                    'cidr': None,
-                    'is_range': True,
-                    'start_last': start_last,
-                    'end_last': end_last
-                }
-            except (ValueError, IndexError):
-                return None
-    
-    # Check if it's CIDR format
-    if '/' in input_str:
-        # Format: x.y.z.0/24
-        parts = input_str.split('/')
-        if len(parts) == 2:
-            ip = parts[0].strip()
-            mask = int(parts[1].strip())
-            
-            # Calculate start and end IPs based on CIDR
-            ip_parts = ip.split('.')
-            if len(ip_parts) == 4 and 0 <= mask <= 32:
-                ip_int = (int(ip_parts[0]) << 24) + (int(ip_parts[1]) << 16) + (int(ip_parts[2]) << 8) + int(ip_parts[3])
-                mask_int = (0xFFFFFFFF << (32 - mask)) & 0xFFFFFFFF
-                start_int = ip_int & mask_int
-                end_int = start_int | (0xFFFFFFFF - mask_int)
-                
-                return {
-                    'base_ip': ip,
-                    'start_ip': f"{(start_int >> 24) & 0xFF}.{(start_int >> 16) & 0xFF}.{(start_int >> 8) & 0xFF}.{start_int & 0xFF}",
-                    'end_ip': f"{(end_int >> 24) & 0xFF}.{(end_int >> 16) & 0xFF}.{(end_int >> 8) & 0xFF}.{end_int & 0xFF}",
-                    'cidr': mask,
-                    'is_range': False,
-                    'start_last': start_int & 0xFF,
-                    'end_last': end_int & 0xFF
-                }
-    
-    # Default: treat as simple base (backward compatibility)
-    parts = input_str.split('.')
-    if len(parts) == 4:
-        base = '.'.join(parts[:3])
-        return {
-            'base_ip': input_str,
-            'start_ip': f"{base}.1",
-            'end_ip': f"{base}.254",
-            'cidr': 24,
-            'is_range': False,
-            'start_last': 1,
-            'end_last': 254
-        }
-    
-    return None
+    return parse_ip_pool(input_str)
 
 
 def get_server_field_prompt(field: str, step_num: int = None, total_steps: int = None) -> tuple:
@@ -437,7 +357,7 @@ def get_server_field_prompt(field: str, step_num: int = None, total_steps: int =
         "wg_server_public_key": ("Public Key سرور:", False),
         "wg_server_endpoint": ("Endpoint سرور:", False),
         "wg_server_port": ("پورت وایرگارد:", False),
-        "wg_client_network_base": ("رنج IP را وارد کنید:\n• فرمت CIDR: 192.168.30.0/24\n• فرمت رنج: 192.168.30.10-192.168.30.220", False),
+        "wg_client_network_base": ("رنج IP را وارد کنید:\n• فرمت CIDR: 192.168.30.0/24 یا 10.8.0.0/16 یا fd00::/64\n• فرمت رنج: 192.168.30.10-192.168.31.220", False),
         "wg_client_dns": ("DNS (مثلاً 8.8.8.8,1.0.0.1):", False),
         "capacity": ("ظرفیت سرور (تعداد اکانت):", True)
     }
@@ -0,0 +1,135 @@
+"""
+Session-per-update middleware.
+
+Every update gets one sync Session in data["db"] and one AsyncSession in
+data["session"]; handlers declare whichever they use as a parameter and share
+it with the guard in callback_handler. Both are lazy: the sync Session is only
+created when a handler first uses it, and a pool connection is only checked
+out on the first query and goes back at commit, so an update that never
+touches the database never touches the pool. Everything is closed (and anything
+left uncommitted rolled back) when the update is done, so handlers only commit.
+
+The sync Session keeps loaded rows on commit (expire_on_commit=False). Its
+queries hold a transaction open until commit, so handlers that call a router or
+another slow service mid-way commit first instead of idling in transaction.
+
+Queries and time spent in the database are counted per update (data["db_stats"])
+and in total (DbSessionMiddleware.metrics()).
+"""
+import contextvars
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy import event
+
+from config import DB_PROFILE_UPDATES, DB_SLOW_UPDATE_MS
+from database import AsyncSessionLocal, SessionLocal, async_engine, engine
+
+logger = logging.getLogger(__name__)
+
+_current_stats: contextvars.ContextVar["DbStats | None"] = contextvars.ContextVar("update_db_stats", default=None)
+
+
+class DbStats:
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    started = conn.info.get("query_started")
+    if stats is None or not started:
+        return
+    stats.queries += 1
+    stats.db_time += time.perf_counter() - started.pop()
+
+
+for _engine in (engine, async_engine.sync_engine):
+    event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class LazySession:
+    """Stands in for the update's sync Session and creates it on first use."""
+
+    __slots__ = ("_factory", "_session")
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._session = None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._factory(expire_on_commit=False)
+        return getattr(self._session, name)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    def __init__(self, session_factory=SessionLocal, async_session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self.updates = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.max_queries = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = DbStats()
+        token = _current_stats.set(stats)
+        db = LazySession(self.session_factory)
+        session = self.async_session_factory()
+        data["db"] = db
+        data["session"] = session
+        data["db_stats"] = stats
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            db.close()
+            await session.close()
+            _current_stats.reset(token)
+            self._record(event, stats, time.perf_counter() - started)
+
+    def _record(self, event: TelegramObject, stats: DbStats, elapsed: float):
+        self.updates += 1
+        self.queries += stats.queries
+        self.db_time += stats.db_time
+        self.max_queries = max(self.max_queries, stats.queries)
+        db_ms = stats.db_time * 1000
+        if DB_PROFILE_UPDATES or (DB_SLOW_UPDATE_MS > 0 and db_ms >= DB_SLOW_UPDATE_MS):
+            logger.info(
+                f"Update {getattr(event, 'update_id', '?')} ({getattr(event, 'event_type', type(event).__name__)}): "
+                f"{stats.queries} queries, {db_ms:.1f} ms in DB, {elapsed * 1000:.1f} ms total"
+            )
+
+    def metrics(self) -> dict:
+        """Totals since start: updates handled, queries, DB seconds, and the per-update average and max."""
+        return {
+            "updates": self.updates,
+            "queries": self.queries,
+            "db_time": self.db_time,
+            "avg_queries": self.queries / self.updates if self.updates else 0.0,
+            "avg_db_ms": self.db_time * 1000 / self.updates if self.updates else 0.0,
+            "max_queries": self.max_queries,
+        }
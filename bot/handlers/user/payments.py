@@ -2,7 +2,7 @@ from aiogram.types import Message
 from ..common import *
 
 @dp.message(lambda message: (not is_admin(message.from_user.id)) and message.from_user.id in user_payment_state and user_payment_state.get(message.from_user.id, {}).get("step") == "discount_code")
-async def handle_discount_code_input(message: Message):
+async def handle_discount_code_input(message: Message, db: Session):
     user_id = message.from_user.id
     code_text = message.text.strip().upper()
     state = user_payment_state.get(user_id, {})
@@ -11,42 +11,38 @@ async def handle_discount_code_input(message: Message):
         await message.answer("❌ ابتدا پلن را انتخاب کنید.", parse_mode="HTML")
         return
 
-    db = SessionLocal()
-    try:
-        plan = db.query(Plan).filter(Plan.id == plan_id).first()
-        gift = db.query(GiftCode).filter(GiftCode.code == code_text, GiftCode.is_active == True).first()
-        if not plan or not gift:
-            await message.answer("❌ کد تخفیف نامعتبر است.", parse_mode="HTML")
-            return
-        if gift.expires_at and gift.expires_at < datetime.utcnow():
-            await message.answer("❌ اعتبار این کد تخفیف تمام شده است.", parse_mode="HTML")
-            return
-        if gift.used_count >= gift.max_uses:
-            await message.answer("❌ ظرفیت استفاده این کد تکمیل شده است.", parse_mode="HTML")
-            return
+    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+    gift = db.query(GiftCode).filter(GiftCode.code == code_text, GiftCode.is_active == True).first()
+    if not plan or not gift:
+        await message.answer("❌ کد تخفیف نامعتبر است.", parse_mode="HTML")
+        return
+    if gift.expires_at and gift.expires_at < datetime.utcnow():
+        await message.answer("❌ اعتبار این کد تخفیف تمام شده است.", parse_mode="HTML")
+        return
+    if gift.used_count >= gift.max_uses:
+        await message.answer("❌ ظرفیت استفاده این کد تکمیل شده است.", parse_mode="HTML")
+        return
 
-        discount_amount = 0
-        if gift.discount_percent:
-            discount_amount = int((plan.price * gift.discount_percent) / 100)
-        elif gift.discount_amount:
-            discount_amount = gift.discount_amount
+    discount_amount = 0
+    if gift.discount_percent:
+        discount_amount = int((plan.price * gift.discount_percent) / 100)
+    elif gift.discount_amount:
+        discount_amount = gift.discount_amount
+
+    final_price = max(plan.price - discount_amount, 0)
+    state["discount_amount"] = discount_amount
+    state["price"] = final_price
+    state["gift_code"] = gift.code
+    state.pop("step", None)
+    user_payment_state[user_id] = state
 
-        final_price = max(plan.price - discount_amount, 0)
-        state["discount_amount"] = discount_amount
-        state["price"] = final_price
-        state["gift_code"] = gift.code
-        state.pop("step", None)
-        user_payment_state[user_id] = state
-
-        renew_config_id = state.get("renew_config_id")
-        kb = get_payment_method_keyboard_for_renew(plan.id, renew_config_id) if renew_config_id else get_payment_method_keyboard(plan.id)
-        await message.answer(
-            f"✅ کد اعمال شد.\nقیمت اصلی: {plan.price} تومان\nمیزان تخفیف: {discount_amount} تومان\nقیمت نهایی: {final_price} تومان",
-            reply_markup=kb,
-            parse_mode="HTML"
-        )
-    finally:
-        db.close()
+    renew_config_id = state.get("renew_config_id")
+    kb = get_payment_method_keyboard_for_renew(plan.id, renew_config_id) if renew_config_id else get_payment_method_keyboard(plan.id)
+    await message.answer(
+        f"✅ کد اعمال شد.\nقیمت اصلی: {plan.price} تومان\nمیزان تخفیف: {discount_amount} تومان\nقیمت نهایی: {final_price} تومان",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
 
 @dp.message(lambda message: (not is_admin(message.from_user.id)) and message.from_user.id in user_payment_state and user_payment_state.get(message.from_user.id, {}).get("method") == "wallet_topup" and user_payment_state.get(message.from_user.id, {}).get("step") == "amount_input")
 async def handle_wallet_topup_amount(message: Message):
@@ -65,7 +61,7 @@ async def handle_wallet_topup_amount(message: Message):
 
 # Receipt photo handler
 @dp.message(lambda message: (not is_admin(message.from_user.id)) and message.from_user.id in user_payment_state and user_payment_state.get(message.from_user.id, {}).get("method") in ["card_to_card", "wallet_topup"])
-async def handle_receipt_photo(message: Message):
+async def handle_receipt_photo(message: Message, db: Session):
     user_id = message.from_user.id
     
     # Check if user is in payment state and expecting a receipt
@@ -88,7 +84,6 @@ async def handle_receipt_photo(message: Message):
     file_id = photo.file_id
     
     # Save receipt to database
-    db = SessionLocal()
     try:
         is_wallet_topup = payment_info.get("method") == "wallet_topup"
         receipt = PaymentReceipt(
@@ -152,11 +147,9 @@ async def handle_receipt_photo(message: Message):
                 
     except Exception as e:
         await message.answer(f"❌ خطا در ذخیره فیش: {str(e)}", parse_mode="HTML")
-    finally:
-        db.close()
 
 @dp.message(lambda message: (not is_admin(message.from_user.id)) and message.from_user.id in org_user_state and org_user_state.get(message.from_user.id, {}).get("step") in {"name", "days", "traffic"})
-async def handle_org_create_account_input(message: Message):
+async def handle_org_create_account_input(message: Message, db: Session):
     user_id = message.from_user.id
     state = org_user_state.get(user_id, {})
     step = state.get("step")
@@ -195,23 +188,19 @@ async def handle_org_create_account_input(message: Message):
         state["step"] = "server"
         org_user_state[user_id] = state
 
-        db = SessionLocal()
-        try:
-            wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
-            if not wireguard_type:
-                await message.answer("❌ سرویس WireGuard تعریف نشده است.", parse_mode="HTML")
-                return
-            servers = db.query(Server).filter(Server.service_type_id == wireguard_type.id, Server.is_active == True).all()
-            if not servers:
-                await message.answer("❌ سرور فعالی وجود ندارد.", parse_mode="HTML")
-                return
-            await message.answer("سرور مدنظر را انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(servers, "create_acc_custom_server_"), parse_mode="HTML")
-        finally:
-            db.close()
+        wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
+        if not wireguard_type:
+            await message.answer("❌ سرویس WireGuard تعریف نشده است.", parse_mode="HTML")
+            return
+        servers = db.query(Server).filter(Server.service_type_id == wireguard_type.id, Server.is_active == True).all()
+        if not servers:
+            await message.answer("❌ سرور فعالی وجود ندارد.", parse_mode="HTML")
+            return
+        await message.answer("سرور مدنظر را انتخاب کنید:", reply_markup=get_plan_server_select_keyboard(servers, "create_acc_custom_server_"), parse_mode="HTML")
 
 
 @dp.message(lambda message: (not is_admin(message.from_user.id)) and message.from_user.id in org_user_state and org_user_state.get(message.from_user.id, {}).get("step") == "settlement_receipt")
-async def handle_org_settlement_receipt(message: Message):
+async def handle_org_settlement_receipt(message: Message, db: Session):
     user_id = message.from_user.id
     state = org_user_state.get(user_id, {})
     if not message.photo:
@@ -221,7 +210,6 @@ async def handle_org_settlement_receipt(message: Message):
     file_id = message.photo[-1].file_id
     amount = int(state.get("amount") or 0)
 
-    db = SessionLocal()
     try:
         receipt = PaymentReceipt(
             user_telegram_id=str(user_id),
@@ -256,5 +244,4 @@ async def handle_org_settlement_receipt(message: Message):
             except Exception as e:
                 print(f"Error sending org settlement receipt to admin: {e}")
     finally:
-        db.close()
         org_user_state.pop(user_id, None)
@@ -3,15 +3,14 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from ..common import *
 
 @dp.message(filters.CommandStart())
-async def start_handler(message: Message, bot):
+async def start_handler(message: Message, bot, session: AsyncSession):
     user = message.from_user
     user_id = user.id
-    db = SessionLocal()
     try:
         is_member = await check_channel_member(bot, user_id, CHANNEL_ID)
         if is_member:
-            db_user, is_new_user = get_or_create_user(
-                db,
+            db_user, is_new_user = await get_or_create_user_async(
+                session,
                 str(user_id),
                 user.username,
                 user.first_name,
@@ -22,7 +21,8 @@ async def start_handler(message: Message, bot):
                 await message.answer("⛔ حساب شما توسط ادمین مسدود شده است.", parse_mode="HTML")
                 return
             db_user.is_member = True
-            db.commit()
+            await session.commit()
+            access_cache.invalidate(user_id)
             await message.answer(WELCOME_MESSAGE, reply_markup=get_main_keyboard(db_user.is_admin), parse_mode="HTML")
             if is_new_user:
                 await message.answer("🎉 خوش آمدید! عضویت شما در کانال تایید شد.", parse_mode="HTML")
@@ -42,16 +42,16 @@ async def start_handler(message: Message, bot):
                     except Exception:
                         pass
         else:
-            db_user = get_user(db, str(user_id))
+            db_user = await get_user_async(session, str(user_id))
             if db_user:
                 db_user.is_member = False
-                db.commit()
+                await session.commit()
+                access_cache.invalidate(user_id)
             await message.answer(NOT_MEMBER_MESSAGE.format(channel_username=CHANNEL_USERNAME), parse_mode="HTML")
     except Exception as e:
+        await session.rollback()
         print(f"Error in start_handler: {e}")
         await message.answer("❌ خطایی رخ داد. لطفاً دوباره تلاش کنید.")
-    finally:
-        db.close()
 
 
 @dp.message(filters.Command("register_panel"))
@@ -72,20 +72,16 @@ async def register_panel_handler(message: Message):
 @dp.message(lambda message: not is_admin(message.from_user.id) and (message.text or "").strip() in {
     "🛒 خرید جدید", "📱 نرم‌افزارها", "🔗 کانفیگ‌های من", "📚 آموزش اتصال", "💳 شارژ کیف پول", "🧪 اکانت تست", "👤 حساب کاربری"
 })
-async def handle_user_menu_buttons(message: Message):
+async def handle_user_menu_buttons(message: Message, db: Session, session: AsyncSession):
     text = (message.text or "").strip()
     user_id = message.from_user.id
 
     if text == "🛒 خرید جدید":
-        db = SessionLocal()
-        try:
-            plans = db.query(Plan).filter(Plan.is_active == True).all()
-            if plans:
-                await message.answer("🛒 خرید سرویس وی پی ان\n\nیکی از پلن‌های زیر را انتخاب کنید:\n", reply_markup=get_buy_keyboard(plans), parse_mode="HTML")
-            else:
-                await message.answer("❌ در حال حاضر پلن فعالی برای خرید وجود ندارد.", parse_mode="HTML")
-        finally:
-            db.close()
+        catalog = catalog_cache.get()
+        if catalog.active_plans:
+            await message.answer("🛒 خرید سرویس وی پی ان\n\nیکی از پلن‌های زیر را انتخاب کنید:\n", reply_markup=catalog.buy_keyboard, parse_mode="HTML")
+        else:
+            await message.answer("❌ در حال حاضر پلن فعالی برای خرید وجود ندارد.", parse_mode="HTML")
         return
 
     if text == "📱 نرم‌افزارها":
@@ -101,24 +97,16 @@ async def handle_user_menu_buttons(message: Message):
         return
 
     if text == "🔗 کانفیگ‌های من":
-        db = SessionLocal()
-        try:
-            configs = db.query(WireGuardConfig).filter(WireGuardConfig.user_telegram_id == str(user_id)).order_by(WireGuardConfig.created_at.desc()).all()
-            if configs:
-                await message.answer("🔗 کانفیگ های من\n\nبرای مشاهده جزئیات، کانفیگ موردنظر را انتخاب کنید:", reply_markup=get_configs_keyboard(configs), parse_mode="HTML")
-            else:
-                await message.answer(MY_CONFIGS_MESSAGE, parse_mode="HTML")
-        finally:
-            db.close()
+        configs = await list_user_configs_async(session, user_id)
+        if configs:
+            await message.answer("🔗 کانفیگ های من\n\nبرای مشاهده جزئیات، کانفیگ موردنظر را انتخاب کنید:", reply_markup=get_configs_keyboard(configs), parse_mode="HTML")
+        else:
+            await message.answer(MY_CONFIGS_MESSAGE, parse_mode="HTML")
         return
 
     if text == "💳 شارژ کیف پول":
-        db = SessionLocal()
-        try:
-            user = get_user(db, str(user_id))
-            await message.answer(WALLET_MESSAGE.format(balance=user.wallet_balance if user else 0), parse_mode="HTML")
-        finally:
-            db.close()
+        user = get_user(db, str(user_id))
+        await message.answer(WALLET_MESSAGE.format(balance=user.wallet_balance if user else 0), parse_mode="HTML")
         return
 
     if text == "👤 حساب کاربری":
@@ -2,13 +2,18 @@ import asyncio
 import sys
 from aiogram import Bot
 
-from database import init_db
+from database import async_engine, init_db
 from config import TOKEN
 from handlers import dp
+from services.keypair_buffer import keypair_buffer
+from services.router_pool import router_pool
+from services.usage_accumulator import usage_accumulator
+from services.usage_history import usage_history
 from services.monitoring_service import (
     usage_sync_worker,
     notify_plan_thresholds_worker,
     cleanup_expired_test_accounts_worker,
+    peer_slot_refill_worker,
 )
 
 print("Starting bot...", file=sys.stderr)
@@ -24,12 +29,15 @@ async def main():
     usage_task = None
     notify_task = None
     test_cleanup_task = None
+    peer_slot_task = None
     try:
         print("Deleting webhook...", file=sys.stderr)
         await bot.delete_webhook(drop_pending_updates=True)
+        keypair_buffer.refill_if_low()
         usage_task = asyncio.create_task(usage_sync_worker())
         notify_task = asyncio.create_task(notify_plan_thresholds_worker(bot))
         test_cleanup_task = asyncio.create_task(cleanup_expired_test_accounts_worker(bot))
+        peer_slot_task = asyncio.create_task(peer_slot_refill_worker())
         print("Starting polling...", file=sys.stderr)
         await dp.start_polling(bot)
     finally:
@@ -39,6 +47,12 @@ async def main():
             notify_task.cancel()
         if test_cleanup_task:
             test_cleanup_task.cancel()
+        if peer_slot_task:
+            peer_slot_task.cancel()
+        usage_accumulator.flush()
+        usage_history.flush(force=True)
+        await router_pool.close_all()
+        await async_engine.dispose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+"""Apply pending database migrations (see migrations.py).
+
+Run it as a deploy step before starting the bot when AUTO_MIGRATE=false.
+
+Example:
+    python migrate.py            # apply everything pending
+    python migrate.py --status   # only show the current and latest version
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+
+from migrations import LATEST_VERSION, current_version, migrate, pending_migrations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply pending database migrations.")
+    parser.add_argument("--status", action="store_true", help="Show schema version and pending migrations only")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    version = current_version()
+    pending = pending_migrations(version)
+    print(f"Schema version: {version} (latest: {LATEST_VERSION})")
+    for number, description, _ in pending:
+        print(f"  pending {number}: {description}")
+    if args.status or not pending:
+        return
+
+    applied = migrate()
+    print(f"Applied: {', '.join(map(str, applied)) or 'nothing'}")
+
+
+if __name__ == "__main__":
+    main()
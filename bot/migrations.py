@@ -0,0 +1,534 @@
+"""
+Versioned schema migrations.
+
+Applied versions are recorded in schema_migrations. On startup init_db() runs
+a single version check; pending migrations are applied there only with
+AUTO_MIGRATE, otherwise startup stops and `python migrate.py` applies them as a
+separate deploy step. Every migration commits on its own; backfills of big
+tables commit every MIGRATION_BATCH_SIZE rows so locks stay short.
+
+Version 1 is the schema init_db() used to rebuild on every start, frozen as
+its own table definitions so it never follows later changes to models.py. Its
+statements are idempotent, so databases created before versioning are adopted
+by simply running it once. Every later schema change is its own migration,
+written as idempotent DDL; add new ones at the end of MIGRATIONS.
+"""
+import logging
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    text,
+)
+from sqlalchemy.exc import ProgrammingError
+
+from config import MIGRATION_BATCH_SIZE
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Serializes migrations between the polling bot and the webhook process
+MIGRATION_LOCK_ID = 72_150_001
+
+
+def _t(name, *columns):
+    return Table(name, _V1, Column("id", Integer, primary_key=True, index=True), *columns)
+
+
+# Migration 1's tables exactly as the baseline models declared them; frozen so
+# later model changes go through their own migrations instead of create_all
+_V1 = MetaData()
+_t(
+    "users",
+    Column("telegram_id", String, unique=True, index=True, nullable=False),
+    Column("username", String),
+    Column("first_name", String, nullable=False),
+    Column("last_name", String),
+    Column("is_member", Boolean),
+    Column("is_admin", Boolean),
+    Column("is_blocked", Boolean),
+    Column("is_organization_customer", Boolean),
+    Column("org_price_per_gb", Integer),
+    Column("org_last_settlement_at", DateTime),
+    Column("org_deleted_traffic_bytes", BigInteger),
+    Column("wallet_balance", Integer),
+    Column("has_used_test_account", Boolean),
+    Column("representative_id", Integer),
+    Column("joined_at", DateTime),
+)
+_t(
+    "panels",
+    Column("name", String, nullable=False),
+    Column("ip_address", String, nullable=False),
+    Column("local_ip", String),
+    Column("location", String),
+    Column("port", Integer),
+    Column("path", String),
+    Column("api_username", String),
+    Column("api_password", String),
+    Column("xui_version", String),
+    Column("system_info", Text),
+    Column("status", String),
+    Column("created_at", DateTime),
+    Column("approved_at", DateTime),
+)
+_t(
+    "service_types",
+    Column("code", String, unique=True, nullable=False, index=True),
+    Column("name", String, nullable=False),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime),
+)
+_t(
+    "servers",
+    Column("name", String, nullable=False),
+    Column("service_type_id", Integer, ForeignKey("service_types.id"), nullable=False, index=True),
+    Column("host", String, nullable=False),
+    Column("api_port", Integer),
+    Column("username", String),
+    Column("password", String),
+    Column("wg_interface", String),
+    Column("wg_server_public_key", String),
+    Column("wg_server_endpoint", String),
+    Column("wg_server_port", Integer),
+    Column("wg_client_network_base", String),
+    Column("wg_client_dns", String),
+    Column("wg_ip_range_start", Integer),
+    Column("wg_ip_range_end", Integer),
+    Column("wg_is_ip_range", Boolean),
+    Column("capacity", Integer),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime),
+)
+_t(
+    "plans",
+    Column("name", String, nullable=False),
+    Column("service_type_id", Integer, ForeignKey("service_types.id"), index=True),
+    Column("duration_days", Integer, nullable=False),
+    Column("traffic_gb", Float, nullable=False),
+    Column("price", Integer, nullable=False),
+    Column("description", Text),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime),
+)
+_t(
+    "plan_server_map",
+    Column("plan_id", Integer, ForeignKey("plans.id"), nullable=False, index=True),
+    Column("server_id", Integer, ForeignKey("servers.id"), nullable=False, index=True),
+    Column("created_at", DateTime),
+)
+_t(
+    "payment_receipts",
+    Column("user_telegram_id", String, index=True, nullable=False),
+    Column("plan_id", Integer),
+    Column("plan_name", String, nullable=False),
+    Column("amount", Integer, nullable=False),
+    Column("payment_method", String, nullable=False),
+    Column("receipt_file_id", String),
+    Column("status", String),
+    Column("created_at", DateTime),
+    Column("approved_at", DateTime),
+    Column("approved_by", String),
+    Column("server_id", Integer),
+    Column("renew_config_id", Integer),
+    Column("representative_id", Integer),
+)
+_t(
+    "wireguard_configs",
+    Column("user_telegram_id", String, index=True, nullable=False),
+    Column("plan_name", String),
+    Column("plan_id", Integer),
+    Column("server_id", Integer),
+    Column("representative_id", Integer),
+    Column("private_key", Text, nullable=False),
+    Column("public_key", Text, nullable=False),
+    Column("client_ip", String, nullable=False),
+    Column("preshared_key", Text),
+    Column("wg_server_public_key", String, nullable=False),
+    Column("wg_server_endpoint", String, nullable=False),
+    Column("wg_server_port", Integer, nullable=False),
+    Column("wg_client_dns", String),
+    Column("allowed_ips", String),
+    Column("status", String),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime),
+    Column("duration_days", Integer),
+    Column("traffic_limit_gb", Float),
+    Column("renewed_at", DateTime),
+    Column("cumulative_rx_bytes", BigInteger),
+    Column("cumulative_tx_bytes", BigInteger),
+    Column("last_rx_counter", BigInteger),
+    Column("last_tx_counter", BigInteger),
+    Column("counter_reset_flag", Boolean),
+    Column("low_traffic_alert_sent", Boolean),
+    Column("expiry_alert_sent", Boolean),
+    Column("threshold_alert_sent", Boolean),
+)
+_t(
+    "gift_codes",
+    Column("code", String, unique=True, index=True, nullable=False),
+    Column("discount_percent", Integer),
+    Column("discount_amount", Integer),
+    Column("max_uses", Integer),
+    Column("used_count", Integer),
+    Column("expires_at", DateTime),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime),
+)
+_t(
+    "service_tutorials",
+    Column("service_type_id", Integer, ForeignKey("service_types.id"), nullable=False, index=True),
+    Column("title", String, nullable=False),
+    Column("description", Text),
+    Column("media_type", String),
+    Column("media_file_id", String),
+    Column("media_url", String),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime),
+    Column("updated_at", DateTime),
+)
+_t(
+    "representatives",
+    Column("name", String, nullable=False),
+    Column("bot_token", String, nullable=False),
+    Column("admin_telegram_id", String, nullable=False),
+    Column("channel_id", String, nullable=False),
+    Column("docker_container_name", String),
+    Column("is_active", Boolean),
+    Column("total_configs", Integer),
+    Column("total_traffic_bytes", BigInteger),
+    Column("total_sales_amount", BigInteger),
+    Column("created_at", DateTime),
+)
+
+
+def _baseline(conn):
+    _V1.create_all(bind=conn)
+
+    # WireGuard config columns
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS cumulative_rx_bytes BIGINT DEFAULT 0"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS cumulative_tx_bytes BIGINT DEFAULT 0"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS last_rx_counter BIGINT DEFAULT 0"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS last_tx_counter BIGINT DEFAULT 0"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS counter_reset_flag BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS low_traffic_alert_sent BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS expiry_alert_sent BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS threshold_alert_sent BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS duration_days INTEGER"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS traffic_limit_gb DOUBLE PRECISION"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS renewed_at TIMESTAMP"))
+
+    # Add server_id column if it doesn't exist (for FK to servers table)
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS server_id INTEGER"))
+
+    # User columns
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS has_used_test_account BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_organization_customer BOOLEAN DEFAULT FALSE"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS org_price_per_gb INTEGER DEFAULT 3000"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS org_last_settlement_at TIMESTAMP"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS org_deleted_traffic_bytes BIGINT DEFAULT 0"))
+
+    # Plan columns
+    try:
+        conn.execute(text("ALTER TABLE plans ALTER COLUMN traffic_gb TYPE DOUBLE PRECISION USING traffic_gb::double precision"))
+    except Exception:
+        pass
+
+    conn.execute(text("ALTER TABLE plans ADD COLUMN IF NOT EXISTS service_type_id INTEGER"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_plans_service_type_id ON plans(service_type_id)"))
+    conn.execute(text("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1
+                FROM pg_constraint
+                WHERE conname = 'fk_plans_service_type_id'
+            ) THEN
+                ALTER TABLE plans
+                ADD CONSTRAINT fk_plans_service_type_id
+                FOREIGN KEY (service_type_id) REFERENCES service_types(id)
+                ON DELETE SET NULL;
+            END IF;
+        END;
+        $$;
+    """))
+
+    # Payment receipt columns
+    conn.execute(text("ALTER TABLE payment_receipts ADD COLUMN IF NOT EXISTS server_id INTEGER"))
+    conn.execute(text("ALTER TABLE payment_receipts ADD COLUMN IF NOT EXISTS renew_config_id INTEGER"))
+    conn.execute(text("ALTER TABLE payment_receipts ADD COLUMN IF NOT EXISTS representative_id INTEGER"))
+
+    # Representative columns
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS representative_id INTEGER"))
+    conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS representative_id INTEGER"))
+    conn.execute(text("ALTER TABLE representatives ADD COLUMN IF NOT EXISTS total_configs INTEGER DEFAULT 0"))
+    conn.execute(text("ALTER TABLE representatives ADD COLUMN IF NOT EXISTS total_traffic_bytes BIGINT DEFAULT 0"))
+    conn.execute(text("ALTER TABLE representatives ADD COLUMN IF NOT EXISTS total_sales_amount BIGINT DEFAULT 0"))
+
+    # Server columns (for legacy databases created before service type support)
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS service_type_id INTEGER"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS host VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS api_port INTEGER DEFAULT 8728"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS username VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS password VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_interface VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_server_public_key VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_server_endpoint VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_server_port INTEGER"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_client_network_base VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS wg_client_dns VARCHAR"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS capacity INTEGER DEFAULT 100"))
+    conn.execute(text("ALTER TABLE servers ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE"))
+
+    conn.execute(text("""
+        INSERT INTO service_types (code, name, is_active, created_at)
+        VALUES
+            ('wireguard', 'WireGuard', TRUE, NOW()),
+            ('v2ray', 'V2Ray', TRUE, NOW())
+        ON CONFLICT (code) DO NOTHING
+    """))
+
+    # Backfill missing service_type_id values to WireGuard for old server rows
+    conn.execute(text("""
+        UPDATE servers
+        SET service_type_id = st.id
+        FROM service_types st
+        WHERE st.code = 'wireguard'
+          AND servers.service_type_id IS NULL
+    """))
+    conn.execute(text("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1
+                FROM pg_constraint
+                WHERE conname = 'fk_servers_service_type_id'
+            ) THEN
+                ALTER TABLE servers
+                ADD CONSTRAINT fk_servers_service_type_id
+                FOREIGN KEY (service_type_id) REFERENCES service_types(id)
+                ON DELETE RESTRICT;
+            END IF;
+        END;
+        $$;
+    """))
+
+    # Try to create indexes for tables that may not exist yet
+    try:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_servers_service_type_id ON servers(service_type_id)"))
+    except Exception:
+        pass
+    try:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_plan_server_map_plan_id ON plan_server_map(plan_id)"))
+    except Exception:
+        pass
+    try:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_plan_server_map_server_id ON plan_server_map(server_id)"))
+    except Exception:
+        pass
+
+    # Keep service type defaults present in case of partial startup failures
+    try:
+        conn.execute(text("""
+            INSERT INTO service_types (code, name, is_active, created_at)
+            VALUES
+                ('wireguard', 'WireGuard', TRUE, NOW()),
+                ('v2ray', 'V2Ray', TRUE, NOW())
+            ON CONFLICT (code) DO NOTHING
+        """))
+    except Exception:
+        pass
+
+
+def _config_limit_columns(conn):
+    """Effective limits used by the expiry/quota workers, and the indexes they scan."""
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS effective_expires_at TIMESTAMP"))
+    conn.execute(text("ALTER TABLE wireguard_configs ADD COLUMN IF NOT EXISTS traffic_limit_bytes BIGINT"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_wireguard_configs_active_expiry "
+        "ON wireguard_configs(effective_expires_at) WHERE status = 'active'"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_wireguard_configs_active_remaining ON wireguard_configs("
+        "(traffic_limit_bytes - COALESCE(cumulative_rx_bytes, 0) - COALESCE(cumulative_tx_bytes, 0))"
+        ") WHERE status = 'active'"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_wireguard_configs_server_id ON wireguard_configs(server_id)"))
+
+
+def _ip_allocations(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS ip_allocations (
+            id SERIAL PRIMARY KEY,
+            server_id INTEGER NOT NULL,
+            address VARCHAR NOT NULL,
+            status VARCHAR NOT NULL,
+            config_id INTEGER,
+            allocated_at TIMESTAMP,
+            CONSTRAINT uq_ip_allocations_server_address UNIQUE (server_id, address)
+        )
+    """))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ip_allocations_id ON ip_allocations(id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ip_allocations_server_id ON ip_allocations(server_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ip_allocations_config_id ON ip_allocations(config_id)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_ip_allocations_free ON ip_allocations(server_id, id) WHERE status = 'free'"
+    ))
+
+
+def _peer_slots(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS peer_slots (
+            id SERIAL PRIMARY KEY,
+            server_id INTEGER NOT NULL,
+            wg_interface VARCHAR NOT NULL,
+            client_ip VARCHAR NOT NULL,
+            private_key VARCHAR NOT NULL,
+            public_key VARCHAR NOT NULL,
+            peer_id VARCHAR NOT NULL,
+            status VARCHAR NOT NULL,
+            created_at TIMESTAMP,
+            claimed_at TIMESTAMP
+        )
+    """))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_peer_slots_id ON peer_slots(id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_peer_slots_server_id ON peer_slots(server_id)"))
+
+
+def _config_artifacts(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS config_artifacts (
+            id SERIAL PRIMARY KEY,
+            config_id INTEGER NOT NULL,
+            kind VARCHAR NOT NULL,
+            content_hash VARCHAR NOT NULL,
+            file_id VARCHAR NOT NULL,
+            created_at TIMESTAMP,
+            CONSTRAINT uq_config_artifacts_key UNIQUE (config_id, kind, content_hash)
+        )
+    """))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_config_artifacts_id ON config_artifacts(id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_config_artifacts_config_id ON config_artifacts(config_id)"))
+
+
+def _usage_samples(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS usage_samples (
+            id BIGSERIAL PRIMARY KEY,
+            server_id INTEGER NOT NULL,
+            resolution VARCHAR NOT NULL,
+            bucket_start TIMESTAMP NOT NULL,
+            config_ids INTEGER[] NOT NULL,
+            rx_bytes BIGINT[] NOT NULL,
+            tx_bytes BIGINT[] NOT NULL,
+            CONSTRAINT uq_usage_samples_bucket UNIQUE (resolution, bucket_start, server_id)
+        )
+    """))
+
+
+def _batched_config_ids(conn):
+    """Yield wireguard_configs id ranges of MIGRATION_BATCH_SIZE."""
+    low, high = conn.execute(text("SELECT MIN(id), MAX(id) FROM wireguard_configs")).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, MIGRATION_BATCH_SIZE):
+        yield start, start + MIGRATION_BATCH_SIZE - 1
+
+
+def _backfill_config_limits(conn):
+    """Copy missing limits from plans and compute effective limits, one batch per transaction."""
+    from services.config_limits import refresh_effective_limits
+
+    for start, end in _batched_config_ids(conn):
+        params = {"start": start, "end": end}
+        conn.execute(text("""
+            UPDATE wireguard_configs wc
+            SET duration_days = COALESCE(wc.duration_days, p.duration_days),
+                traffic_limit_gb = COALESCE(wc.traffic_limit_gb, p.traffic_gb)
+            FROM plans p
+            WHERE wc.plan_id = p.id AND wc.id BETWEEN :start AND :end
+              AND (wc.duration_days IS NULL OR wc.traffic_limit_gb IS NULL)
+        """), params)
+        refresh_effective_limits(conn, config_ids=range(start, end + 1))
+        conn.commit()
+
+
+# (version, description, function(conn)); versions only ever grow
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "config limit columns", _config_limit_columns),
+    (3, "backfill config limits", _backfill_config_limits),
+    (4, "ip allocations", _ip_allocations),
+    (5, "peer slots", _peer_slots),
+    (6, "config artifacts", _config_artifacts),
+    (7, "usage samples", _usage_samples),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version() -> int:
+    """Highest applied version; 0 for a database that predates versioning."""
+    with engine.connect() as conn:
+        try:
+            return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+        except ProgrammingError:
+            return 0
+
+
+def pending_migrations(version: int | None = None) -> list[tuple]:
+    version = current_version() if version is None else version
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def migrate() -> list[int]:
+    """Apply pending migrations in order; returns the versions applied."""
+    applied = []
+    with engine.connect() as conn:
+        # Backfills run long and the lock below waits for any other migrating
+        # process; the engine's lock/statement timeouts are for the bot's queries
+        conn.execute(text("SET lock_timeout = 0"))
+        conn.execute(text("SET statement_timeout = 0"))
+        conn.execute(text("SELECT pg_advisory_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        conn.commit()
+        try:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description VARCHAR NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+                )
+            """))
+            conn.commit()
+            # Re-read under the lock: another process may have just migrated
+            version = conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+            conn.commit()
+            for number, description, apply in pending_migrations(version):
+                logger.info(f"Applying migration {number}: {description}")
+                apply(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                    {"version": number, "description": description},
+                )
+                conn.commit()
+                applied.append(number)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+            # Back to the engine's limits before the connection returns to the pool
+            conn.execute(text("RESET lock_timeout"))
+            conn.execute(text("RESET statement_timeout"))
+            conn.commit()
+    return applied
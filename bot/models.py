@@ -2,7 +2,8 @@
 SQLAlchemy database models.
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, Boolean, Text, ForeignKey, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -134,7 +135,7 @@ class WireGuardConfig(Base):
     user_telegram_id = Column(String, index=True, nullable=False)
     plan_name = Column(String, nullable=True)
     plan_id = Column(Integer, nullable=True)
-    server_id = Column(Integer, nullable=True)  # No FK until servers table exists
+    server_id = Column(Integer, nullable=True, index=True)  # No FK until servers table exists
     representative_id = Column(Integer, nullable=True)
     private_key = Column(Text, nullable=False)
     public_key = Column(Text, nullable=False)
@@ -151,6 +152,9 @@ class WireGuardConfig(Base):
     duration_days = Column(Integer, nullable=True)
     traffic_limit_gb = Column(Float, nullable=True)
     renewed_at = Column(DateTime, nullable=True)
+    # Resolved from the config's and its plan's limits; see services/config_limits.py
+    effective_expires_at = Column(DateTime, nullable=True)
+    traffic_limit_bytes = Column(BigInteger, nullable=True)
     cumulative_rx_bytes = Column(BigInteger, default=0)
     cumulative_tx_bytes = Column(BigInteger, default=0)
     last_rx_counter = Column(BigInteger, default=0)
@@ -161,6 +165,62 @@ class WireGuardConfig(Base):
     threshold_alert_sent = Column(Boolean, default=False)
 
 
+class IpAllocation(Base):
+    """One client address of a server's pool; status is free / assigned / external / retired."""
+    __tablename__ = "ip_allocations"
+    __table_args__ = (UniqueConstraint("server_id", "address", name="uq_ip_allocations_server_address"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, nullable=False, index=True)
+    address = Column(String, nullable=False)
+    status = Column(String, default="free", nullable=False)
+    config_id = Column(Integer, nullable=True, index=True)
+    allocated_at = Column(DateTime, nullable=True)
+
+
+class PeerSlot(Base):
+    """A peer pre-added (disabled) on a server's router, waiting to be claimed by a new account."""
+    __tablename__ = "peer_slots"
+
+    id = Column(Integer, primary_key=True, index=True)
+    server_id = Column(Integer, nullable=False, index=True)
+    wg_interface = Column(String, nullable=False)
+    client_ip = Column(String, nullable=False)
+    private_key = Column(String, nullable=False)
+    public_key = Column(String, nullable=False)
+    peer_id = Column(String, nullable=False)
+    status = Column(String, default="ready", nullable=False)  # ready / claimed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+
+
+class ConfigArtifact(Base):
+    """Telegram file_id of a config file or QR code already uploaded for a config's current content."""
+    __tablename__ = "config_artifacts"
+    __table_args__ = (UniqueConstraint("config_id", "kind", "content_hash", name="uq_config_artifacts_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    config_id = Column(Integer, nullable=False, index=True)
+    kind = Column(String, nullable=False)  # conf / qr
+    content_hash = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class UsageSample(Base):
+    """Traffic of one server's configs during one time bucket, as parallel arrays (only configs that moved)."""
+    __tablename__ = "usage_samples"
+    __table_args__ = (UniqueConstraint("resolution", "bucket_start", "server_id", name="uq_usage_samples_bucket"),)
+
+    id = Column(BigInteger, primary_key=True)
+    server_id = Column(Integer, nullable=False)
+    resolution = Column(String, nullable=False)  # 5m / 1h / 1d
+    bucket_start = Column(DateTime, nullable=False)
+    config_ids = Column(ARRAY(Integer), nullable=False)
+    rx_bytes = Column(ARRAY(BigInteger), nullable=False)
+    tx_bytes = Column(ARRAY(BigInteger), nullable=False)
+
+
 class GiftCode(Base):
     __tablename__ = "gift_codes"
 
@@ -0,0 +1,99 @@
+"""
+Per-user access flags (blocked, admin, organization customer, channel member)
+cached in process.
+
+The is_blocked guard in callback_handler runs for every non-admin update, and
+is the most frequent query the bot issues. Flags are kept in a bounded LRU
+(ACCESS_CACHE_SIZE entries) for ACCESS_CACHE_TTL seconds. Handlers that change
+a flag call invalidate(); the TTL bounds staleness for writes made outside this
+process (other bot instances, import scripts). Unknown telegram ids are cached
+too, as exists=False, and invalidated when the user is created.
+"""
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from config import ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL
+from models import User
+
+
+class AccessState:
+    __slots__ = ("exists", "blocked", "admin", "org_customer", "member")
+
+    def __init__(self, exists=False, blocked=False, admin=False, org_customer=False, member=False):
+        self.exists = exists
+        self.blocked = bool(blocked)
+        self.admin = bool(admin)
+        self.org_customer = bool(org_customer)
+        self.member = bool(member)
+
+
+_ACCESS_COLUMNS = (User.is_blocked, User.is_admin, User.is_organization_customer, User.is_member)
+
+
+class AccessCache:
+    def __init__(self, max_size: int = ACCESS_CACHE_SIZE, ttl: float = ACCESS_CACHE_TTL):
+        self.max_size = max(max_size, 0)
+        self.ttl = ttl
+        # telegram_id -> (expires_at, AccessState), least recently used first
+        self._entries: OrderedDict[str, tuple[float, AccessState]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id) -> AccessState | None:
+        key = str(telegram_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, telegram_id, state: AccessState):
+        if self.max_size == 0:
+            return
+        key = str(telegram_id)
+        self._entries[key] = (time.monotonic() + self.ttl, state)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, telegram_id):
+        if self._entries.pop(str(telegram_id), None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    async def lookup(self, session, telegram_id) -> AccessState:
+        """Cached flags of `telegram_id`, loaded through the AsyncSession on a miss."""
+        state = self.get(telegram_id)
+        if state is None:
+            row = (await session.execute(
+                select(*_ACCESS_COLUMNS).where(User.telegram_id == str(telegram_id))
+            )).first()
+            state = AccessState(True, *row) if row else AccessState()
+            self.put(telegram_id, state)
+        return state
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+access_cache = AccessCache()
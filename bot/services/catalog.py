@@ -0,0 +1,115 @@
+"""
+In-memory snapshot of the sales catalog: plans, service types, servers and
+plan-server mappings, plus the keyboards built from them.
+
+Browsing the catalog (buy menu, admin plan / service type / server menus) reads
+catalog_cache.get() and needs no database round trip. Admin handlers that change
+any of these tables call catalog_cache.invalidate() after committing; the next
+get() loads a fresh snapshot (four small queries) under a new version. Snapshot
+rows are detached ORM objects: read their columns, never relationships, and never
+hand them to a session.
+"""
+import logging
+
+from sqlalchemy import func
+
+from database import SessionLocal
+from keyboards import get_buy_keyboard, get_plans_keyboard, get_servers_service_type_keyboard, get_service_types_keyboard
+from models import Plan, PlanServerMap, Server, ServiceType, WireGuardConfig
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot:
+    def __init__(self, version: int, plans, service_types, servers, mappings):
+        self.version = version
+        self.plans = tuple(plans)
+        self.active_plans = tuple(plan for plan in self.plans if plan.is_active)
+        self.plans_by_id = {plan.id: plan for plan in self.plans}
+        self.service_types = tuple(service_types)
+        self.active_service_types = tuple(st for st in self.service_types if st.is_active)
+        self.servers = tuple(servers)
+        self.servers_by_id = {server.id: server for server in self.servers}
+        self.plan_server_ids: dict[int, tuple[int, ...]] = {}
+        for plan_id, server_id in mappings:
+            self.plan_server_ids[plan_id] = self.plan_server_ids.get(plan_id, ()) + (server_id,)
+
+        self.buy_keyboard = get_buy_keyboard(self.active_plans)
+        self.plans_keyboard = get_plans_keyboard(self.plans)
+        self.service_types_keyboard = get_service_types_keyboard(self.service_types)
+        self.servers_service_type_keyboard = get_servers_service_type_keyboard(self.active_service_types)
+
+    def active_plan(self, plan_id: int):
+        plan = self.plans_by_id.get(plan_id)
+        return plan if plan and plan.is_active else None
+
+    def plan_servers(self, plan_id: int) -> list:
+        """Active servers mapped to a plan (get_plan_servers without the query)."""
+        servers = (self.servers_by_id.get(server_id) for server_id in self.plan_server_ids.get(plan_id, ()))
+        return [server for server in servers if server and server.is_active]
+
+
+class CatalogCache:
+    def __init__(self):
+        self._snapshot: CatalogSnapshot | None = None
+        self.version = 0
+        self.hits = 0
+        self.builds = 0
+
+    def get(self) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            self.hits += 1
+            return snapshot
+        return self._build()
+
+    def invalidate(self):
+        """Call after committing any change to plans, service types, servers or plan-server mappings."""
+        self.version += 1
+
+    def _build(self) -> CatalogSnapshot:
+        version = self.version
+        db = SessionLocal()
+        try:
+            plans = db.query(Plan).order_by(Plan.id).all()
+            service_types = db.query(ServiceType).order_by(ServiceType.id).all()
+            servers = db.query(Server).order_by(Server.id).all()
+            mappings = db.query(PlanServerMap.plan_id, PlanServerMap.server_id).order_by(PlanServerMap.id).all()
+            db.expunge_all()
+        finally:
+            db.close()
+        snapshot = CatalogSnapshot(version, plans, service_types, servers, mappings)
+        self._snapshot = snapshot
+        self.builds += 1
+        logger.info(f"Catalog snapshot v{version}: {len(plans)} plans, {len(servers)} servers, {len(mappings)} mappings")
+        return snapshot
+
+    def available_servers(self, db, plan_id: int) -> list:
+        """
+        get_available_servers_for_plan on the snapshot: the plan's active servers
+        below capacity. Only servers with a capacity cost a (single, grouped) query.
+        """
+        servers = self.get().plan_servers(plan_id)
+        capped = [server.id for server in servers if (server.capacity or 0) > 0]
+        if not capped:
+            return servers
+        active_counts = dict(
+            db.query(WireGuardConfig.server_id, func.count(WireGuardConfig.id))
+            .filter(WireGuardConfig.server_id.in_(capped), WireGuardConfig.status == "active")
+            .group_by(WireGuardConfig.server_id)
+            .all()
+        )
+        return [
+            server for server in servers
+            if (server.capacity or 0) <= 0 or active_counts.get(server.id, 0) < server.capacity
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "builds": self.builds,
+        }
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,66 @@
+"""
+Rendered config artifacts (.conf document, QR code) and their Telegram file_ids.
+
+An artifact is keyed by config id, kind and a hash of the config text. After
+the first upload Telegram's file_id is stored and later sends reuse it, so
+sending the same config again costs no upload and no QR render.
+"""
+import hashlib
+import logging
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import SessionLocal
+from models import ConfigArtifact
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(config_text: str) -> str:
+    return hashlib.sha256((config_text or "").encode("utf-8")).hexdigest()[:32]
+
+
+def get_file_id(config_id: int, kind: str, digest: str) -> str | None:
+    if config_id is None:
+        return None
+    db = SessionLocal()
+    try:
+        row = db.query(ConfigArtifact.file_id).filter(
+            ConfigArtifact.config_id == config_id,
+            ConfigArtifact.kind == kind,
+            ConfigArtifact.content_hash == digest,
+        ).first()
+        return row[0] if row else None
+    finally:
+        db.close()
+
+
+def store_file_id(config_id: int, kind: str, digest: str, file_id: str):
+    if config_id is None or not file_id:
+        return
+    db = SessionLocal()
+    try:
+        db.execute(
+            pg_insert(ConfigArtifact.__table__)
+            .values(config_id=config_id, kind=kind, content_hash=digest, file_id=file_id)
+            .on_conflict_do_update(constraint="uq_config_artifacts_key", set_={"file_id": file_id})
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to store {kind} file_id for config {config_id}: {e}")
+    finally:
+        db.close()
+
+
+def forget_config(config_id: int, db=None):
+    """Drop cached artifacts of a deleted config. Pass db to do it inside the caller's transaction."""
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        db.query(ConfigArtifact).filter(ConfigArtifact.config_id == config_id).delete(synchronize_session=False)
+        if own_session:
+            db.commit()
+    finally:
+        if own_session:
+            db.close()
@@ -0,0 +1,118 @@
+"""
+Effective expiry and traffic quota stored on each config.
+
+A config's limits come from its own duration_days / traffic_limit_gb, falling
+back to its plan's. They are resolved into effective_expires_at and
+traffic_limit_bytes (NULL = no limit) so the workers can select due rows with
+one indexed query instead of loading every active config plus its plan.
+
+Call refresh_effective_limits() in the same transaction that edits a config's
+limits or a plan. For display code that needs the full picture (duration,
+GB, consumed, remaining) use resolve_config_limits(), which loads the plans of
+a whole list of configs with a single query.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, literal_column, or_, text
+
+from models import Plan, WireGuardConfig
+
+GIB = 1024 ** 3
+
+# Must match the expression of ix_wireguard_configs_active_remaining for the index to be used
+REMAINING_BYTES_SQL = "(traffic_limit_bytes - COALESCE(cumulative_rx_bytes, 0) - COALESCE(cumulative_tx_bytes, 0))"
+
+_REFRESH_SQL = """
+    UPDATE wireguard_configs wc SET
+        effective_expires_at = lim.effective_expires_at,
+        traffic_limit_bytes = lim.traffic_limit_bytes
+    FROM (
+        SELECT c.id,
+            CASE
+                WHEN c.expires_at IS NOT NULL THEN c.expires_at
+                WHEN COALESCE(c.duration_days, p.duration_days, 0) > 0
+                    THEN c.created_at + make_interval(days => COALESCE(c.duration_days, p.duration_days))
+            END AS effective_expires_at,
+            CASE
+                WHEN COALESCE(c.traffic_limit_gb, p.traffic_gb, 0) > 0
+                    THEN FLOOR(COALESCE(c.traffic_limit_gb, p.traffic_gb) * 1073741824)::BIGINT
+            END AS traffic_limit_bytes
+        FROM wireguard_configs c
+        LEFT JOIN plans p ON p.id = c.plan_id
+        WHERE {where}
+    ) lim
+    WHERE wc.id = lim.id AND (
+        wc.effective_expires_at IS DISTINCT FROM lim.effective_expires_at
+        OR wc.traffic_limit_bytes IS DISTINCT FROM lim.traffic_limit_bytes
+    )
+"""
+
+
+def refresh_effective_limits(db, config_ids=None, plan_ids=None) -> int:
+    """Recompute effective limits of the given configs, of every config on the given plans, or of all configs."""
+    if config_ids is not None:
+        where, params = "c.id = ANY(:ids)", {"ids": list(config_ids)}
+    elif plan_ids is not None:
+        where, params = "c.plan_id = ANY(:ids)", {"ids": list(plan_ids)}
+    else:
+        where, params = "TRUE", {}
+    return db.execute(text(_REFRESH_SQL.format(where=where)), params).rowcount
+
+
+def remaining_bytes():
+    return literal_column(REMAINING_BYTES_SQL)
+
+
+def is_due(now: datetime):
+    """SQL predicate: expired or over quota."""
+    return or_(WireGuardConfig.effective_expires_at <= now, remaining_bytes() <= 0)
+
+
+def is_near_limit(now: datetime, bytes_left: int = GIB, time_left: timedelta = timedelta(days=1)):
+    """SQL predicate: within bytes_left of the quota, or expiring within time_left."""
+    return or_(
+        remaining_bytes() <= bytes_left,
+        and_(WireGuardConfig.effective_expires_at >= now, WireGuardConfig.effective_expires_at <= now + time_left),
+    )
+
+
+def config_is_due(config: WireGuardConfig, now: datetime, consumed: int | None = None) -> bool:
+    """In-memory twin of is_due(); pass consumed when the counters were just recomputed but not stored."""
+    if config.effective_expires_at is not None and config.effective_expires_at <= now:
+        return True
+    if consumed is None:
+        consumed = (config.cumulative_rx_bytes or 0) + (config.cumulative_tx_bytes or 0)
+    return config.traffic_limit_bytes is not None and consumed >= config.traffic_limit_bytes
+
+
+def load_plans(db, configs) -> dict[int, Plan]:
+    """Plans of the given configs keyed by id, in one query."""
+    plan_ids = {config.plan_id for config in configs if config.plan_id}
+    if not plan_ids:
+        return {}
+    return {plan.id: plan for plan in db.query(Plan).filter(Plan.id.in_(plan_ids)).all()}
+
+
+def config_limits(config: WireGuardConfig, plan: Plan | None) -> dict:
+    """Effective limits of one config; plan must be the config's plan (or None)."""
+    duration_days = config.duration_days if config.duration_days is not None else (plan.duration_days if plan else None)
+    traffic_limit_gb = config.traffic_limit_gb if config.traffic_limit_gb is not None else (plan.traffic_gb if plan else None)
+    expires_at = config.expires_at
+    if not expires_at and duration_days:
+        expires_at = config.created_at + timedelta(days=duration_days)
+    limit_bytes = int(traffic_limit_gb * GIB) if traffic_limit_gb else 0
+    consumed_bytes = int((config.cumulative_rx_bytes or 0) + (config.cumulative_tx_bytes or 0))
+    return {
+        "duration_days": duration_days,
+        "traffic_limit_gb": traffic_limit_gb,
+        "expires_at": expires_at,
+        "limit_bytes": limit_bytes,
+        "consumed_bytes": consumed_bytes,
+        "remaining_bytes": max(limit_bytes - consumed_bytes, 0) if limit_bytes else 0,
+    }
+
+
+def resolve_config_limits(db, configs) -> dict[int, dict]:
+    """config_limits() for every config, keyed by config id, batch-loading their plans."""
+    plans = load_plans(db, configs)
+    return {config.id: config_limits(config, plans.get(config.plan_id)) for config in configs}
@@ -0,0 +1,272 @@
+"""
+Per-server client address allocation backed by the ip_allocations table.
+
+A server's pool is its network base address plus a range of host offsets
+(wg_ip_range_start..wg_ip_range_end). Offsets are plain integers on top of
+the base address, so the same code covers a legacy /24 (offset == last
+octet), a /16 or a slice of an IPv6 /64.
+
+Every address of a server's pool has one row. Allocation pops the first free
+row with SELECT ... FOR UPDATE SKIP LOCKED, so parallel purchases never get
+the same address, and the unique (server_id, address) constraint backs that
+up. Deleting a config releases its row back to the pool.
+"""
+import ipaddress
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import IP_POOL_MAX_SIZE
+from database import SessionLocal
+from models import IpAllocation
+
+logger = logging.getLogger(__name__)
+
+# Rows reserved by a purchase that never saved its config are reclaimed after this
+RESERVATION_TIMEOUT = timedelta(minutes=10)
+
+# Rows inserted per statement while seeding a pool
+SEED_BATCH_SIZE = 5000
+
+# server_id -> pool signature already seeded by this process
+_seeded_pools: dict[int, tuple] = {}
+
+
+def canonical_ip(value: str) -> str:
+    """Normalize an address (optionally with /prefix) to ipaddress' text form; returns "" if invalid."""
+    text_value = (value or "").split(",")[0].split("/")[0].strip()
+    try:
+        return str(ipaddress.ip_address(text_value))
+    except ValueError:
+        return ""
+
+
+def network_base_address(network_base: str):
+    """Base address of a pool from the stored value: CIDR, plain IP, legacy 3-octet prefix or a-b range."""
+    raw_base = (network_base or "").strip()
+    if "-" in raw_base and "/" not in raw_base:
+        raw_base = raw_base.split("-", 1)[0].strip()
+    if "/" in raw_base:
+        return ipaddress.ip_network(raw_base, strict=False).network_address
+    if raw_base.count(".") == 2:
+        # Backward compatibility for values like "192.168.30"
+        raw_base = f"{raw_base}.0"
+    return ipaddress.ip_address(raw_base)
+
+
+def offset_address(base, offset: int) -> str:
+    """Address `offset` hosts above `base`, keeping its IP version."""
+    return str(type(base)(int(base) + offset))
+
+
+def pool_addresses(network_base: str, start: int, end: int) -> list[str]:
+    base = network_base_address(network_base)
+    return [offset_address(base, offset) for offset in range(start, end + 1)]
+
+
+def parse_ip_pool(value: str) -> dict | None:
+    """
+    Parse admin input for a server's client pool.
+
+    Accepts CIDR (10.8.0.0/16, fd00::/64), a range (10.8.0.10-10.8.3.200,
+    192.168.30.10-220, fd00::10-fd00::ffff) or a bare /24 base IP. Returns the
+    base address with start/end host offsets, or None when invalid or larger
+    than IP_POOL_MAX_SIZE. IPv6 prefixes are the exception: they are cut down
+    to their first IP_POOL_MAX_SIZE hosts.
+    """
+    value = (value or "").strip()
+    try:
+        if "/" in value:
+            network = ipaddress.ip_network(value, strict=False)
+            if network.version == 4 and network.prefixlen <= 30:
+                # Skip network and broadcast addresses
+                start, end = 1, network.num_addresses - 2
+            else:
+                start, end = (1 if network.num_addresses > 1 else 0), network.num_addresses - 1
+            if network.version == 6:
+                # An IPv6 prefix is only ever used from its first IP_POOL_MAX_SIZE hosts
+                end = min(end, start + IP_POOL_MAX_SIZE - 1)
+            base = network.network_address
+            cidr = network.prefixlen
+            is_range = False
+        elif "-" in value:
+            left, right = [part.strip() for part in value.split("-", 1)]
+            first = ipaddress.ip_address(left)
+            if first.version == 4 and "." not in right:
+                # Short form: 192.168.30.10-220
+                right = left.rsplit(".", 1)[0] + "." + right
+            last = ipaddress.ip_address(right)
+            if first.version != last.version or last < first:
+                return None
+            # Smallest network containing the whole range
+            prefixlen = first.max_prefixlen
+            network = ipaddress.ip_network(f"{first}/{prefixlen}", strict=False)
+            while last not in network:
+                prefixlen -= 1
+                network = ipaddress.ip_network(f"{first}/{prefixlen}", strict=False)
+            base = network.network_address
+            start = int(first) - int(base)
+            end = int(last) - int(base)
+            cidr = None
+            is_range = True
+        else:
+            address = ipaddress.ip_address(value)
+            if address.version != 4:
+                return None
+            base = ipaddress.ip_network(f"{address}/24", strict=False).network_address
+            start, end = 1, 254
+            cidr = 24
+            is_range = False
+    except ValueError:
+        return None
+
+    if start < 1 or end < start or end - start + 1 > IP_POOL_MAX_SIZE:
+        return None
+    return {
+        "base_ip": str(base),
+        "start_ip": offset_address(base, start),
+        "end_ip": offset_address(base, end),
+        "cidr": cidr,
+        "is_range": is_range,
+        "start_offset": start,
+        "end_offset": end,
+    }
+
+
+def _seed_pool(db, server_id: int, addresses: list[str]):
+    """Create rows for the pool's addresses and reconcile them with existing configs."""
+    for chunk_start in range(0, len(addresses), SEED_BATCH_SIZE):
+        db.execute(
+            pg_insert(IpAllocation.__table__)
+            .values([
+                {"server_id": server_id, "address": address, "status": "free"}
+                for address in addresses[chunk_start:chunk_start + SEED_BATCH_SIZE]
+            ])
+            .on_conflict_do_nothing(index_elements=["server_id", "address"])
+        )
+
+    params = {"server_id": server_id, "addresses": addresses}
+    # Addresses dropped from the pool (range was narrowed) must not be handed out
+    db.execute(text("""
+        UPDATE ip_allocations SET status = 'retired'
+        WHERE server_id = :server_id AND status = 'free' AND NOT (address = ANY(:addresses))
+    """), params)
+    db.execute(text("""
+        UPDATE ip_allocations SET status = 'free'
+        WHERE server_id = :server_id AND status IN ('retired', 'external') AND address = ANY(:addresses)
+    """), params)
+    # Free rows whose config is gone or whose reservation was abandoned
+    # (addresses held by pre-provisioned peer slots stay reserved)
+    db.execute(text("""
+        UPDATE ip_allocations ia SET status = 'free', config_id = NULL, allocated_at = NULL
+        WHERE ia.server_id = :server_id AND ia.status = 'assigned' AND (
+            (ia.config_id IS NULL AND ia.allocated_at < :stale_before
+             AND NOT EXISTS (SELECT 1 FROM peer_slots ps WHERE ps.server_id = ia.server_id AND ps.client_ip = ia.address))
+            OR (ia.config_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM wireguard_configs wc WHERE wc.id = ia.config_id))
+        )
+    """), {**params, "stale_before": datetime.utcnow() - RESERVATION_TIMEOUT})
+    # Addresses already used by existing configs
+    db.execute(text("""
+        UPDATE ip_allocations ia SET status = 'assigned', config_id = wc.id, allocated_at = COALESCE(ia.allocated_at, wc.created_at)
+        FROM wireguard_configs wc
+        WHERE ia.server_id = :server_id AND wc.server_id = :server_id
+          AND wc.client_ip = ia.address AND ia.config_id IS DISTINCT FROM wc.id
+    """), params)
+
+
+def ensure_pool(server_id: int, network_base: str, start: int, end: int):
+    """Seed a server's pool once per process, or again when its base or range changed."""
+    signature = (str(network_base_address(network_base)), start, end)
+    if _seeded_pools.get(server_id) == signature:
+        return
+
+    db = SessionLocal()
+    try:
+        _seed_pool(db, server_id, pool_addresses(network_base, start, end))
+        db.commit()
+        _seeded_pools[server_id] = signature
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def allocate_ip(server_id: int, network_base: str, start: int, end: int, used_on_router: set[str] | None = None) -> str | None:
+    """
+    Reserve the first free address of a server's pool.
+
+    Addresses already present on the router (peers not known to the DB) are
+    marked external and skipped. The reservation must be bound to the saved
+    config with bind_ip() or given back with release_ip().
+    """
+    ensure_pool(server_id, network_base, start, end)
+    used_on_router = used_on_router or set()
+
+    db = SessionLocal()
+    try:
+        while True:
+            row = (
+                db.query(IpAllocation)
+                .filter(IpAllocation.server_id == server_id, IpAllocation.status == "free")
+                .order_by(IpAllocation.id)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if row is None:
+                db.commit()
+                return None
+            if row.address in used_on_router:
+                row.status = "external"
+                db.flush()
+                continue
+            row.status = "assigned"
+            row.config_id = None
+            row.allocated_at = datetime.utcnow()
+            db.commit()
+            return row.address
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def bind_ip(server_id: int, address: str, config_id: int):
+    db = SessionLocal()
+    try:
+        db.query(IpAllocation).filter(
+            IpAllocation.server_id == server_id,
+            IpAllocation.address == address,
+        ).update({"status": "assigned", "config_id": config_id}, synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to bind IP {address} to config {config_id}: {e}")
+    finally:
+        db.close()
+
+
+def release_ip(server_id: int, address: str, db=None):
+    """Return an address to the free pool. Pass db to release inside the caller's transaction."""
+    if server_id is None or not address:
+        return
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        db.query(IpAllocation).filter(
+            IpAllocation.server_id == server_id,
+            IpAllocation.address == address,
+            IpAllocation.status == "assigned",
+        ).update({"status": "free", "config_id": None, "allocated_at": None}, synchronize_session=False)
+        if own_session:
+            db.commit()
+    except Exception as e:
+        if own_session:
+            db.rollback()
+        logger.error(f"Failed to release IP {address} on server {server_id}: {e}")
+    finally:
+        if own_session:
+            db.close()
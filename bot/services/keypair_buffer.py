@@ -0,0 +1,103 @@
+"""
+Buffer of pre-generated WireGuard (X25519) keypairs.
+
+Account creation takes a ready keypair instead of generating one on the event
+loop. When the buffer drops below KEYPAIR_BUFFER_LOW_WATERMARK a background
+thread refills it up to KEYPAIR_BUFFER_SIZE; an empty buffer falls back to
+generating inline, which is counted as a miss.
+"""
+import base64
+import logging
+import threading
+from collections import deque
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+
+from config import KEYPAIR_BUFFER_LOW_WATERMARK, KEYPAIR_BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def generate_keypairs(count: int) -> list[tuple[str, str]]:
+    """Generate `count` base64 (public_key, private_key) pairs."""
+    keypairs = []
+    for _ in range(count):
+        private = x25519.X25519PrivateKey.generate()
+        private_bytes = private.private_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PrivateFormat.Raw,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        public_bytes = private.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw,
+        )
+        keypairs.append((base64.b64encode(public_bytes).decode("ascii"), base64.b64encode(private_bytes).decode("ascii")))
+    return keypairs
+
+
+class KeypairBuffer:
+    def __init__(self, capacity: int = KEYPAIR_BUFFER_SIZE, low_watermark: int = KEYPAIR_BUFFER_LOW_WATERMARK):
+        self.capacity = max(capacity, 0)
+        self.low_watermark = min(max(low_watermark, 0), self.capacity)
+        self._keypairs: deque[tuple[str, str]] = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+
+    def take(self) -> tuple[str, str]:
+        """Return one (public_key, private_key) pair."""
+        return self.take_many(1)[0]
+
+    def take_many(self, count: int) -> list[tuple[str, str]]:
+        """Return `count` keypairs: buffered ones first, the shortfall generated in one batch."""
+        with self._lock:
+            taken = [self._keypairs.popleft() for _ in range(min(count, len(self._keypairs)))]
+            self.hits += len(taken)
+            self.misses += count - len(taken)
+        if len(taken) < count:
+            taken.extend(generate_keypairs(count - len(taken)))
+        self.refill_if_low()
+        return taken
+
+    def refill_if_low(self):
+        """Start a background refill when the buffer is below its low watermark."""
+        with self._lock:
+            if self._refilling or self.capacity == 0 or len(self._keypairs) > self.low_watermark:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, name="keypair-buffer-refill", daemon=True).start()
+
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    missing = self.capacity - len(self._keypairs)
+                if missing <= 0:
+                    break
+                keypairs = generate_keypairs(min(missing, 16))
+                with self._lock:
+                    self._keypairs.extend(keypairs[:self.capacity - len(self._keypairs)])
+            self.refills += 1
+        except Exception as e:
+            logger.error(f"Keypair buffer refill failed: {e}")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._keypairs),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "refills": self.refills,
+        }
+
+
+keypair_buffer = KeypairBuffer()
@@ -1,17 +1,49 @@
 import asyncio
 import sys
+import time
 from datetime import datetime, timedelta
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
 
+from config import (
+    PEER_SLOT_POOL_SIZE,
+    PEER_SLOT_REFILL_INTERVAL,
+    TEST_CLEANUP_INTERVAL,
+    THRESHOLD_CHECK_INTERVAL,
+    USAGE_SYNC_CONCURRENCY,
+    USAGE_SYNC_ROUTER_DEADLINE,
+)
 from database import SessionLocal
+from services.access_cache import access_cache
+from services.config_artifacts import forget_config
+from services.config_limits import is_due, is_near_limit
+from services.ip_allocator import release_ip
+from services.keypair_buffer import keypair_buffer
+from services.peer_index import peer_id_index
+from services.peer_slots import refill_requested
+from services.plan_service import _normalize_ip_pool
+from services.sync_scheduler import SyncScheduler
+from services.usage_accumulator import usage_accumulator
+from services.usage_history import usage_history
 from models import Server, ServiceType, WireGuardConfig, Plan
-from wireguard import sync_wireguard_usage_counters, disable_expired_or_exhausted_configs, delete_wireguard_peer
+from wireguard import sync_and_enforce_wireguard_usage, apply_peer_operations_by_server, refill_peer_slots
 
 ONE_GB_IN_BYTES = 1 * (1024 ** 3)
 TEST_ACCOUNT_PLAN_NAME = "اکانت تست"
 
+# Seconds between usage sync summary lines
+USAGE_SYNC_REPORT_INTERVAL = 60
+# Longest sleep of the usage sync worker, so added or removed routers are noticed
+USAGE_SYNC_TICK = 5
+
+# server_id -> outcome of the router's latest usage sync
+last_usage_sync_report: dict[int, dict] = {}
+# Decides when each router is synced; metrics() has the queue depth and lag
+usage_sync_scheduler = SyncScheduler()
+# Totals since the last summary line
+_usage_sync_totals = {"syncs": 0, "failed": 0, "scanned": 0, "changed": 0, "buffered": 0, "flushed": 0}
+
 
 def _get_wireguard_servers(db):
     wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
@@ -27,21 +59,18 @@ async def notify_plan_thresholds_worker(bot: Bot):
     while True:
         db = SessionLocal()
         try:
-            now = datetime.now()
-            configs = db.query(WireGuardConfig).filter(WireGuardConfig.status == "active").all()
+            now = datetime.utcnow()
+            # Only rows within 1 GB / 1 day of their limits (partial indexes on active rows)
+            configs = db.query(WireGuardConfig).filter(
+                WireGuardConfig.status == "active",
+                WireGuardConfig.threshold_alert_sent.isnot(True),
+                is_near_limit(now, bytes_left=ONE_GB_IN_BYTES),
+            ).all()
             for config in configs:
-                plan = db.query(Plan).filter(Plan.id == config.plan_id).first() if config.plan_id else None
-                duration_days = config.duration_days if config.duration_days is not None else (plan.duration_days if plan else None)
-                traffic_limit_gb = config.traffic_limit_gb if config.traffic_limit_gb is not None else (plan.traffic_gb if plan else None)
-                if not duration_days and not traffic_limit_gb:
-                    continue
-
-                expires_at = config.expires_at or (config.created_at + timedelta(days=(duration_days or 0)))
-                plan_traffic_bytes = (traffic_limit_gb or 0) * (1024 ** 3)
                 consumed_bytes = (config.cumulative_rx_bytes or 0) + (config.cumulative_tx_bytes or 0)
-                remaining_bytes = max(plan_traffic_bytes - consumed_bytes, 0)
+                low_traffic = config.traffic_limit_bytes is not None and config.traffic_limit_bytes - consumed_bytes <= ONE_GB_IN_BYTES
 
-                if not config.threshold_alert_sent and remaining_bytes <= ONE_GB_IN_BYTES:
+                if not config.threshold_alert_sent and low_traffic:
                     try:
                         await bot.send_message(
                             chat_id=int(config.user_telegram_id),
@@ -57,8 +86,8 @@ async def notify_plan_thresholds_worker(bot: Bot):
                     except Exception as e:
                         print(f"Low traffic notify failed for {config.user_telegram_id}: {e}", file=sys.stderr)
 
-                days_left = (expires_at - now).total_seconds() / 86400
-                if not config.threshold_alert_sent and 0 <= days_left <= 1:
+                expires_soon = config.effective_expires_at is not None and now <= config.effective_expires_at <= now + timedelta(days=1)
+                if not config.threshold_alert_sent and expires_soon:
                     try:
                         await bot.send_message(
                             chat_id=int(config.user_telegram_id),
@@ -81,50 +110,45 @@ async def notify_plan_thresholds_worker(bot: Bot):
         finally:
             db.close()
 
-        await asyncio.sleep(180)
+        await asyncio.sleep(THRESHOLD_CHECK_INTERVAL)
 
 
 async def cleanup_expired_test_accounts_worker(bot: Bot):
     while True:
         db = SessionLocal()
         try:
-            now = datetime.now()
+            now = datetime.utcnow()
             test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
             if not test_plan:
-                await asyncio.sleep(180)
+                await asyncio.sleep(TEST_CLEANUP_INTERVAL)
                 continue
 
-            configs = db.query(WireGuardConfig).filter(
+            due_configs = db.query(WireGuardConfig).filter(
                 WireGuardConfig.status.in_(["active", "expired"]),
                 WireGuardConfig.plan_id == test_plan.id,
+                is_due(now),
             ).all()
 
-            for config in configs:
-                expires_at = config.expires_at or (config.created_at + timedelta(days=test_plan.duration_days))
-                traffic_limit_gb = config.traffic_limit_gb if config.traffic_limit_gb is not None else (test_plan.traffic_gb or 0)
-                traffic_limit_bytes = traffic_limit_gb * (1024 ** 3)
-                consumed_bytes = (config.cumulative_rx_bytes or 0) + (config.cumulative_tx_bytes or 0)
-                is_expired = bool(expires_at and expires_at <= now)
-                is_exhausted = bool(traffic_limit_bytes and consumed_bytes >= traffic_limit_bytes)
-
-                if not (is_expired or is_exhausted):
-                    continue
-
-                try:
-                    server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
-                    if server:
-                        delete_wireguard_peer(
-                            mikrotik_host=server.host,
-                            mikrotik_user=server.username,
-                            mikrotik_pass=server.password,
-                            mikrotik_port=server.api_port,
-                            wg_interface=server.wg_interface,
-                            client_ip=config.client_ip,
-                        )
-                except Exception as e:
-                    print(f"Test account peer delete failed ({config.client_ip}): {e}", file=sys.stderr)
+            if due_configs:
+                # One pipelined batch of removals per router instead of a round trip per peer
+                server_ids = {config.server_id for config in due_configs if config.server_id}
+                servers = {
+                    server.id: server
+                    for server in db.query(Server).filter(Server.id.in_(server_ids), Server.is_active == True).all()
+                } if server_ids else {}
+                targets = [config for config in due_configs if config.server_id in servers]
+                results = await apply_peer_operations_by_server(
+                    servers,
+                    [{"server_id": config.server_id, "op": "remove", "client_ip": config.client_ip} for config in targets],
+                )
+                for config, result in zip(targets, results):
+                    if not result["ok"]:
+                        print(f"Test account peer delete failed ({config.client_ip}): {result['error']}", file=sys.stderr)
 
+            for config in due_configs:
                 user_tg_id = config.user_telegram_id
+                release_ip(config.server_id, config.client_ip, db=db)
+                forget_config(config.id, db=db)
                 db.delete(config)
                 db.commit()
 
@@ -141,31 +165,176 @@ async def cleanup_expired_test_accounts_worker(bot: Bot):
         finally:
             db.close()
 
-        await asyncio.sleep(180)
+        await asyncio.sleep(TEST_CLEANUP_INTERVAL)
+
+
+async def _sync_server(server, elapsed: float | None = None) -> dict:
+    """Sync and enforce one router within USAGE_SYNC_ROUTER_DEADLINE; never raises."""
+    started = time.monotonic()
+    try:
+        stats = await asyncio.wait_for(
+            sync_and_enforce_wireguard_usage(
+                mikrotik_host=server.host,
+                mikrotik_user=server.username,
+                mikrotik_pass=server.password,
+                mikrotik_port=server.api_port,
+                wg_interface=server.wg_interface,
+                server_id=server.id,
+                elapsed=elapsed,
+            ),
+            timeout=USAGE_SYNC_ROUTER_DEADLINE,
+        )
+        outcome = "ok" if stats is not None else "failed"
+    except asyncio.TimeoutError:
+        stats, outcome = None, "timeout"
+    except Exception as e:
+        stats, outcome = None, f"error: {e}"
+    return {
+        "server_id": server.id,
+        "server": server.name,
+        "outcome": outcome,
+        "duration": time.monotonic() - started,
+        "scanned": (stats or {}).get("scanned", 0),
+        "changed": (stats or {}).get("changed", 0),
+        "buffered": (stats or {}).get("buffered", 0),
+        "next_due_in": stats["next_due_in"] if stats is not None else None,
+    }
+
+
+async def _run_scheduled_sync(server, semaphore: asyncio.Semaphore):
+    item = None
+    try:
+        await usage_sync_scheduler.acquire()
+        async with semaphore:
+            item = await _sync_server(server, elapsed=usage_sync_scheduler.started(server.id))
+    finally:
+        usage_sync_scheduler.complete(server.id, item["next_due_in"] if item else None)
+
+    last_usage_sync_report[server.id] = item
+    _usage_sync_totals["syncs"] += 1
+    for key in ("scanned", "changed", "buffered"):
+        _usage_sync_totals[key] += item[key]
+    if item["outcome"] != "ok":
+        _usage_sync_totals["failed"] += 1
+        print(
+            f"Usage sync {item['server']} (#{item['server_id']}): {item['outcome']} after {item['duration']:.1f}s",
+            file=sys.stderr,
+        )
+
+
+def _print_usage_sync_summary():
+    metrics = usage_sync_scheduler.metrics()
+    totals = dict(_usage_sync_totals)
+    print(
+        f"Usage sync: {totals['syncs']} syncs ({totals['failed']} failed), "
+        f"{totals['changed']}/{totals['scanned']} rows written, {totals['buffered']} buffered, "
+        f"{totals['flushed']} flushed; {metrics['running']} running, queue {metrics['queue_depth']} "
+        f"(lag {metrics['queue_lag']:.1f}s) over {metrics['routers']} routers",
+        file=sys.stderr,
+    )
+    for key in _usage_sync_totals:
+        _usage_sync_totals[key] = 0
+
+
+def _print_cache_summary():
+    """Process-lifetime counters of the in-memory caches."""
+    keypairs = keypair_buffer.stats()
+    access = access_cache.stats()
+    peer_ids = peer_id_index.stats()
+    print(
+        f"Caches: keypairs {keypairs['size']}/{keypairs['capacity']} buffered, "
+        f"{keypairs['hit_rate']:.0%} hit rate ({keypairs['hits']} hits, {keypairs['misses']} misses, "
+        f"{keypairs['refills']} refills); access {access['size']}/{access['capacity']} users, "
+        f"{access['hit_rate']:.0%} hit rate ({access['hits']} hits, {access['misses']} misses, "
+        f"{access['evictions']} evicted, {access['invalidations']} invalidated); "
+        f"peer ids {peer_ids['entries']} on {peer_ids['routers']} routers "
+        f"({peer_ids['hits']} hits, {peer_ids['misses']} misses)",
+        file=sys.stderr,
+    )
 
 
 async def usage_sync_worker():
-    while True:
-        db = SessionLocal()
+    """Start each router's sync when the scheduler says it is due, at most USAGE_SYNC_CONCURRENCY at a time."""
+    semaphore = asyncio.Semaphore(max(USAGE_SYNC_CONCURRENCY, 1))
+    tasks: set[asyncio.Task] = set()
+    last_summary = time.monotonic()
+    try:
+        while True:
+            try:
+                db = SessionLocal()
+                try:
+                    servers = {server.id: server for server in _get_wireguard_servers(db)}
+                finally:
+                    db.close()
+                usage_sync_scheduler.track(servers)
+                for server_id in usage_sync_scheduler.take_due():
+                    task = asyncio.create_task(_run_scheduled_sync(servers[server_id], semaphore))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if usage_accumulator.flush_due():
+                    _usage_sync_totals["flushed"] += usage_accumulator.flush()
+                await usage_history.flush_async()
+                await usage_history.maintain_async()
+
+                if time.monotonic() - last_summary >= USAGE_SYNC_REPORT_INTERVAL:
+                    last_summary = time.monotonic()
+                    _print_usage_sync_summary()
+                    _print_cache_summary()
+            except Exception as e:
+                print(f"Usage sync worker error: {e}", file=sys.stderr)
+            await asyncio.sleep(min(usage_sync_scheduler.seconds_until_next(), USAGE_SYNC_TICK))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _refill_server_slots(server, semaphore: asyncio.Semaphore):
+    network_base, ip_range_start, ip_range_end = _normalize_ip_pool(server)
+    if not network_base:
+        return
+    async with semaphore:
         try:
-            servers = _get_wireguard_servers(db)
-            for server in servers:
-                sync_wireguard_usage_counters(
-                    mikrotik_host=server.host,
-                    mikrotik_user=server.username,
-                    mikrotik_pass=server.password,
-                    mikrotik_port=server.api_port,
-                    wg_interface=server.wg_interface,
-                )
-                disable_expired_or_exhausted_configs(
+            created = await asyncio.wait_for(
+                refill_peer_slots(
                     mikrotik_host=server.host,
                     mikrotik_user=server.username,
                     mikrotik_pass=server.password,
                     mikrotik_port=server.api_port,
                     wg_interface=server.wg_interface,
-                )
+                    wg_client_network_base=network_base,
+                    wg_ip_range_start=ip_range_start,
+                    wg_ip_range_end=ip_range_end,
+                    server_id=server.id,
+                    target=PEER_SLOT_POOL_SIZE,
+                ),
+                timeout=USAGE_SYNC_ROUTER_DEADLINE,
+            )
+            if created:
+                print(f"Peer slots: added {created} on {server.name} (#{server.id})", file=sys.stderr)
+        except asyncio.TimeoutError:
+            print(f"Peer slot refill timed out on {server.name} (#{server.id})", file=sys.stderr)
         except Exception as e:
-            print(f"Usage sync worker error: {e}", file=sys.stderr)
+            print(f"Peer slot refill failed on {server.name} (#{server.id}): {e}", file=sys.stderr)
+
+
+async def peer_slot_refill_worker():
+    """Keep PEER_SLOT_POOL_SIZE ready peers on every server; wakes early when a slot is claimed."""
+    if PEER_SLOT_POOL_SIZE <= 0:
+        return
+    while True:
+        refill_requested.clear()
+        db = SessionLocal()
+        try:
+            servers = _get_wireguard_servers(db)
+        except Exception as e:
+            servers = []
+            print(f"Peer slot worker error: {e}", file=sys.stderr)
         finally:
             db.close()
-        await asyncio.sleep(180)
+        semaphore = asyncio.Semaphore(max(USAGE_SYNC_CONCURRENCY, 1))
+        await asyncio.gather(*(_refill_server_slots(server, semaphore) for server in servers))
+        try:
+            await asyncio.wait_for(refill_requested.wait(), timeout=PEER_SLOT_REFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
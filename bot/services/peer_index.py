@@ -0,0 +1,78 @@
+"""
+In-memory index from peer identifiers to RouterOS `.id`, per router interface.
+
+Lets single-peer operations (disable/reset/delete) address a peer directly
+instead of listing the whole peer table to find it. The usage sync pass
+rebuilds a router's index from its peer dump; create/delete keep it current
+in between.
+"""
+from services.ip_allocator import canonical_ip
+
+
+def _peer_ip(allowed_address: str) -> str:
+    return canonical_ip(allowed_address)
+
+
+class PeerIdIndex:
+    def __init__(self):
+        # (host, port, interface) -> {public key / comment / client IP: .id}
+        self._ids: dict[tuple, dict[str, str]] = {}
+        # (host, port, interface) -> {.id: keys pointing at it}
+        self._keys: dict[tuple, dict[str, set[str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _router_key(host: str, port: int, wg_interface: str) -> tuple:
+        return ((host or "").strip(), int(port or 8728), wg_interface or "")
+
+    def replace(self, host: str, port: int, wg_interface: str, peers: list[dict]):
+        """Rebuild a router's index from a full peer listing of the interface."""
+        router = self._router_key(host, port, wg_interface)
+        self._ids[router] = {}
+        self._keys[router] = {}
+        for peer in peers:
+            peer_id = peer.get(".id")
+            if peer_id:
+                self.remember(
+                    host, port, wg_interface, peer_id,
+                    peer.get("public-key"), peer.get("comment"), _peer_ip(peer.get("allowed-address")),
+                )
+
+    def remember(self, host: str, port: int, wg_interface: str, peer_id: str, *keys: str):
+        router = self._router_key(host, port, wg_interface)
+        ids = self._ids.setdefault(router, {})
+        id_keys = self._keys.setdefault(router, {}).setdefault(peer_id, set())
+        for key in keys:
+            key = (key or "").strip()
+            if key:
+                ids[key] = peer_id
+                id_keys.add(key)
+
+    def lookup(self, host: str, port: int, wg_interface: str, *keys: str) -> str | None:
+        ids = self._ids.get(self._router_key(host, port, wg_interface), {})
+        for key in keys:
+            peer_id = ids.get((key or "").strip())
+            if peer_id:
+                self.hits += 1
+                return peer_id
+        self.misses += 1
+        return None
+
+    def forget(self, host: str, port: int, wg_interface: str, peer_id: str):
+        router = self._router_key(host, port, wg_interface)
+        ids = self._ids.get(router, {})
+        for key in self._keys.get(router, {}).pop(peer_id, ()):
+            if ids.get(key) == peer_id:
+                del ids[key]
+
+    def stats(self) -> dict:
+        return {
+            "routers": len(self._ids),
+            "entries": sum(len(ids) for ids in self._ids.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+peer_id_index = PeerIdIndex()
@@ -0,0 +1,202 @@
+"""
+Per-server pool of pre-provisioned WireGuard peers.
+
+A background worker keeps PEER_SLOT_POOL_SIZE slots ready on every server:
+keypair generated, address reserved in ip_allocations and the peer already
+added to the router in disabled state. Creating an account then claims a slot
+and only has to enable the peer and set its comment.
+
+A slot row is written (status "adding", no peer_id yet) before its peer is
+added, and only deleted once its peer is known to be off the router, so every
+slot-* peer on a router has a row. Rows the router side could not settle
+(timeouts, dropped connections, a cancelled refill) become obsolete after
+CLAIM_TIMEOUT and are cleaned up by the refill worker.
+
+This module holds the DB side; the router side lives in wireguard.py.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from database import SessionLocal
+from models import IpAllocation, PeerSlot, WireGuardConfig
+
+logger = logging.getLogger(__name__)
+
+# A claim (or add) that was neither completed nor returned (process died mid-claim)
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+# Set when a slot is claimed so the refill worker tops the pool up right away
+refill_requested = asyncio.Event()
+
+
+def claim_slot(server_id: int, wg_interface: str) -> dict | None:
+    """Take the oldest ready slot of a server; returns its fields or None when the pool is empty."""
+    db = SessionLocal()
+    try:
+        slot = (
+            db.query(PeerSlot)
+            .filter(
+                PeerSlot.server_id == server_id,
+                PeerSlot.wg_interface == wg_interface,
+                PeerSlot.status == "ready",
+            )
+            .order_by(PeerSlot.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if slot is None:
+            db.commit()
+            return None
+        slot.status = "claimed"
+        slot.claimed_at = datetime.utcnow()
+        # Restart the reservation clock so the address survives until bind_ip()
+        db.query(IpAllocation).filter(
+            IpAllocation.server_id == server_id,
+            IpAllocation.address == slot.client_ip,
+        ).update({"allocated_at": slot.claimed_at}, synchronize_session=False)
+        db.commit()
+        return {
+            "id": slot.id,
+            "client_ip": slot.client_ip,
+            "private_key": slot.private_key,
+            "public_key": slot.public_key,
+            "peer_id": slot.peer_id,
+        }
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to claim peer slot on server {server_id}: {e}")
+        return None
+    finally:
+        db.close()
+        refill_requested.set()
+
+
+def finish_slot(slot_id: int, reuse: bool = False):
+    """Drop a claimed slot once its peer belongs to an account, or put it back with reuse=True."""
+    db = SessionLocal()
+    try:
+        query = db.query(PeerSlot).filter(PeerSlot.id == slot_id)
+        if reuse:
+            query.update({"status": "ready", "claimed_at": None}, synchronize_session=False)
+        else:
+            query.delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to finish peer slot {slot_id}: {e}")
+    finally:
+        db.close()
+
+
+def add_slots(server_id: int, wg_interface: str, slots: list[dict]) -> list[int]:
+    """Record slots whose peers are about to be added; returns their ids, in order."""
+    if not slots:
+        return []
+    db = SessionLocal()
+    try:
+        rows = [
+            PeerSlot(
+                server_id=server_id,
+                wg_interface=wg_interface,
+                client_ip=slot["client_ip"],
+                private_key=slot["private_key"],
+                public_key=slot["public_key"],
+                peer_id="",
+                status="adding",
+            )
+            for slot in slots
+        ]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def activate_slots(peer_ids: dict[int, str]):
+    """Mark added slots ready: {slot_id: peer_id}."""
+    if not peer_ids:
+        return
+    db = SessionLocal()
+    try:
+        for slot_id, peer_id in peer_ids.items():
+            db.query(PeerSlot).filter(PeerSlot.id == slot_id).update(
+                {"peer_id": peer_id, "status": "ready"}, synchronize_session=False
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def drop_slots(slot_ids: list[int]):
+    """Delete slots whose peers are off the router (or were never added)."""
+    if not slot_ids:
+        return
+    db = SessionLocal()
+    try:
+        db.query(PeerSlot).filter(PeerSlot.id.in_(slot_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def ready_slot_count(server_id: int, wg_interface: str) -> int:
+    db = SessionLocal()
+    try:
+        return db.query(PeerSlot).filter(
+            PeerSlot.server_id == server_id,
+            PeerSlot.wg_interface == wg_interface,
+            PeerSlot.status == "ready",
+        ).count()
+    finally:
+        db.close()
+
+
+def obsolete_slots(server_id: int, wg_interface: str) -> list[dict]:
+    """
+    Slots that can no longer be claimed: created for another interface, or
+    claimed or being added and then abandoned. The caller removes their peers
+    from the router, then drops them and releases their addresses. An abandoned
+    claim whose account did get saved is dropped here (its peer is in use).
+    peer_id is "" for slots abandoned while being added.
+    """
+    stale = datetime.utcnow() - CLAIM_TIMEOUT
+    db = SessionLocal()
+    try:
+        slots = db.query(PeerSlot).filter(
+            PeerSlot.server_id == server_id,
+            (PeerSlot.wg_interface != wg_interface)
+            | ((PeerSlot.status == "claimed") & (PeerSlot.claimed_at < stale))
+            | ((PeerSlot.status == "adding") & (PeerSlot.created_at < stale)),
+        ).all()
+        saved_ips = set()
+        if slots:
+            saved_ips = {
+                client_ip for (client_ip,) in db.query(WireGuardConfig.client_ip).filter(
+                    WireGuardConfig.server_id == server_id,
+                    WireGuardConfig.client_ip.in_([slot.client_ip for slot in slots]),
+                )
+            }
+        obsolete = [
+            {"id": slot.id, "client_ip": slot.client_ip, "peer_id": slot.peer_id, "wg_interface": slot.wg_interface}
+            for slot in slots
+            if slot.client_ip not in saved_ips
+        ]
+        for slot in slots:
+            if slot.client_ip in saved_ips:
+                db.delete(slot)
+        db.commit()
+        return obsolete
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to collect obsolete peer slots on server {server_id}: {e}")
+        return []
+    finally:
+        db.close()
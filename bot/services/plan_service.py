@@ -1,6 +1,5 @@
-import ipaddress
-
 from models import Server, PlanServerMap, WireGuardConfig
+from services.ip_allocator import parse_ip_pool
 
 
 def _normalize_ip_pool(server: Server) -> tuple[str | None, int | None, int | None]:
@@ -8,9 +7,11 @@ def _normalize_ip_pool(server: Server) -> tuple[str | None, int | None, int | No
     Normalize server IP pool fields.
 
     Supports legacy values that may be stored as:
-      - CIDR (e.g. 192.168.30.0/24)
+      - CIDR (e.g. 192.168.30.0/24, 10.8.0.0/16, fd00::/64)
       - explicit range (e.g. 192.168.30.10-192.168.30.220 or 192.168.30.10-220)
       - base IP only (e.g. 192.168.30.0)
+
+    start/end are host offsets from the network base address.
     """
     raw_base = (server.wg_client_network_base or "").strip()
     start = server.wg_ip_range_start
@@ -19,35 +20,13 @@ def _normalize_ip_pool(server: Server) -> tuple[str | None, int | None, int | No
     if not raw_base:
         return raw_base or None, start, end
 
-    # Legacy: value kept as CIDR in DB
-    if "/" in raw_base:
-        try:
-            network = ipaddress.ip_network(raw_base, strict=False)
-            if isinstance(network, ipaddress.IPv4Network):
-                raw_base = str(network.network_address)
-                if start is None or end is None:
-                    start = int(network.network_address) & 0xFF
-                    end = int(network.broadcast_address) & 0xFF
-        except ValueError:
-            pass
-
-    # Legacy/manual: explicit range kept in base field
-    if "-" in raw_base and "/" not in raw_base:
-        left, right = [p.strip() for p in raw_base.split("-", 1)]
-        left_parts = left.split(".")
-        if len(left_parts) == 4:
-            prefix = ".".join(left_parts[:3])
-            try:
-                start = int(left_parts[3]) if start is None else start
-                if "." in right:
-                    right_parts = right.split(".")
-                    if len(right_parts) == 4 and ".".join(right_parts[:3]) == prefix:
-                        end = int(right_parts[3]) if end is None else end
-                else:
-                    end = int(right) if end is None else end
-                raw_base = f"{prefix}.0"
-            except ValueError:
-                pass
+    # Legacy/manual: CIDR or explicit range kept in the base field
+    if "/" in raw_base or "-" in raw_base:
+        parsed = parse_ip_pool(raw_base)
+        if parsed:
+            raw_base = parsed["base_ip"]
+            if start is None or end is None:
+                start, end = parsed["start_offset"], parsed["end_offset"]
 
     # Fallback for missing range columns
     if start is None:
@@ -0,0 +1,83 @@
+"""
+QR code rendering straight to 1-bit PNG bytes.
+
+qrcode only computes the module matrix; the PNG (grayscale, bit depth 1) is
+written directly with zlib instead of drawing a PIL image and re-encoding it.
+Size and error correction match qrcode.make() defaults (box size 10, border 4).
+
+Most of qrcode's time goes into scoring all eight mask patterns. That score
+is what keeps large areas of one colour and finder-like patterns out of the
+code, so "auto" stays the default; QR_MASK_PATTERN (or the mask_pattern
+argument) forces a single mask where speed matters more than scan margin.
+
+Renders run in a thread so the event loop stays free.
+"""
+import asyncio
+import logging
+import struct
+import zlib
+
+from config import QR_MASK_PATTERN
+
+logger = logging.getLogger(__name__)
+
+try:
+    import qrcode
+    QRCODE_AVAILABLE = True
+except ImportError as e:
+    logger.error(f"✗ qrcode NOT available: {e}")
+    QRCODE_AVAILABLE = False
+
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Level 9 is ~4x slower on these highly repetitive scanlines for a ~4% smaller file
+_PNG_COMPRESSION_LEVEL = 6
+
+_MASK_PATTERN = None if QR_MASK_PATTERN.strip().lower() in ("", "auto") else int(QR_MASK_PATTERN)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def qr_matrix(text: str, border: int = QR_BORDER, mask_pattern: int | None = _MASK_PATTERN) -> list[list[bool]]:
+    """Module matrix including the quiet zone; True is a dark module. mask_pattern None scores all masks."""
+    qr = qrcode.QRCode(border=border, mask_pattern=mask_pattern)
+    qr.add_data(text)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def render_qr_png(
+    text: str,
+    box_size: int = QR_BOX_SIZE,
+    border: int = QR_BORDER,
+    mask_pattern: int | None = _MASK_PATTERN,
+) -> bytes | None:
+    if not QRCODE_AVAILABLE:
+        return None
+    matrix = qr_matrix(text, border, mask_pattern)
+    size = len(matrix) * box_size
+    padding = "1" * (-size % 8)
+
+    scanlines = bytearray()
+    for row in matrix:
+        # Dark modules are 0 (black), light modules 1 (white)
+        bits = "".join("0" * box_size if dark else "1" * box_size for dark in row) + padding
+        scanline = b"\x00" + int(bits, 2).to_bytes(len(bits) // 8, "big")
+        scanlines += scanline * box_size
+
+    return b"".join((
+        _PNG_SIGNATURE,
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 0, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(bytes(scanlines), _PNG_COMPRESSION_LEVEL)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+
+async def render_qr_png_async(text: str) -> bytes | None:
+    return await asyncio.to_thread(render_qr_png, text)
+
@@ -0,0 +1,195 @@
+"""
+Long-lived RouterOS API connections shared by every router operation.
+
+Connections are kept per router (host, port, credentials) and reused across
+usage sync cycles and handler calls instead of paying a TCP connect + login
+for every operation.
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from config import (
+    ROUTER_POOL_MAX_CONNECTIONS,
+    ROUTER_POOL_IDLE_TIMEOUT,
+    ROUTER_POOL_HEALTHCHECK_INTERVAL,
+    ROUTER_POOL_ACQUIRE_TIMEOUT,
+)
+from services.routeros_client import RouterOsClient, RouterOsTrapError
+
+logger = logging.getLogger(__name__)
+
+
+class RouterPoolTimeout(RuntimeError):
+    """Raised when no connection slot frees up for a router in time."""
+
+
+class _PooledConnection:
+    def __init__(self, client: RouterOsClient):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.last_checked = self.last_used
+
+    async def is_alive(self) -> bool:
+        if not self.client.connected:
+            return False
+        try:
+            await self.client.print("/system/identity")
+            self.last_checked = time.monotonic()
+            return True
+        except Exception:
+            return False
+
+    async def close(self):
+        try:
+            await self.client.close()
+        except Exception:
+            pass
+
+
+class _RouterSlot:
+    """Idle connections and the connection cap of a single router."""
+
+    def __init__(self, max_connections: int):
+        self.idle: list[_PooledConnection] = []
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.created = 0
+        self.reused = 0
+        self.retired = False
+
+
+class RouterConnectionManager:
+    def __init__(
+        self,
+        max_connections_per_router: int = ROUTER_POOL_MAX_CONNECTIONS,
+        idle_timeout: float = ROUTER_POOL_IDLE_TIMEOUT,
+        healthcheck_interval: float = ROUTER_POOL_HEALTHCHECK_INTERVAL,
+        acquire_timeout: float = ROUTER_POOL_ACQUIRE_TIMEOUT,
+    ):
+        self.max_connections_per_router = max(int(max_connections_per_router), 1)
+        self.idle_timeout = idle_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.acquire_timeout = acquire_timeout
+        self._slots: dict[tuple, _RouterSlot] = {}
+        self._last_sweep = time.monotonic()
+
+    @staticmethod
+    def _key(host: str, username: str, password: str, port: int) -> tuple:
+        return ((host or "").strip(), int(port or 8728), username or "", password or "")
+
+    def _get_slot(self, key: tuple) -> _RouterSlot:
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = _RouterSlot(self.max_connections_per_router)
+            self._slots[key] = slot
+        return slot
+
+    async def _take_idle(self, slot: _RouterSlot):
+        now = time.monotonic()
+        while slot.idle:
+            conn = slot.idle.pop()
+            if not conn.client.connected or now - conn.last_used > self.idle_timeout:
+                await conn.close()
+                continue
+            if now - conn.last_checked > self.healthcheck_interval and not await conn.is_alive():
+                logger.info("Dropping dead RouterOS connection; reconnecting")
+                await conn.close()
+                continue
+            return conn
+        return None
+
+    @asynccontextmanager
+    async def connection(self, host: str, username: str, password: str, port: int):
+        """Borrow an API client for a router, returning it to the pool afterwards."""
+        key = self._key(host, username, password, port)
+        slot = self._get_slot(key)
+        try:
+            await asyncio.wait_for(slot.semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError as e:
+            raise RouterPoolTimeout(f"No free RouterOS connection for {key[0]}:{key[1]}") from e
+
+        conn = None
+        reusable = False
+        try:
+            conn = await self._take_idle(slot)
+            if conn is None:
+                client = RouterOsClient(key[0], key[1], key[2], key[3])
+                await client.connect()
+                conn = _PooledConnection(client)
+                slot.created += 1
+            else:
+                slot.reused += 1
+
+            try:
+                yield conn.client
+                reusable = True
+            except RouterOsTrapError:
+                # A trap still ends with !done, so the connection stays usable
+                reusable = True
+                raise
+        finally:
+            if conn is not None:
+                if reusable and conn.client.connected and not slot.retired:
+                    conn.last_used = time.monotonic()
+                    slot.idle.append(conn)
+                else:
+                    # Connection error, timeout or cancellation mid-reply: never hand this client out again
+                    await conn.close()
+            slot.semaphore.release()
+            await self._maybe_sweep()
+
+    async def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_timeout / 2:
+            return
+        self._last_sweep = now
+        await self.evict_idle()
+
+    async def evict_idle(self) -> int:
+        """Close connections that have been idle longer than idle_timeout."""
+        now = time.monotonic()
+        evicted = 0
+        for slot in list(self._slots.values()):
+            stale = [c for c in slot.idle if now - c.last_used > self.idle_timeout]
+            slot.idle = [c for c in slot.idle if now - c.last_used <= self.idle_timeout]
+            for conn in stale:
+                await conn.close()
+                evicted += 1
+        return evicted
+
+    async def invalidate(self, host: str, port: int = None):
+        """Close idle connections of a router, e.g. after its credentials were edited."""
+        host = (host or "").strip()
+        keys = [k for k in self._slots if k[0] == host and (port is None or k[1] == int(port))]
+        for key in keys:
+            slot = self._slots.pop(key)
+            slot.retired = True
+            idle, slot.idle = slot.idle, []
+            for conn in idle:
+                await conn.close()
+
+    async def close_all(self):
+        slots, self._slots = list(self._slots.values()), {}
+        for slot in slots:
+            slot.retired = True
+            idle, slot.idle = slot.idle, []
+            for conn in idle:
+                await conn.close()
+
+    def stats(self) -> dict:
+        return {
+            f"{key[0]}:{key[1]}": {
+                "idle": len(slot.idle),
+                "created": slot.created,
+                "reused": slot.reused,
+            }
+            for key, slot in self._slots.items()
+        }
+
+
+router_pool = RouterConnectionManager()
+
+
+def router_connection(host: str, username: str, password: str, port: int):
+    return router_pool.connection(host, username, password, port)
@@ -0,0 +1,289 @@
+"""
+Asyncio implementation of the MikroTik RouterOS API protocol.
+
+Speaks the binary sentence protocol directly (length-prefixed words) so router
+I/O never blocks the event loop. Every command is tagged, which lets several
+commands be in flight on one connection; replies are routed back to their
+caller by tag.
+"""
+import asyncio
+import binascii
+import hashlib
+import logging
+from itertools import count
+
+from config import ROUTEROS_CALL_TIMEOUT, ROUTEROS_CONNECT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class RouterOsError(Exception):
+    """Base error for RouterOS API failures."""
+
+
+class RouterOsConnectionError(RouterOsError):
+    """The connection is gone (closed, !fatal or socket error)."""
+
+
+class RouterOsTimeout(RouterOsError):
+    """A command did not complete within its timeout."""
+
+
+class RouterOsTrapError(RouterOsError):
+    """The router answered a command with !trap."""
+
+    def __init__(self, message: str, category: str = None):
+        super().__init__(message)
+        self.message = message
+        self.category = category
+
+
+def encode_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes((length,))
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, "big")
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, "big")
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, "big")
+    return b"\xF0" + length.to_bytes(4, "big")
+
+
+def encode_sentence(words) -> bytes:
+    out = bytearray()
+    for word in words:
+        raw = word.encode("utf-8")
+        out += encode_length(len(raw))
+        out += raw
+    out += b"\x00"
+    return bytes(out)
+
+
+async def _read_length(reader: asyncio.StreamReader) -> int:
+    first = (await reader.readexactly(1))[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        rest = await reader.readexactly(1)
+        return ((first & 0x3F) << 8) | rest[0]
+    if first < 0xE0:
+        rest = await reader.readexactly(2)
+        return ((first & 0x1F) << 16) | int.from_bytes(rest, "big")
+    if first < 0xF0:
+        rest = await reader.readexactly(3)
+        return ((first & 0x0F) << 24) | int.from_bytes(rest, "big")
+    return int.from_bytes(await reader.readexactly(4), "big")
+
+
+async def read_sentence(reader: asyncio.StreamReader) -> list[str]:
+    words = []
+    while True:
+        length = await _read_length(reader)
+        if length == 0:
+            return words
+        words.append((await reader.readexactly(length)).decode("utf-8", errors="replace"))
+
+
+def build_command(command: str, attrs: dict = None, queries=None, proplist=None) -> list[str]:
+    """Build API words for a command, e.g. ("/interface/wireguard/peers/print", queries=["interface=wg0"])."""
+    words = [command]
+    for key, value in (attrs or {}).items():
+        if isinstance(value, bool):
+            value = "yes" if value else "no"
+        words.append(f"={key}={'' if value is None else value}")
+    if proplist:
+        words.append(f"=.proplist={','.join(proplist)}")
+    for query in queries or ():
+        words.append(query if query.startswith("?") else f"?{query}")
+    return words
+
+
+class _PendingCommand:
+    __slots__ = ("future", "rows", "trap")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.rows: list[dict] = []
+        self.trap: RouterOsTrapError | None = None
+
+
+class RouterOsClient:
+    """A single logged-in API connection to one router."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 8728,
+        username: str = "",
+        password: str = "",
+        timeout: float = ROUTEROS_CALL_TIMEOUT,
+        connect_timeout: float = ROUTEROS_CONNECT_TIMEOUT,
+    ):
+        self.host = host
+        self.port = int(port or 8728)
+        self.username = username or ""
+        self.password = password or ""
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._pending: dict[str, _PendingCommand] = {}
+        self._tags = count(1)
+        self._closed = True
+
+    @property
+    def connected(self) -> bool:
+        return not self._closed
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                timeout=self.connect_timeout,
+            )
+        except asyncio.TimeoutError as e:
+            raise RouterOsTimeout(f"Connection to {self.host}:{self.port} timed out") from e
+        except OSError as e:
+            raise RouterOsConnectionError(f"Cannot connect to {self.host}:{self.port}: {e}") from e
+
+        self._closed = False
+        self._reader_task = asyncio.create_task(self._read_loop())
+        try:
+            await self._login()
+        except Exception:
+            await self.close()
+            raise
+        return self
+
+    async def _login(self):
+        reply = await self.call("/login", {"name": self.username, "password": self.password}, timeout=self.connect_timeout)
+        challenge = reply[0].get("ret") if reply else None
+        if challenge:
+            # RouterOS < 6.43 answers with an MD5 challenge instead of logging in
+            digest = hashlib.md5(b"\x00" + self.password.encode("utf-8") + binascii.unhexlify(challenge)).hexdigest()
+            await self.call("/login", {"name": self.username, "response": f"00{digest}"}, timeout=self.connect_timeout)
+
+    async def _read_loop(self):
+        error: Exception = RouterOsConnectionError(f"Connection to {self.host}:{self.port} closed")
+        try:
+            while True:
+                sentence = await read_sentence(self._reader)
+                if sentence:
+                    self._dispatch(sentence)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            error = RouterOsConnectionError(f"Connection to {self.host}:{self.port} lost: {e}")
+        except RouterOsConnectionError as e:
+            error = e
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._closed = True
+            for pending in self._pending.values():
+                if not pending.future.done():
+                    pending.future.set_exception(error)
+            self._pending.clear()
+            if self._writer is not None:
+                self._writer.close()
+
+    def _dispatch(self, sentence: list[str]):
+        reply = sentence[0]
+        tag = None
+        attrs = {}
+        for word in sentence[1:]:
+            if word.startswith(".tag="):
+                tag = word[5:]
+            elif word.startswith("="):
+                key, _, value = word[1:].partition("=")
+                attrs[key] = value
+
+        if reply == "!fatal":
+            message = sentence[1] if len(sentence) > 1 else "fatal error"
+            raise RouterOsConnectionError(f"Router closed the session: {message}")
+
+        pending = self._pending.get(tag)
+        if pending is None:
+            # Reply for a command whose caller already timed out
+            return
+        if reply == "!re":
+            pending.rows.append(attrs)
+        elif reply == "!trap":
+            pending.trap = RouterOsTrapError(attrs.get("message", "unknown error"), attrs.get("category"))
+        elif reply == "!done":
+            if attrs:
+                pending.rows.append(attrs)
+            self._pending.pop(tag, None)
+            if pending.future.done():
+                return
+            if pending.trap is not None:
+                pending.future.set_exception(pending.trap)
+            else:
+                pending.future.set_result(pending.rows)
+
+    def send(self, words: list[str]) -> str:
+        """Write a tagged command without waiting for it; returns the tag to pass to wait()."""
+        if self._closed:
+            raise RouterOsConnectionError(f"Connection to {self.host}:{self.port} is closed")
+        tag = str(next(self._tags))
+        self._pending[tag] = _PendingCommand(asyncio.get_running_loop().create_future())
+        self._writer.write(encode_sentence(words + [f".tag={tag}"]))
+        return tag
+
+    async def wait(self, tag: str, timeout: float = None) -> list[dict]:
+        """Wait for the reply of a command sent with send()."""
+        pending = self._pending.get(tag)
+        if pending is None:
+            raise RouterOsConnectionError(f"Connection to {self.host}:{self.port} lost before reply")
+
+        async def _reply():
+            await self._writer.drain()
+            return await pending.future
+
+        try:
+            return await asyncio.wait_for(_reply(), timeout=timeout or self.timeout)
+        except asyncio.TimeoutError as e:
+            self._pending.pop(tag, None)
+            raise RouterOsTimeout(f"RouterOS command timed out on {self.host}:{self.port}") from e
+
+    async def call(self, command: str, attrs: dict = None, queries=None, proplist=None, timeout: float = None) -> list[dict]:
+        tag = self.send(build_command(command, attrs, queries, proplist))
+        return await self.wait(tag, timeout)
+
+    async def pipeline(self, commands: list[list[str]], timeout: float = None) -> list:
+        """
+        Send several commands back to back and collect their replies in order.
+
+        Each result is the reply rows or the exception that command raised, so
+        one trap does not hide the outcome of the others.
+        """
+        tags = [self.send(words) for words in commands]
+        return await asyncio.gather(*(self.wait(tag, timeout) for tag in tags), return_exceptions=True)
+
+    async def print(self, path: str, queries=None, proplist=None, timeout: float = None) -> list[dict]:
+        return await self.call(f"{path}/print", queries=queries, proplist=proplist, timeout=timeout)
+
+    async def add(self, path: str, timeout: float = None, **attrs) -> str | None:
+        rows = await self.call(f"{path}/add", attrs, timeout=timeout)
+        return rows[0].get("ret") if rows else None
+
+    async def set(self, path: str, item_id: str, timeout: float = None, **attrs):
+        await self.call(f"{path}/set", {".id": item_id, **attrs}, timeout=timeout)
+
+    async def remove(self, path: str, item_id: str, timeout: float = None):
+        await self.call(f"{path}/remove", {".id": item_id}, timeout=timeout)
+
+    async def close(self):
+        self._closed = True
+        if self._reader_task is not None and not self._reader_task.done():
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._writer is not None:
+            try:
+                self._writer.close()
+                await self._writer.wait_closed()
+            except Exception:
+                pass
@@ -1,28 +1,27 @@
-import socket
+import asyncio
 
-from routeros_api import RouterOsApiPool
+from sqlalchemy import select
 
+from models import Server
+from services.router_pool import router_connection
+from wireguard import apply_peer_operations_by_server
 
-def check_server_connection(server) -> tuple[bool, str]:
+
+async def check_server_connection(server) -> tuple[bool, str]:
     try:
-        pool = RouterOsApiPool(
+        async with router_connection(
             server.host,
-            username=server.username or "",
-            password=server.password or "",
-            port=server.api_port or 8728,
-            plaintext_login=True,
-        )
-        try:
-            api = pool.get_api()
-            api.get_resource('/system/resource').get()
-        finally:
-            pool.disconnect()
+            server.username or "",
+            server.password or "",
+            server.api_port or 8728,
+        ) as api:
+            await api.print('/system/resource')
         return True, "اتصال برقرار است"
     except Exception as e:
         return False, str(e)
 
 
-def evaluate_server_parameters(server) -> dict:
+async def evaluate_server_parameters(server) -> dict:
     """Check only host reachability and WG interface existence for server health."""
     result = {
         "host": False,
@@ -39,31 +38,57 @@ def evaluate_server_parameters(server) -> dict:
         result["all_ok"] = False
         return result
 
-    pool = None
     try:
-        with socket.create_connection((host, api_port), timeout=2):
-            pass
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, api_port), timeout=2)
+        writer.close()
         result["host"] = True
 
-        pool = RouterOsApiPool(
-            host,
-            username=username,
-            password=password,
-            port=api_port,
-            plaintext_login=True,
-        )
-        api = pool.get_api()
-        interface_rows = api.get_resource('/interface').get(name=wg_interface)
+        async with router_connection(host, username, password, api_port) as api:
+            interface_rows = await api.print('/interface', queries=[f"name={wg_interface}"])
         result["wg_interface"] = bool(interface_rows)
     except Exception:
         result["host"] = False
         result["wg_interface"] = False
-    finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
 
     result["all_ok"] = bool(result["host"] and result["wg_interface"])
     return result
+
+
+async def reset_configs_on_routers(db, configs, error_label: str = "Peer reset failed") -> int:
+    """
+    Reset router-side counters of many configs, one pipelined batch per router.
+    Returns how many succeeded. Commits `db` before the routers are contacted,
+    so pass a session that keeps rows on commit (the handlers' `db` does).
+    """
+    server_ids = {cfg.server_id for cfg in configs if cfg.server_id}
+    if not server_ids:
+        return 0
+    servers = {
+        server.id: server
+        for server in db.query(Server).filter(Server.id.in_(server_ids), Server.is_active == True).all()
+    }
+    db.commit()
+    return await _reset_configs_on_servers(servers, configs, error_label)
+
+
+async def reset_configs_on_routers_async(session, configs, error_label: str = "Peer reset failed") -> int:
+    """reset_configs_on_routers on an AsyncSession; commits `session` the same way."""
+    server_ids = {cfg.server_id for cfg in configs if cfg.server_id}
+    if not server_ids:
+        return 0
+    result = await session.scalars(select(Server).where(Server.id.in_(server_ids), Server.is_active == True))
+    servers = {server.id: server for server in result}
+    await session.commit()
+    return await _reset_configs_on_servers(servers, configs, error_label)
+
+
+async def _reset_configs_on_servers(servers: dict, configs, error_label: str) -> int:
+    targets = [cfg for cfg in configs if cfg.server_id in servers]
+    results = await apply_peer_operations_by_server(
+        servers,
+        [{"server_id": cfg.server_id, "op": "reset", "client_ip": cfg.client_ip} for cfg in targets],
+    )
+    for cfg, result in zip(targets, results):
+        if not result["ok"]:
+            print(f"{error_label} ({cfg.client_ip}): {result['error']}")
+    return sum(1 for result in results if result["ok"])
@@ -0,0 +1,140 @@
+"""
+Adaptive scheduling of router usage syncs.
+
+One sync downloads every peer of a router, so routers are what gets
+scheduled. Each pass reports next_due_in: the shortest estimated time until
+one of the router's configs runs out of quota or expires. Quota estimates use
+twice the config's recent rate, and never less than USAGE_SYNC_PEAK_RATE (what
+a client link can sustain), so an idle config that starts a full-speed
+download is still caught before it overshoots. The router is synced again
+after half that time, clamped to USAGE_SYNC_MIN_INTERVAL..USAGE_SYNC_MAX_INTERVAL
+(at most 180 s by default). Configs near their limits are
+polled often and routers without any rarely. A token bucket caps sync
+starts at USAGE_SYNC_REQUESTS_PER_SECOND across all routers.
+"""
+import asyncio
+import math
+import time
+
+from config import (
+    USAGE_SYNC_INTERVAL,
+    USAGE_SYNC_MAX_INTERVAL,
+    USAGE_SYNC_MIN_INTERVAL,
+    USAGE_SYNC_PEAK_RATE,
+    USAGE_SYNC_REQUESTS_PER_SECOND,
+)
+
+
+def seconds_until_due(remaining_bytes: int | None, rate: float, seconds_to_expiry: float | None) -> float:
+    """Estimated seconds until a config hits its quota or expiry; inf without limits."""
+    eta = math.inf
+    if remaining_bytes is not None:
+        eta = max(remaining_bytes, 0) / max(rate * 2, USAGE_SYNC_PEAK_RATE, 1)
+    if seconds_to_expiry is not None:
+        eta = min(eta, max(seconds_to_expiry, 0))
+    return eta
+
+
+class SyncScheduler:
+    def __init__(
+        self,
+        min_interval: float = USAGE_SYNC_MIN_INTERVAL,
+        max_interval: float = USAGE_SYNC_MAX_INTERVAL,
+        retry_interval: float = USAGE_SYNC_INTERVAL,
+        requests_per_second: float = USAGE_SYNC_REQUESTS_PER_SECOND,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.retry_interval = retry_interval
+        self.requests_per_second = requests_per_second
+        self._due: dict[int, float] = {}  # server_id -> monotonic time of next sync
+        self._last_started: dict[int, float] = {}
+        self._taken: dict[int, float] = {}  # server_id -> due time, for syncs waiting or running
+        self._running: set[int] = set()
+        self._capacity = max(requests_per_second, 1.0)
+        self._tokens = self._capacity
+        self._tokens_updated = time.monotonic()
+        self.syncs = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def track(self, server_ids):
+        """Follow exactly these routers; new ones are due at once."""
+        now = time.monotonic()
+        server_ids = set(server_ids)
+        for server_id in server_ids - self._due.keys():
+            self._due[server_id] = now
+        for server_id in self._due.keys() - server_ids:
+            del self._due[server_id]
+            self._last_started.pop(server_id, None)
+
+    def take_due(self) -> list[int]:
+        """Routers whose sync is due and not already in progress, most overdue first."""
+        now = time.monotonic()
+        due = sorted(
+            (due_at, server_id)
+            for server_id, due_at in self._due.items()
+            if due_at <= now and server_id not in self._taken
+        )
+        for due_at, server_id in due:
+            self._taken[server_id] = due_at
+        return [server_id for _, server_id in due]
+
+    async def acquire(self):
+        """Wait for a request token of the global budget."""
+        if self.requests_per_second <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._tokens_updated) * self.requests_per_second)
+            self._tokens_updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.requests_per_second)
+
+    def started(self, server_id: int) -> float | None:
+        """Mark a sync as started; returns seconds since the router's previous sync started."""
+        now = time.monotonic()
+        self._running.add(server_id)
+        self.last_lag = max(now - self._taken.get(server_id, now), 0.0)
+        self.max_lag = max(self.max_lag, self.last_lag)
+        previous = self._last_started.get(server_id)
+        self._last_started[server_id] = now
+        self.syncs += 1
+        return now - previous if previous is not None else None
+
+    def complete(self, server_id: int, next_due_in: float | None):
+        """Schedule the router's next sync; next_due_in None means the sync failed."""
+        self._taken.pop(server_id, None)
+        self._running.discard(server_id)
+        if server_id not in self._due:
+            return
+        if next_due_in is None:
+            interval = self.retry_interval
+        else:
+            interval = min(max(next_due_in / 2, self.min_interval), self.max_interval)
+        self._due[server_id] = time.monotonic() + interval
+
+    def seconds_until_next(self) -> float:
+        now = time.monotonic()
+        pending = [due_at for server_id, due_at in self._due.items() if server_id not in self._taken]
+        return max(min(pending) - now, 0.0) if pending else self.max_interval
+
+    def metrics(self) -> dict:
+        """Queue depth (due routers not syncing yet, including those waiting for a token) and lag in seconds."""
+        now = time.monotonic()
+        queued = [
+            self._taken.get(server_id, due_at)
+            for server_id, due_at in self._due.items()
+            if server_id not in self._running and (server_id in self._taken or due_at <= now)
+        ]
+        return {
+            "routers": len(self._due),
+            "running": len(self._running),
+            "queue_depth": len(queued),
+            "queue_lag": max(now - min(queued), 0.0) if queued else 0.0,
+            "last_start_lag": self.last_lag,
+            "max_start_lag": self.max_lag,
+            "syncs": self.syncs,
+        }
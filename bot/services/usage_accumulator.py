@@ -0,0 +1,123 @@
+"""
+Write-behind buffer for usage counters.
+
+The sync pass can poll routers far more often than usage needs to reach the
+DB: deltas are added up here per config and written with one UPDATE when
+USAGE_FLUSH_INTERVAL has passed or USAGE_FLUSH_MAX_PENDING configs are
+waiting. Enforcement reads live totals (stored cumulative + pending delta).
+
+cumulative_* and last_*_counter are always written together, so a crash only
+loses the unflushed deltas in memory: after a restart the next pass computes
+them again from the stored (older) router counters. Only a router reboot in
+the same window loses traffic.
+
+All state is touched from the event loop only. A sync pass reads its rows and
+the pending deltas with no await in between and afterwards only adds deltas,
+so flush() may run at any time, also while passes are in flight.
+"""
+import logging
+import time
+
+from sqlalchemy import text
+
+from config import USAGE_FLUSH_INTERVAL, USAGE_FLUSH_MAX_PENDING
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Rows reset by an admin since their deltas were collected are skipped
+_FLUSH_SQL = text("""
+    UPDATE wireguard_configs wc SET
+        cumulative_rx_bytes = COALESCE(wc.cumulative_rx_bytes, 0) + v.delta_rx,
+        cumulative_tx_bytes = COALESCE(wc.cumulative_tx_bytes, 0) + v.delta_tx,
+        last_rx_counter = v.last_rx_counter,
+        last_tx_counter = v.last_tx_counter
+    FROM unnest(
+        CAST(:ids AS INTEGER[]),
+        CAST(:delta_rx AS BIGINT[]),
+        CAST(:delta_tx AS BIGINT[]),
+        CAST(:last_rx AS BIGINT[]),
+        CAST(:last_tx AS BIGINT[])
+    ) AS v(id, delta_rx, delta_tx, last_rx_counter, last_tx_counter)
+    WHERE wc.id = v.id AND NOT COALESCE(wc.counter_reset_flag, FALSE)
+""")
+
+
+class UsageAccumulator:
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL, max_pending: int = USAGE_FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # config_id -> [delta_rx, delta_tx, last_rx_counter, last_tx_counter]
+        self._pending: dict[int, list[int]] = {}
+        self._last_flush = time.monotonic()
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def baseline(self, config) -> tuple[int, int, int, int]:
+        """Live (cumulative_rx, cumulative_tx, last_rx_counter, last_tx_counter) of a config row."""
+        cumulative_rx = config.cumulative_rx_bytes or 0
+        cumulative_tx = config.cumulative_tx_bytes or 0
+        entry = self._pending.get(config.id)
+        if entry is None:
+            return cumulative_rx, cumulative_tx, config.last_rx_counter or 0, config.last_tx_counter or 0
+        return cumulative_rx + entry[0], cumulative_tx + entry[1], entry[2], entry[3]
+
+    def add(self, config_id: int, delta_rx: int, delta_tx: int, last_rx: int, last_tx: int):
+        entry = self._pending.get(config_id)
+        if entry is None:
+            self._pending[config_id] = [delta_rx, delta_tx, last_rx, last_tx]
+        else:
+            entry[0] += delta_rx
+            entry[1] += delta_tx
+            entry[2] = last_rx
+            entry[3] = last_tx
+
+    def discard(self, config_ids):
+        """Drop pending usage of configs that were just written (or reset) directly."""
+        for config_id in config_ids:
+            self._pending.pop(config_id, None)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def flush_due(self) -> bool:
+        if not self._pending:
+            return False
+        return (
+            self.flush_interval <= 0
+            or len(self._pending) >= self.max_pending
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def flush(self) -> int:
+        """Write all pending usage with one UPDATE; returns rows written. Pending usage is kept on failure."""
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return 0
+        pending = self._pending
+        self._pending = {}
+        ids = list(pending)
+        db = SessionLocal()
+        try:
+            rows = db.execute(_FLUSH_SQL, {
+                "ids": ids,
+                "delta_rx": [pending[config_id][0] for config_id in ids],
+                "delta_tx": [pending[config_id][1] for config_id in ids],
+                "last_rx": [pending[config_id][2] for config_id in ids],
+                "last_tx": [pending[config_id][3] for config_id in ids],
+            }).rowcount
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to flush usage of {len(ids)} configs: {e}")
+            self._pending = pending
+            return 0
+        finally:
+            db.close()
+        self.flushes += 1
+        self.rows_flushed += rows
+        return rows
+
+
+usage_accumulator = UsageAccumulator()
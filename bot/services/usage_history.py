@@ -0,0 +1,343 @@
+"""
+Per-config usage history: 5-minute samples with hourly and daily rollups.
+
+The sync pass hands every config's delta to usage_history.record(). Deltas are
+summed in memory per server for the current 5-minute bucket and written by
+flush() once the bucket is over. A bucket is one usage_samples row per server
+holding parallel config_ids / rx_bytes / tx_bytes arrays of the configs that
+moved, so idle peers cost nothing and 20k configs sampled every few minutes
+stay at a few hundred rows a day per server.
+
+maintain() rolls the 5-minute rows up into hourly ones and those into daily
+ones, then drops rows past their retention. Each rollup remembers how far it
+got and only adds the buckets finished since; samples written late into an
+already rolled bucket move that mark back so the bucket is rebuilt. The first
+run after a start rebuilds a few recent buckets instead. The worker uses the
+*_async twins, which run the SQL on a thread so the event loop keeps serving
+updates. rates() and series() are the query API; the newest data lags by at
+most one 5-minute bucket.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from config import (
+    USAGE_HISTORY_MAINTENANCE_INTERVAL,
+    USAGE_HISTORY_RETENTION_1D_DAYS,
+    USAGE_HISTORY_RETENTION_1H_DAYS,
+    USAGE_HISTORY_RETENTION_5M_HOURS,
+)
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = {
+    "5m": timedelta(minutes=5),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+
+RETENTION = {
+    "5m": timedelta(hours=USAGE_HISTORY_RETENTION_5M_HOURS),
+    "1h": timedelta(days=USAGE_HISTORY_RETENTION_1H_DAYS),
+    "1d": timedelta(days=USAGE_HISTORY_RETENTION_1D_DAYS),
+}
+
+# target resolution -> (source resolution, date_trunc unit, completed buckets rebuilt on the first run)
+ROLLUPS = {
+    "1h": ("5m", "hour", 3),
+    "1d": ("1h", "day", 2),
+}
+
+# Keys rates() can group by
+GROUP_KEYS = {
+    "config": "u.config_id",
+    "user": "wc.user_telegram_id",
+    "server": "s.server_id",
+    "representative": "wc.representative_id",
+}
+
+_EPOCH = datetime(1970, 1, 1)
+
+# A bucket written twice (restart or forced flush mid-bucket) gets both halves summed
+_UPSERT_SAMPLE_SQL = text("""
+    INSERT INTO usage_samples (server_id, resolution, bucket_start, config_ids, rx_bytes, tx_bytes)
+    VALUES (:server_id, '5m', :bucket_start, CAST(:config_ids AS INTEGER[]), CAST(:rx_bytes AS BIGINT[]), CAST(:tx_bytes AS BIGINT[]))
+    ON CONFLICT (resolution, bucket_start, server_id) DO UPDATE SET
+        (config_ids, rx_bytes, tx_bytes) = (
+            SELECT array_agg(config_id ORDER BY config_id), array_agg(rx ORDER BY config_id), array_agg(tx ORDER BY config_id)
+            FROM (
+                SELECT config_id, SUM(rx)::BIGINT AS rx, SUM(tx)::BIGINT AS tx
+                FROM (
+                    SELECT * FROM unnest(usage_samples.config_ids, usage_samples.rx_bytes, usage_samples.tx_bytes) AS a(config_id, rx, tx)
+                    UNION ALL
+                    SELECT * FROM unnest(EXCLUDED.config_ids, EXCLUDED.rx_bytes, EXCLUDED.tx_bytes)
+                ) AS u
+                GROUP BY config_id
+            ) AS merged
+        )
+""")
+
+_ROLLUP_SQL = text("""
+    INSERT INTO usage_samples (server_id, resolution, bucket_start, config_ids, rx_bytes, tx_bytes)
+    SELECT server_id, :target, bucket, array_agg(config_id ORDER BY config_id), array_agg(rx ORDER BY config_id), array_agg(tx ORDER BY config_id)
+    FROM (
+        SELECT s.server_id, date_trunc(:unit, s.bucket_start) AS bucket, u.config_id,
+               SUM(u.rx)::BIGINT AS rx, SUM(u.tx)::BIGINT AS tx
+        FROM usage_samples s
+        CROSS JOIN LATERAL unnest(s.config_ids, s.rx_bytes, s.tx_bytes) AS u(config_id, rx, tx)
+        WHERE s.resolution = :source AND s.bucket_start >= :since AND s.bucket_start < :until
+        GROUP BY s.server_id, bucket, u.config_id
+    ) AS t
+    GROUP BY server_id, bucket
+    ON CONFLICT (resolution, bucket_start, server_id) DO UPDATE SET
+        config_ids = EXCLUDED.config_ids,
+        rx_bytes = EXCLUDED.rx_bytes,
+        tx_bytes = EXCLUDED.tx_bytes
+""")
+
+
+def bucket_start(moment: datetime, resolution: str) -> datetime:
+    """Start of the bucket of `resolution` containing `moment` (UTC, naive)."""
+    width = int(RESOLUTIONS[resolution].total_seconds())
+    return _EPOCH + timedelta(seconds=int((moment - _EPOCH).total_seconds()) // width * width)
+
+
+def pick_resolution(since: datetime, now: datetime | None = None) -> str:
+    """Finest resolution whose retention still covers `since`."""
+    now = now or datetime.utcnow()
+    for resolution in ("5m", "1h"):
+        if since >= now - RETENTION[resolution]:
+            return resolution
+    return "1d"
+
+
+class UsageHistory:
+    def __init__(self):
+        # (server_id, bucket_start) -> {config_id: [rx, tx]}
+        self._buckets: dict[tuple[int, datetime], dict[int, list[int]]] = {}
+        self._last_maintenance = 0.0
+        # target resolution -> source rows before this are rolled up; None until the first run
+        self._rolled_until: dict[str, datetime | None] = {target: None for target in ROLLUPS}
+
+    def record(self, server_id: int, samples, now: datetime | None = None):
+        """Add (config_id, rx_delta, tx_delta) samples of one server to the current 5-minute bucket."""
+        bucket = self._buckets.setdefault((server_id, bucket_start(now or datetime.utcnow(), "5m")), {})
+        for config_id, rx, tx in samples:
+            if not rx and not tx:
+                continue
+            entry = bucket.get(config_id)
+            if entry is None:
+                bucket[config_id] = [rx, tx]
+            else:
+                entry[0] += rx
+                entry[1] += tx
+
+    def flush(self, now: datetime | None = None, force: bool = False) -> int:
+        """Write finished buckets (all of them with force); returns rows written. Unwritten buckets are kept on failure."""
+        taken = self._take_finished(now, force)
+        return self._written(taken, self._write(taken))
+
+    async def flush_async(self, now: datetime | None = None, force: bool = False) -> int:
+        """flush() with the write on a thread."""
+        taken = self._take_finished(now, force)
+        return self._written(taken, await asyncio.to_thread(self._write, taken))
+
+    def _take_finished(self, now: datetime | None, force: bool) -> dict:
+        cutoff = bucket_start(now or datetime.utcnow(), "5m")
+        keys = [key for key in self._buckets if force or key[1] < cutoff]
+        return {key: self._buckets.pop(key) for key in keys}
+
+    def _write(self, taken: dict) -> bool:
+        rows = []
+        for (server_id, start), bucket in taken.items():
+            if not bucket:
+                continue
+            config_ids = sorted(bucket)
+            rows.append({
+                "server_id": server_id,
+                "bucket_start": start,
+                "config_ids": config_ids,
+                "rx_bytes": [bucket[config_id][0] for config_id in config_ids],
+                "tx_bytes": [bucket[config_id][1] for config_id in config_ids],
+            })
+        if not rows:
+            return True
+        db = SessionLocal()
+        try:
+            db.execute(_UPSERT_SAMPLE_SQL, rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to write {len(rows)} usage samples: {e}")
+            return False
+        finally:
+            db.close()
+        self._source_changed("5m", min(row["bucket_start"] for row in rows))
+        return True
+
+    def _written(self, taken: dict, ok: bool) -> int:
+        if ok:
+            return sum(1 for bucket in taken.values() if bucket)
+        # Put the buckets back, merged with anything recorded into them meanwhile
+        for key, bucket in taken.items():
+            current = self._buckets.setdefault(key, {})
+            for config_id, (rx, tx) in bucket.items():
+                entry = current.setdefault(config_id, [0, 0])
+                entry[0] += rx
+                entry[1] += tx
+        return 0
+
+    def _source_changed(self, source: str, start: datetime):
+        """Rows of `source` from `start` on were (re)written: roll up the buckets holding them again."""
+        for target, (target_source, _, _) in ROLLUPS.items():
+            rolled_until = self._rolled_until[target]
+            if target_source == source and rolled_until is not None:
+                self._rolled_until[target] = min(rolled_until, bucket_start(start, target))
+
+    def maintain(self, now: datetime | None = None, force: bool = False):
+        """Roll up finished buckets and apply retention, at most every USAGE_HISTORY_MAINTENANCE_INTERVAL."""
+        if self._maintenance_due(force):
+            self._maintain(now or datetime.utcnow())
+
+    async def maintain_async(self, now: datetime | None = None, force: bool = False):
+        """maintain() with the SQL on a thread."""
+        if self._maintenance_due(force):
+            await asyncio.to_thread(self._maintain, now or datetime.utcnow())
+
+    def _maintenance_due(self, force: bool) -> bool:
+        if not force and time.monotonic() - self._last_maintenance < USAGE_HISTORY_MAINTENANCE_INTERVAL:
+            return False
+        self._last_maintenance = time.monotonic()
+        return True
+
+    def _maintain(self, now: datetime):
+        rolled = {}
+        db = SessionLocal()
+        try:
+            for target, (source, unit, lookback) in ROLLUPS.items():
+                until = bucket_start(now, target)
+                since = self._rolled_until[target]
+                if since is None:
+                    since = until - RESOLUTIONS[target] * lookback
+                if since < until:
+                    db.execute(_ROLLUP_SQL, {
+                        "target": target,
+                        "source": source,
+                        "unit": unit,
+                        "since": since,
+                        "until": until,
+                    })
+                rolled[target] = (since, until)
+            for resolution, keep in RETENTION.items():
+                db.execute(
+                    text("DELETE FROM usage_samples WHERE resolution = :resolution AND bucket_start < :before"),
+                    {"resolution": resolution, "before": now - keep},
+                )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Usage history maintenance failed: {e}")
+            return
+        finally:
+            db.close()
+        for target, (since, until) in rolled.items():
+            self._rolled_until[target] = until
+        # Rollups run in ROLLUPS order, so the next level already saw rewritten rows
+        # from its own `since` on; anything older has to be rolled up there again
+        for target, (since, until) in rolled.items():
+            for consumer, (source, _, _) in ROLLUPS.items():
+                if source == target and since < until and since < rolled[consumer][0]:
+                    self._rolled_until[consumer] = min(self._rolled_until[consumer], bucket_start(since, consumer))
+
+
+def _window(since: datetime | None, until: datetime | None, resolution: str | None):
+    until = until or datetime.utcnow()
+    since = since or until - timedelta(minutes=15)
+    resolution = resolution or pick_resolution(since)
+    since = bucket_start(since, resolution)
+    until = max(bucket_start(until, resolution), since + RESOLUTIONS[resolution])
+    return since, until, resolution
+
+
+def rates(
+    db,
+    group_by: str = "config",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    resolution: str | None = None,
+    server_id: int | None = None,
+    limit: int | None = None,
+) -> list[dict]:
+    """
+    Traffic and average bytes/s per config, user, server or representative over
+    [since, until), busiest first. Defaults to the last 15 minutes; the window is
+    aligned to buckets of the chosen resolution.
+    """
+    since, until, resolution = _window(since, until, resolution)
+    key = GROUP_KEYS[group_by]
+    join = "LEFT JOIN wireguard_configs wc ON wc.id = u.config_id" if key.startswith("wc.") else ""
+    server_filter = "AND s.server_id = :server_id" if server_id is not None else ""
+    rows = db.execute(text(f"""
+        SELECT {key} AS key, SUM(u.rx)::BIGINT AS rx, SUM(u.tx)::BIGINT AS tx
+        FROM usage_samples s
+        CROSS JOIN LATERAL unnest(s.config_ids, s.rx_bytes, s.tx_bytes) AS u(config_id, rx, tx)
+        {join}
+        WHERE s.resolution = :resolution AND s.bucket_start >= :since AND s.bucket_start < :until {server_filter}
+        GROUP BY 1
+        ORDER BY SUM(u.rx) + SUM(u.tx) DESC
+        {"LIMIT :limit" if limit else ""}
+    """), {"resolution": resolution, "since": since, "until": until, "server_id": server_id, "limit": limit}).all()
+    seconds = (until - since).total_seconds()
+    return [
+        {
+            "key": row.key,
+            "rx_bytes": int(row.rx),
+            "tx_bytes": int(row.tx),
+            "rx_rate": row.rx / seconds,
+            "tx_rate": row.tx / seconds,
+        }
+        for row in rows
+    ]
+
+
+def series(
+    db,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    resolution: str | None = None,
+    server_id: int | None = None,
+    config_id: int | None = None,
+) -> list[dict]:
+    """Per-bucket traffic and bytes/s for a server, a config, or everything, oldest first."""
+    since, until, resolution = _window(since, until, resolution)
+    filters = ""
+    if server_id is not None:
+        filters += " AND s.server_id = :server_id"
+    if config_id is not None:
+        filters += " AND u.config_id = :config_id"
+    rows = db.execute(text(f"""
+        SELECT s.bucket_start, SUM(u.rx)::BIGINT AS rx, SUM(u.tx)::BIGINT AS tx
+        FROM usage_samples s
+        CROSS JOIN LATERAL unnest(s.config_ids, s.rx_bytes, s.tx_bytes) AS u(config_id, rx, tx)
+        WHERE s.resolution = :resolution AND s.bucket_start >= :since AND s.bucket_start < :until {filters}
+        GROUP BY s.bucket_start
+        ORDER BY s.bucket_start
+    """), {"resolution": resolution, "since": since, "until": until, "server_id": server_id, "config_id": config_id}).all()
+    seconds = RESOLUTIONS[resolution].total_seconds()
+    return [
+        {
+            "bucket_start": row.bucket_start,
+            "rx_bytes": int(row.rx),
+            "tx_bytes": int(row.tx),
+            "rx_rate": row.rx / seconds,
+            "tx_rate": row.tx / seconds,
+        }
+        for row in rows
+    ]
+
+
+usage_history = UsageHistory()
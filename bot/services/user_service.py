@@ -1,5 +1,9 @@
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
 from models import User, WireGuardConfig
 from config import ADMIN_IDS
+from services.access_cache import access_cache
 
 
 def get_or_create_user(db, telegram_id: str, username=None, first_name=None, last_name=None, return_created: bool = False):
@@ -19,6 +23,7 @@ def get_or_create_user(db, telegram_id: str, username=None, first_name=None, las
         db.add(user)
         db.commit()
         db.refresh(user)
+        access_cache.invalidate(telegram_id)
         created = True
 
     if return_created:
@@ -30,6 +35,52 @@ def get_user(db, telegram_id: str):
     return db.query(User).filter(User.telegram_id == str(telegram_id)).first()
 
 
+async def get_user_async(session, telegram_id: str):
+    return await session.scalar(select(User).where(User.telegram_id == str(telegram_id)))
+
+
+async def get_or_create_user_async(session, telegram_id: str, username=None, first_name=None, last_name=None, return_created: bool = False):
+    """
+    get_or_create_user on an AsyncSession. The insert is ON CONFLICT DO NOTHING,
+    so two concurrent /start updates of a new user cannot both create it.
+    """
+    user = await get_user_async(session, telegram_id)
+    created = False
+    if not user:
+        created_id = await session.scalar(
+            insert(User)
+            .values(
+                telegram_id=str(telegram_id),
+                username=username,
+                first_name=first_name,
+                last_name=last_name,
+                is_member=False,
+                is_admin=str(telegram_id) in ADMIN_IDS,
+                wallet_balance=0,
+            )
+            .on_conflict_do_nothing(index_elements=[User.telegram_id])
+            .returning(User.id)
+        )
+        await session.commit()
+        created = created_id is not None
+        access_cache.invalidate(telegram_id)
+        user = await get_user_async(session, telegram_id)
+
+    if return_created:
+        return user, created
+    return user
+
+
+async def list_user_configs_async(session, telegram_id: str):
+    """A user's configs, newest first."""
+    result = await session.scalars(
+        select(WireGuardConfig)
+        .where(WireGuardConfig.user_telegram_id == str(telegram_id))
+        .order_by(WireGuardConfig.created_at.desc())
+    )
+    return result.all()
+
+
 def is_admin(telegram_id: str) -> bool:
     return str(telegram_id) in ADMIN_IDS
 
@@ -0,0 +1,68 @@
+import unittest
+
+from config import IP_POOL_MAX_SIZE
+from services.ip_allocator import parse_ip_pool, pool_addresses
+
+
+class ParseIpPoolTest(unittest.TestCase):
+    def test_ipv4_cidr_skips_network_and_broadcast(self):
+        pool = parse_ip_pool("10.8.0.0/24")
+        self.assertEqual(pool["base_ip"], "10.8.0.0")
+        self.assertEqual((pool["start_ip"], pool["end_ip"]), ("10.8.0.1", "10.8.0.254"))
+        self.assertEqual((pool["start_offset"], pool["end_offset"], pool["cidr"]), (1, 254, 24))
+        self.assertFalse(pool["is_range"])
+
+    def test_ipv4_cidr_is_normalized_to_its_network(self):
+        self.assertEqual(parse_ip_pool("10.8.3.7/22")["base_ip"], "10.8.0.0")
+
+    def test_ipv4_slash_16_fits_default_max_size(self):
+        pool = parse_ip_pool("10.8.0.0/16")
+        self.assertEqual((pool["start_ip"], pool["end_ip"]), ("10.8.0.1", "10.8.255.254"))
+        self.assertLessEqual(pool["end_offset"] - pool["start_offset"] + 1, IP_POOL_MAX_SIZE)
+
+    def test_ipv4_cidr_larger_than_max_size_is_rejected(self):
+        self.assertIsNone(parse_ip_pool("10.0.0.0/8"))
+        self.assertIsNone(parse_ip_pool("10.8.0.0/15"))
+
+    def test_ipv6_prefix_is_clamped_to_max_size(self):
+        pool = parse_ip_pool("fd00::/64")
+        self.assertEqual(pool["base_ip"], "fd00::")
+        self.assertEqual(pool["start_offset"], 1)
+        self.assertEqual(pool["end_offset"], IP_POOL_MAX_SIZE)
+        self.assertEqual(pool["start_ip"], "fd00::1")
+
+    def test_full_ipv4_range(self):
+        pool = parse_ip_pool("10.8.0.10-10.8.3.200")
+        self.assertTrue(pool["is_range"])
+        self.assertIsNone(pool["cidr"])
+        self.assertEqual((pool["start_ip"], pool["end_ip"]), ("10.8.0.10", "10.8.3.200"))
+        self.assertEqual((pool["base_ip"], pool["start_offset"]), ("10.8.0.0", 10))
+
+    def test_short_ipv4_range(self):
+        pool = parse_ip_pool("192.168.30.10-220")
+        self.assertEqual((pool["start_ip"], pool["end_ip"]), ("192.168.30.10", "192.168.30.220"))
+
+    def test_ipv6_range(self):
+        pool = parse_ip_pool("fd00::10-fd00::ffff")
+        self.assertEqual((pool["start_ip"], pool["end_ip"]), ("fd00::10", "fd00::ffff"))
+
+    def test_range_larger_than_max_size_is_rejected(self):
+        self.assertIsNone(parse_ip_pool("10.0.0.1-10.255.255.254"))
+
+    def test_bare_ipv4_is_a_slash_24(self):
+        pool = parse_ip_pool("192.168.30.77")
+        self.assertEqual((pool["base_ip"], pool["start_offset"], pool["end_offset"], pool["cidr"]), ("192.168.30.0", 1, 254, 24))
+
+    def test_invalid_input(self):
+        for value in ("", "nonsense", "10.8.0.300/24", "10.8.0.20-10.8.0.10", "10.8.0.1-fd00::1", "fd00::1"):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_ip_pool(value))
+
+    def test_pool_addresses_follow_offsets(self):
+        pool = parse_ip_pool("10.8.0.0/16")
+        addresses = pool_addresses(pool["base_ip"], 254, 256)
+        self.assertEqual(addresses, ["10.8.0.254", "10.8.0.255", "10.8.1.0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+
+from services.routeros_client import _read_length, encode_length, encode_sentence, read_sentence
+
+
+def reader_for(data: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def _decode_length(data: bytes) -> tuple[int, bytes]:
+    reader = reader_for(data)
+    length = await _read_length(reader)
+    return length, await reader.read()
+
+
+def decode_length(data: bytes) -> tuple[int, bytes]:
+    """Decoded length and whatever bytes were left unread."""
+    return asyncio.run(_decode_length(data))
+
+
+class LengthCodecTest(unittest.TestCase):
+    BOUNDARIES = [
+        (0, b"\x00"),
+        (0x7F, b"\x7F"),
+        (0x80, b"\x80\x80"),
+        (0x3FFF, b"\xBF\xFF"),
+        (0x4000, b"\xC0\x40\x00"),
+        (0x1FFFFF, b"\xDF\xFF\xFF"),
+        (0x200000, b"\xE0\x20\x00\x00"),
+        (0xFFFFFFF, b"\xEF\xFF\xFF\xFF"),
+        (0x10000000, b"\xF0\x10\x00\x00\x00"),
+    ]
+
+    def test_encode_boundaries(self):
+        for length, encoded in self.BOUNDARIES:
+            with self.subTest(length=hex(length)):
+                self.assertEqual(encode_length(length), encoded)
+
+    def test_round_trip(self):
+        lengths = [length for boundary, _ in self.BOUNDARIES for length in (boundary, boundary + 1)]
+        for length in lengths + [300, 70_000, 0xFFFFFFFF]:
+            with self.subTest(length=hex(length)):
+                # The trailing byte must not be consumed as part of the length
+                self.assertEqual(decode_length(encode_length(length) + b"!"), (length, b"!"))
+
+
+class SentenceCodecTest(unittest.TestCase):
+    def test_sentence_round_trip(self):
+        words = ["/interface/wireguard/peers/print", "?interface=wg0", "=comment=" + "x" * 200, "=name=ünïcode"]
+
+        async def read_back():
+            return await read_sentence(reader_for(encode_sentence(words) + encode_sentence(["!done"])))
+
+        self.assertEqual(asyncio.run(read_back()), words)
+
+    def test_empty_sentence_is_a_single_zero(self):
+        self.assertEqual(encode_sentence([]), b"\x00")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import time
+import unittest
+
+from config import USAGE_SYNC_MAX_INTERVAL, USAGE_SYNC_PEAK_RATE
+from services.sync_scheduler import SyncScheduler, seconds_until_due
+
+GB = 1024 ** 3
+LINK_SPEED = 100 * 1000 ** 2 / 8  # a 100 Mbit/s client, in bytes/s
+
+
+def scheduled_interval(scheduler: SyncScheduler, next_due_in: float) -> float:
+    scheduler.track([1])
+    scheduler.complete(1, next_due_in)
+    return scheduler._due[1] - time.monotonic()
+
+
+class SyncSchedulerTest(unittest.TestCase):
+    def test_max_interval_not_above_fixed_interval(self):
+        self.assertLessEqual(USAGE_SYNC_MAX_INTERVAL, 180)
+        self.assertAlmostEqual(scheduled_interval(SyncScheduler(), float("inf")), USAGE_SYNC_MAX_INTERVAL, delta=1)
+
+    def test_idle_config_near_limit_cannot_overshoot_before_next_sync(self):
+        scheduler = SyncScheduler()
+        for remaining in (GB // 2, GB, 2 * GB, 5 * GB):
+            with self.subTest(remaining=remaining):
+                eta = seconds_until_due(remaining, rate=0.0, seconds_to_expiry=None)
+                interval = scheduled_interval(scheduler, eta)
+                # Downloading at link speed from now on still leaves quota at the next sync
+                self.assertLess(interval * LINK_SPEED, remaining)
+
+    def test_busy_config_uses_measured_rate(self):
+        rate = USAGE_SYNC_PEAK_RATE * 4
+        self.assertAlmostEqual(seconds_until_due(GB, rate=rate, seconds_to_expiry=None), GB / (rate * 2))
+
+    def test_expiry_bounds_estimate(self):
+        self.assertEqual(seconds_until_due(None, rate=0.0, seconds_to_expiry=90), 90)
+        self.assertEqual(seconds_until_due(None, rate=0.0, seconds_to_expiry=None), float("inf"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,12 @@
 """
 WireGuard account creation on MikroTik using MikroTik API
 """
+import asyncio
+import math
 import os
 import sys
 import logging
-from io import BytesIO
-import base64
-import ipaddress
+from contextlib import AsyncExitStack
 from datetime import datetime, timedelta
 
 # Configure logging
@@ -20,8 +20,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Import dependencies
+from sqlalchemy import text
 from database import SessionLocal
-from models import WireGuardConfig, Plan
+from models import WireGuardConfig
+from services.config_limits import config_is_due, refresh_effective_limits
+from services.ip_allocator import allocate_ip, bind_ip, canonical_ip, network_base_address, offset_address, release_ip
+from services.peer_index import peer_id_index
+from services.peer_slots import activate_slots, add_slots, claim_slot, drop_slots, finish_slot, obsolete_slots, ready_slot_count
+from services.router_pool import router_connection
+from services.sync_scheduler import seconds_until_due
+from services.usage_accumulator import usage_accumulator
+from services.usage_history import usage_history
+from services.routeros_client import RouterOsTrapError, build_command
 
 logger.info("=" * 60)
 logger.info("Loading wireguard module...")
@@ -39,59 +49,23 @@ except ImportError as e:
     PARAMIKO_AVAILABLE = False
 
 try:
-    import qrcode
-    logger.info("✓ qrcode imported")
-    QRCODE_AVAILABLE = True
-except ImportError as e:
-    logger.error(f"✗ qrcode NOT available: {e}")
-    QRCODE_AVAILABLE = False
-
-try:
-    from cryptography.hazmat.primitives.asymmetric import x25519
-    from cryptography.hazmat.primitives import serialization
+    from services.keypair_buffer import keypair_buffer
     logger.info("✓ cryptography imported")
     CRYPTO_AVAILABLE = True
 except ImportError as e:
     logger.error(f"✗ cryptography NOT available: {e}")
     CRYPTO_AVAILABLE = False
 
-try:
-    from routeros_api import RouterOsApiPool
-    logger.info("✓ routeros_api imported")
-    ROUTEROS_API_AVAILABLE = True
-except ImportError as e:
-    logger.error(f"✗ routeros_api NOT available: {e}")
-    logger.error("Please install: pip install routeros-api")
-    ROUTEROS_API_AVAILABLE = False
-
 
 def generate_wireguard_keypair():
     """
-    Generate WireGuard private/public key pair using cryptography library
-    No external CLI tools required
+    Take a WireGuard private/public key pair from the pre-generated buffer
+    (generated inline with the cryptography library when the buffer is empty)
     """
     logger.info("[Step 1] Generating WireGuard keypair...")
     
     try:
-        # Generate private key
-        priv = x25519.X25519PrivateKey.generate()
-        pub = priv.public_key()
-        
-        # Get raw bytes
-        priv_b = priv.private_bytes(
-            encoding=serialization.Encoding.Raw,
-            format=serialization.PrivateFormat.Raw,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        pub_b = pub.public_bytes(
-            encoding=serialization.Encoding.Raw,
-            format=serialization.PublicFormat.Raw
-        )
-        
-        # Encode as base64
-        private_key = base64.b64encode(priv_b).decode("ascii")
-        public_key = base64.b64encode(pub_b).decode("ascii")
-        
+        public_key, private_key = keypair_buffer.take()
         logger.info(f"[Step 1] ✓ WireGuard keypair generated successfully")
         return public_key, private_key
     except Exception as e:
@@ -133,6 +107,19 @@ def build_peer_comment(user_telegram_id: str, client_ip: str, legacy: bool = Fal
     return f"{user_telegram_id}-{ip_suffix}" if ip_suffix else str(user_telegram_id)
 
 
+WG_PEERS_PATH = '/interface/wireguard/peers'
+
+# Only the peer attributes this module reads. Without a proplist RouterOS sends
+# keys, endpoints and handshake state of every peer on every interface.
+PEER_PROPLIST = (".id", "comment", "allowed-address", "public-key", "rx", "tx", "disabled")
+
+
+async def fetch_interface_peers(api, wg_interface: str = None, proplist=PEER_PROPLIST) -> list[dict]:
+    """List peers of one WireGuard interface, filtered and trimmed on the router side."""
+    queries = [f"interface={wg_interface}"] if wg_interface else None
+    return await api.print(WG_PEERS_PATH, queries=queries, proplist=proplist)
+
+
 def _safe_int(value) -> int:
     try:
         return int(str(value).strip())
@@ -148,187 +135,266 @@ def _read_peer_counter(peer: dict, *candidate_keys: str) -> int:
     return 0
 
 
-def _resolve_config_for_peer(peer: dict, config_index: dict):
-    """Match MikroTik peer with a DB config using comment or allowed-address."""
-    comment = (peer.get("comment", "") or "").strip()
-    if comment and comment in config_index:
-        return config_index[comment]
+def _peer_ip(peer: dict) -> str:
+    return canonical_ip(peer.get("allowed-address") or "")
 
-    allowed_address = peer.get("allowed-address", "")
-    peer_ip = allowed_address.split('/')[0].strip() if allowed_address else ""
-    if peer_ip:
-        return config_index.get(peer_ip)
-    return None
 
+def build_config_index(configs) -> dict:
+    """Index configs by every key a MikroTik peer can be matched on (comment, legacy comment, IP)."""
+    config_index = {}
+    for config in configs:
+        if config.user_telegram_id and config.client_ip:
+            config_index[build_peer_comment(config.user_telegram_id, config.client_ip)] = config
+            config_index[build_peer_comment(config.user_telegram_id, config.client_ip, legacy=True)] = config
+        if config.client_ip:
+            config_index[canonical_ip(config.client_ip) or config.client_ip] = config
+    return config_index
 
-def sync_wireguard_usage_counters(
-    mikrotik_host: str,
-    mikrotik_user: str,
-    mikrotik_pass: str,
-    mikrotik_port: int,
-    wg_interface: str,
-):
-    """Sync RX/TX counters from MikroTik peers into local DB with reboot/reset handling."""
-    if not ROUTEROS_API_AVAILABLE:
-        logger.warning("routeros_api unavailable; skipping usage sync")
-        return
 
-    db = SessionLocal()
-    pool = None
-    try:
-        active_configs = db.query(WireGuardConfig).filter(WireGuardConfig.status == "active").all()
-        if not active_configs:
-            return
+def _active_configs_query(db, server_id: int = None):
+    query = db.query(WireGuardConfig).filter(WireGuardConfig.status == "active")
+    if server_id is not None:
+        query = query.filter(WireGuardConfig.server_id == server_id)
+    return query
 
-        config_index = {}
-        for config in active_configs:
-            if config.user_telegram_id and config.client_ip:
-                config_index[build_peer_comment(config.user_telegram_id, config.client_ip)] = config
-                config_index[build_peer_comment(config.user_telegram_id, config.client_ip, legacy=True)] = config
-            if config.client_ip:
-                config_index[config.client_ip] = config
-
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers = api.get_resource('/interface/wireguard/peers').get()
 
-        for peer in peers:
-            config = _resolve_config_for_peer(peer, config_index)
-            if not config:
-                continue
+def _resolve_config_for_peer(peer: dict, config_index: dict):
+    """
+    Match MikroTik peer with a DB config using allowed-address or comment.
 
-            peer_interface = peer.get("interface")
-            if peer_interface and peer_interface != wg_interface:
-                continue
+    The address is tried first: it is unique per interface, while comments
+    only carry the last two octets and repeat across a /16 or larger pool.
+    """
+    peer_ip = _peer_ip(peer)
+    if peer_ip and peer_ip in config_index:
+        return config_index[peer_ip]
 
-            current_rx = _read_peer_counter(peer, "rx", "rx-byte", "rx-bytes")
-            current_tx = _read_peer_counter(peer, "tx", "tx-byte", "tx-bytes")
-            previous_rx = config.last_rx_counter or 0
-            previous_tx = config.last_tx_counter or 0
-
-            if config.counter_reset_flag:
-                config.cumulative_rx_bytes = 0
-                config.cumulative_tx_bytes = 0
-                delta_rx = 0
-                delta_tx = 0
-                config.counter_reset_flag = False
-            else:
-                # Router reboot / counter reset: if current counter is smaller than previous
-                delta_rx = current_rx if current_rx < previous_rx else current_rx - previous_rx
-                delta_tx = current_tx if current_tx < previous_tx else current_tx - previous_tx
+    comment = (peer.get("comment", "") or "").strip()
+    if comment:
+        return config_index.get(comment)
+    return None
 
-            config.cumulative_rx_bytes = (config.cumulative_rx_bytes or 0) + max(delta_rx, 0)
-            config.cumulative_tx_bytes = (config.cumulative_tx_bytes or 0) + max(delta_tx, 0)
-            config.last_rx_counter = current_rx
-            config.last_tx_counter = current_tx
 
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Failed to sync wireguard usage counters: {e}")
-    finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
-        db.close()
+# Columns the usage sync reads; rows are plain tuples, not tracked ORM objects
+_USAGE_SYNC_COLUMNS = (
+    WireGuardConfig.id,
+    WireGuardConfig.user_telegram_id,
+    WireGuardConfig.client_ip,
+    WireGuardConfig.cumulative_rx_bytes,
+    WireGuardConfig.cumulative_tx_bytes,
+    WireGuardConfig.last_rx_counter,
+    WireGuardConfig.last_tx_counter,
+    WireGuardConfig.counter_reset_flag,
+    WireGuardConfig.effective_expires_at,
+    WireGuardConfig.traffic_limit_bytes,
+)
 
+# Rows that must be written in this pass (expiring or reset), one statement per server
+_BULK_USAGE_UPDATE_SQL = text("""
+    UPDATE wireguard_configs wc SET
+        cumulative_rx_bytes = v.cumulative_rx_bytes,
+        cumulative_tx_bytes = v.cumulative_tx_bytes,
+        last_rx_counter = v.last_rx_counter,
+        last_tx_counter = v.last_tx_counter,
+        counter_reset_flag = FALSE,
+        status = CASE WHEN v.expire THEN 'expired' ELSE wc.status END
+    FROM unnest(
+        CAST(:ids AS INTEGER[]),
+        CAST(:cumulative_rx AS BIGINT[]),
+        CAST(:cumulative_tx AS BIGINT[]),
+        CAST(:last_rx AS BIGINT[]),
+        CAST(:last_tx AS BIGINT[]),
+        CAST(:expire AS BOOLEAN[])
+    ) AS v(id, cumulative_rx_bytes, cumulative_tx_bytes, last_rx_counter, last_tx_counter, expire)
+    WHERE wc.id = v.id
+""")
+
+
+def _peer_counter_values(baseline: tuple[int, int, int, int], peer: dict, reset: bool = False) -> tuple[int, int, int, int]:
+    """
+    Fold the peer's current RX/TX counters into a config's cumulative usage.
+    baseline and the result are (cumulative_rx, cumulative_tx, last_rx_counter, last_tx_counter).
+    """
+    cumulative_rx, cumulative_tx, previous_rx, previous_tx = baseline
+    current_rx = _read_peer_counter(peer, "rx", "rx-byte", "rx-bytes")
+    current_tx = _read_peer_counter(peer, "tx", "tx-byte", "tx-bytes")
 
-def _peer_matches_config(peer: dict, config: WireGuardConfig) -> bool:
-    comment = (peer.get("comment", "") or "").strip()
-    expected_comment = build_peer_comment(config.user_telegram_id, config.client_ip)
-    legacy_comment = build_peer_comment(config.user_telegram_id, config.client_ip, legacy=True)
-    if comment in {expected_comment, legacy_comment}:
-        return True
+    if reset:
+        return 0, 0, current_rx, current_tx
 
-    allowed_address = (peer.get("allowed-address") or "").split('/')[0].strip()
-    return bool(allowed_address and allowed_address == config.client_ip)
+    # Router reboot / counter reset: if current counter is smaller than previous
+    delta_rx = current_rx if current_rx < previous_rx else current_rx - previous_rx
+    delta_tx = current_tx if current_tx < previous_tx else current_tx - previous_tx
+    return cumulative_rx + max(delta_rx, 0), cumulative_tx + max(delta_tx, 0), current_rx, current_tx
 
 
-def disable_expired_or_exhausted_configs(
+def _apply_usage_updates(db, updates: list[tuple]) -> int:
+    """Write (id, cumulative_rx, cumulative_tx, last_rx, last_tx, expire) rows with one UPDATE."""
+    if not updates:
+        return 0
+    ids, cumulative_rx, cumulative_tx, last_rx, last_tx, expire = (list(column) for column in zip(*updates))
+    return db.execute(_BULK_USAGE_UPDATE_SQL, {
+        "ids": ids,
+        "cumulative_rx": cumulative_rx,
+        "cumulative_tx": cumulative_tx,
+        "last_rx": last_rx,
+        "last_tx": last_tx,
+        "expire": expire,
+    }).rowcount
+
+
+async def sync_and_enforce_wireguard_usage(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
     mikrotik_port: int,
     wg_interface: str,
-):
-    """Disable peers on MikroTik when plan duration or traffic is exhausted."""
-    if not ROUTEROS_API_AVAILABLE:
-        logger.warning("routeros_api unavailable; skipping disable checks")
-        return
-
+    server_id: int = None,
+    elapsed: float = None,
+) -> dict | None:
+    """
+    Sync RX/TX counters from MikroTik peers into local DB and disable the peers
+    whose plan duration or traffic is exhausted, in one pass over one connection.
+    Returns {"scanned", "changed", "buffered", "expired"} row counts plus
+    next_due_in, or None when the pass failed. next_due_in is the shortest
+    estimated time until one of the configs runs out (rates are measured over
+    `elapsed`, the seconds since the router's previous pass).
+
+    The peer list is downloaded once; deltas, reboot/reset handling and the
+    expiry/quota decision are computed in memory against live totals (stored
+    usage plus what usage_accumulator still holds). Expiring and reset rows are
+    written at once, in a single UPDATE, after the disable commands went out on
+    the same connection, so a user is cut off in the same cycle that measured
+    the overage. All other deltas are handed to usage_accumulator, which writes
+    them on its own cadence; rows whose counters did not move are skipped.
+    With server_id the deltas are also recorded in usage_history.
+
+    With server_id only that router's configs are loaded and matched, so a peer
+    can never be credited to a same-IP config living on another server.
+
+    Rows are read after the peer list arrives, with no await until the deltas
+    are computed, so usage_accumulator.flush() may run while passes are in
+    flight.
+    """
     db = SessionLocal()
-    pool = None
     try:
-        active_configs = db.query(WireGuardConfig).filter(WireGuardConfig.status == "active").all()
-        if not active_configs:
-            return
-
-        now = datetime.utcnow()
-        targets = []
-        for config in active_configs:
-            plan = db.query(Plan).filter(Plan.id == config.plan_id).first() if config.plan_id else None
-            duration_days = config.duration_days if config.duration_days is not None else (plan.duration_days if plan else None)
-            traffic_limit_gb = config.traffic_limit_gb if config.traffic_limit_gb is not None else (plan.traffic_gb if plan else None)
-            if not duration_days and not traffic_limit_gb:
-                continue
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            peers = await fetch_interface_peers(api, wg_interface)
+            peer_id_index.replace(mikrotik_host, mikrotik_port, wg_interface, peers)
 
-            expires_at = config.expires_at or (config.created_at + timedelta(days=duration_days or 0))
-            plan_traffic_bytes = (traffic_limit_gb or 0) * (1024 ** 3)
-            consumed_bytes = (config.cumulative_rx_bytes or 0) + (config.cumulative_tx_bytes or 0)
-            exhausted_traffic = consumed_bytes >= plan_traffic_bytes
-            expired_time = expires_at <= now
+            active_configs = _active_configs_query(db, server_id).with_entities(*_USAGE_SYNC_COLUMNS).all()
+            stats = {"scanned": len(active_configs), "changed": 0, "buffered": 0, "expired": 0, "next_due_in": math.inf}
+            config_index = build_config_index(active_configs)
 
-            if exhausted_traffic or expired_time:
-                targets.append(config)
-
-        if not targets:
-            return
-
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers_resource = api.get_resource('/interface/wireguard/peers')
-        peers = peers_resource.get()
-
-        for config in targets:
+            peer_by_config = {}
             for peer in peers:
                 peer_interface = peer.get("interface")
                 if peer_interface and peer_interface != wg_interface:
                     continue
-                if _peer_matches_config(peer, config):
-                    peer_id = peer.get(".id")
-                    if peer_id:
-                        peers_resource.set(**{".id": peer_id, "disabled": "yes"})
-                    break
-            config.status = "expired"
 
+                config = _resolve_config_for_peer(peer, config_index)
+                if not config or config.id in peer_by_config:
+                    continue
+                peer_by_config[config.id] = peer
+
+            now = datetime.utcnow()
+            updates = []
+            deferred = []
+            samples = []
+            disable_commands = []
+            for config in active_configs:
+                peer = peer_by_config.get(config.id)
+                reset = bool(peer and config.counter_reset_flag)
+                if config.counter_reset_flag:
+                    baseline = (config.cumulative_rx_bytes or 0, config.cumulative_tx_bytes or 0, config.last_rx_counter or 0, config.last_tx_counter or 0)
+                else:
+                    baseline = usage_accumulator.baseline(config)
+                new_values = _peer_counter_values(baseline, peer, reset) if peer else baseline
+
+                expire = config_is_due(config, now, consumed=new_values[0] + new_values[1])
+                if expire and peer and peer.get(".id"):
+                    disable_commands.append(build_command(f"{WG_PEERS_PATH}/set", {".id": peer[".id"], "disabled": "yes"}))
+
+                delta_rx, delta_tx = (0, 0) if reset else (new_values[0] - baseline[0], new_values[1] - baseline[1])
+                if delta_rx or delta_tx:
+                    samples.append((config.id, delta_rx, delta_tx))
+
+                if not expire:
+                    remaining = None if config.traffic_limit_bytes is None else config.traffic_limit_bytes - new_values[0] - new_values[1]
+                    to_expiry = None if config.effective_expires_at is None else (config.effective_expires_at - now).total_seconds()
+                    rate = (delta_rx + delta_tx) / elapsed if elapsed else 0.0
+                    stats["next_due_in"] = min(stats["next_due_in"], seconds_until_due(remaining, rate, to_expiry))
+
+                if expire or reset:
+                    updates.append((config.id, *new_values, expire))
+                    stats["expired"] += int(expire)
+                elif new_values != baseline:
+                    deferred.append((config.id, delta_rx, delta_tx, new_values[2], new_values[3]))
+
+            for reply in await _pipeline_in_windows(api, disable_commands):
+                if isinstance(reply, RouterOsTrapError):
+                    logger.warning(f"Failed to disable peer on {mikrotik_host}: {reply}")
+                elif isinstance(reply, Exception):
+                    raise reply
+
+        stats["changed"] = _apply_usage_updates(db, updates)
         db.commit()
+        # No await from here on: the accumulator only sees passes that completed
+        usage_accumulator.discard(config.id for config in active_configs if config.counter_reset_flag)
+        usage_accumulator.discard(update[0] for update in updates)
+        for entry in deferred:
+            usage_accumulator.add(*entry)
+        stats["buffered"] = len(deferred)
+        if server_id is not None:
+            usage_history.record(server_id, samples, now)
+        return stats
     except Exception as e:
         db.rollback()
-        logger.error(f"Failed to disable expired/exhausted configs: {e}")
+        logger.error(f"Failed to sync/enforce wireguard usage: {e}")
+        return None
     finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
         db.close()
 
 
-def disable_wireguard_peer(
+async def _resolve_peer_id(api, mikrotik_host: str, mikrotik_port: int, wg_interface: str, client_ip: str, use_index: bool = True):
+    """Find a peer's .id from the index, falling back to a targeted print on a miss. Returns (peer_id, from_index)."""
+    if use_index:
+        peer_id = peer_id_index.lookup(mikrotik_host, mikrotik_port, wg_interface, client_ip)
+        if peer_id:
+            return peer_id, True
+
+    mask = 128 if ":" in client_ip else 32
+    rows = await api.print(
+        WG_PEERS_PATH,
+        queries=[f"interface={wg_interface}", f"allowed-address={client_ip}/{mask}"],
+        proplist=(".id", "public-key", "comment"),
+    )
+    peer_id = rows[0].get(".id") if rows else None
+    if peer_id:
+        peer_id_index.remember(mikrotik_host, mikrotik_port, wg_interface, peer_id, rows[0].get("public-key"), rows[0].get("comment"), client_ip)
+    return peer_id, False
+
+
+async def _apply_to_peer(api, mikrotik_host: str, mikrotik_port: int, wg_interface: str, client_ip: str, operation) -> str | None:
+    """Run operation(peer_id) on the peer with client_ip; returns the .id used, or None if no such peer."""
+    peer_id, from_index = await _resolve_peer_id(api, mikrotik_host, mikrotik_port, wg_interface, client_ip)
+    if not peer_id:
+        return None
+    try:
+        await operation(peer_id)
+    except RouterOsTrapError:
+        if not from_index:
+            raise
+        # Cached .id went stale (peer removed elsewhere or router reset); look it up once more
+        peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, peer_id)
+        peer_id, _ = await _resolve_peer_id(api, mikrotik_host, mikrotik_port, wg_interface, client_ip, use_index=False)
+        if not peer_id:
+            return None
+        await operation(peer_id)
+    return peer_id
+
+
+async def disable_wireguard_peer(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
@@ -337,49 +403,23 @@ def disable_wireguard_peer(
     client_ip: str,
 ):
     """Disable a specific WireGuard peer on MikroTik by IP."""
-    if not ROUTEROS_API_AVAILABLE:
-        logger.warning("routeros_api unavailable; skipping disable")
-        return False
-
-    pool = None
     try:
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers = api.get_resource('/interface/wireguard/peers').get()
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            async def _disable(peer_id):
+                await api.set(WG_PEERS_PATH, peer_id, disabled="yes")
+
+            if await _apply_to_peer(api, mikrotik_host, mikrotik_port, wg_interface, client_ip, _disable):
+                logger.info(f"Disabled peer with IP: {client_ip}")
+                return True
 
-        for peer in peers:
-            peer_interface = peer.get("interface")
-            if peer_interface and peer_interface != wg_interface:
-                continue
-            
-            allowed_address = (peer.get("allowed-address") or "").split('/')[0].strip()
-            if allowed_address == client_ip:
-                peer_id = peer.get(".id")
-                if peer_id:
-                    api.get_resource('/interface/wireguard/peers').set(**{".id": peer_id, "disabled": "yes"})
-                    logger.info(f"Disabled peer with IP: {client_ip}")
-                    return True
-        
         logger.warning(f"Peer not found for IP: {client_ip}")
         return False
     except Exception as e:
         logger.error(f"Failed to disable peer: {e}")
         return False
-    finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
 
 
-def reset_wireguard_peer_traffic(
+async def reset_wireguard_peer_traffic(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
@@ -388,35 +428,13 @@ def reset_wireguard_peer_traffic(
     client_ip: str,
 ):
     """Disable then enable a WireGuard peer to reset its counters on router side."""
-    if not ROUTEROS_API_AVAILABLE:
-        logger.warning("routeros_api unavailable; skipping peer reset")
-        return False
-
-    pool = None
     try:
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers_resource = api.get_resource('/interface/wireguard/peers')
-        peers = peers_resource.get()
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            async def _reset(peer_id):
+                await api.set(WG_PEERS_PATH, peer_id, disabled="yes")
+                await api.set(WG_PEERS_PATH, peer_id, disabled="no")
 
-        for peer in peers:
-            peer_interface = peer.get("interface")
-            if peer_interface and peer_interface != wg_interface:
-                continue
-
-            allowed_address = (peer.get("allowed-address") or "").split('/')[0].strip()
-            if allowed_address == client_ip:
-                peer_id = peer.get(".id")
-                if not peer_id:
-                    return False
-                peers_resource.set(**{".id": peer_id, "disabled": "yes"})
-                peers_resource.set(**{".id": peer_id, "disabled": "no"})
+            if await _apply_to_peer(api, mikrotik_host, mikrotik_port, wg_interface, client_ip, _reset):
                 logger.info(f"Reset peer traffic counters for IP: {client_ip}")
                 return True
 
@@ -425,15 +443,9 @@ def reset_wireguard_peer_traffic(
     except Exception as e:
         logger.error(f"Failed to reset peer traffic: {e}")
         return False
-    finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
 
 
-def delete_wireguard_peer(
+async def delete_wireguard_peer(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
@@ -442,46 +454,208 @@ def delete_wireguard_peer(
     client_ip: str,
 ):
     """Delete a specific WireGuard peer on MikroTik by IP."""
-    if not ROUTEROS_API_AVAILABLE:
-        logger.warning("routeros_api unavailable; skipping delete")
-        return False
-
-    pool = None
     try:
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers = api.get_resource('/interface/wireguard/peers').get()
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            async def _remove(peer_id):
+                await api.remove(WG_PEERS_PATH, peer_id)
+
+            peer_id = await _apply_to_peer(api, mikrotik_host, mikrotik_port, wg_interface, client_ip, _remove)
+            if peer_id:
+                peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, peer_id)
+                logger.info(f"Deleted peer with IP: {client_ip}")
+                return True
 
-        for peer in peers:
-            peer_interface = peer.get("interface")
-            if peer_interface and peer_interface != wg_interface:
-                continue
-            
-            allowed_address = (peer.get("allowed-address") or "").split('/')[0].strip()
-            if allowed_address == client_ip:
-                peer_id = peer.get(".id")
-                if peer_id:
-                    api.get_resource('/interface/wireguard/peers').remove(**{".id": peer_id})
-                    logger.info(f"Deleted peer with IP: {client_ip}")
-                    return True
-        
         logger.warning(f"Peer not found for IP: {client_ip}")
         return False
     except Exception as e:
         logger.error(f"Failed to delete peer: {e}")
         return False
-    finally:
-        if pool:
-            try:
-                pool.disconnect()
-            except Exception:
-                pass
+
+
+# Sentences kept in flight at once by apply_peer_operations
+PEER_PIPELINE_WINDOW = 256
+
+
+def _peer_op_sentences(operation: dict, peer_id: str | None, wg_interface: str) -> list[list[str]]:
+    op = operation.get("op")
+    if op == "add":
+        return [build_command(f"{WG_PEERS_PATH}/add", {"interface": wg_interface, **operation.get("attrs", {})})]
+    if op == "set":
+        return [build_command(f"{WG_PEERS_PATH}/set", {".id": peer_id, **operation.get("attrs", {})})]
+    if op == "disable":
+        return [build_command(f"{WG_PEERS_PATH}/set", {".id": peer_id, "disabled": "yes"})]
+    if op == "reset":
+        return [
+            build_command(f"{WG_PEERS_PATH}/set", {".id": peer_id, "disabled": "yes"}),
+            build_command(f"{WG_PEERS_PATH}/set", {".id": peer_id, "disabled": "no"}),
+        ]
+    if op == "remove":
+        return [build_command(f"{WG_PEERS_PATH}/remove", {".id": peer_id})]
+    raise ValueError(f"Unknown peer operation: {op}")
+
+
+async def _pipeline_in_windows(api, commands: list[list[str]]) -> list:
+    replies = []
+    for start in range(0, len(commands), PEER_PIPELINE_WINDOW):
+        replies.extend(await api.pipeline(commands[start:start + PEER_PIPELINE_WINDOW]))
+    return replies
+
+
+async def _resolve_peer_ids_bulk(api, mikrotik_host: str, mikrotik_port: int, wg_interface: str, client_ips: list[str]) -> dict:
+    """Resolve many client IPs to .ids with one pipelined round of targeted prints."""
+    commands = [
+        build_command(
+            f"{WG_PEERS_PATH}/print",
+            queries=[f"interface={wg_interface}", f"allowed-address={ip}/{128 if ':' in ip else 32}"],
+            proplist=(".id", "public-key", "comment"),
+        )
+        for ip in client_ips
+    ]
+    resolved = {}
+    for client_ip, rows in zip(client_ips, await _pipeline_in_windows(api, commands)):
+        if isinstance(rows, Exception) or not rows or not rows[0].get(".id"):
+            continue
+        peer_id = rows[0][".id"]
+        peer_id_index.remember(mikrotik_host, mikrotik_port, wg_interface, peer_id, rows[0].get("public-key"), rows[0].get("comment"), client_ip)
+        resolved[client_ip] = peer_id
+    return resolved
+
+
+async def apply_peer_operations(
+    mikrotik_host: str,
+    mikrotik_user: str,
+    mikrotik_pass: str,
+    mikrotik_port: int,
+    wg_interface: str,
+    operations: list[dict],
+) -> list[dict]:
+    """
+    Apply many peer mutations on one router over one pipelined connection.
+
+    Each operation is a dict with "op" in add / set / disable / reset / remove.
+    "add" takes the peer "attrs" (interface is filled in); the others address
+    the peer by "client_ip", and "set" also takes "attrs".
+
+    All commands are written back to back as tagged sentences and the replies
+    are collected afterwards, so a batch costs about one round trip instead
+    of one per peer. Returns one {"ok", "error", "peer_id"} dict per operation,
+    in the same order.
+    """
+    results = [{"ok": False, "error": None, "peer_id": None} for _ in operations]
+    if not operations:
+        return results
+
+    try:
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            # Resolve .ids: index first, then one pipelined round of prints for the misses
+            from_index = set()
+            for i, operation in enumerate(operations):
+                if operation.get("op") == "add":
+                    continue
+                peer_id = peer_id_index.lookup(mikrotik_host, mikrotik_port, wg_interface, operation.get("client_ip"))
+                if peer_id:
+                    results[i]["peer_id"] = peer_id
+                    from_index.add(i)
+
+            todo = list(range(len(operations)))
+            for attempt in range(2):
+                misses = [i for i in todo if operations[i].get("op") != "add" and not results[i]["peer_id"]]
+                if misses:
+                    resolved = await _resolve_peer_ids_bulk(
+                        api, mikrotik_host, mikrotik_port, wg_interface,
+                        list({operations[i].get("client_ip") for i in misses}),
+                    )
+                    for i in misses:
+                        results[i]["peer_id"] = resolved.get(operations[i].get("client_ip"))
+
+                commands, owners = [], []
+                for i in todo:
+                    if operations[i].get("op") != "add" and not results[i]["peer_id"]:
+                        results[i]["error"] = "peer not found"
+                        continue
+                    try:
+                        sentences = _peer_op_sentences(operations[i], results[i]["peer_id"], wg_interface)
+                    except ValueError as e:
+                        results[i]["error"] = str(e)
+                        continue
+                    commands.extend(sentences)
+                    owners.extend([i] * len(sentences))
+
+                replies = await _pipeline_in_windows(api, commands)
+                failed = {}
+                for i, reply in zip(owners, replies):
+                    if isinstance(reply, Exception):
+                        failed.setdefault(i, reply)
+                    elif operations[i].get("op") == "add" and reply:
+                        results[i]["peer_id"] = reply[0].get("ret")
+
+                retry = []
+                for i in dict.fromkeys(owners):
+                    error = failed.get(i)
+                    if error is None:
+                        results[i]["ok"] = True
+                        results[i]["error"] = None
+                        _track_peer_operation(mikrotik_host, mikrotik_port, wg_interface, operations[i], results[i]["peer_id"])
+                    elif attempt == 0 and i in from_index and isinstance(error, RouterOsTrapError):
+                        # Cached .id went stale; drop it and resolve this peer again
+                        peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, results[i]["peer_id"])
+                        results[i]["peer_id"] = None
+                        retry.append(i)
+                    else:
+                        results[i]["error"] = str(error)
+                if not retry:
+                    break
+                todo = retry
+    except Exception as e:
+        logger.error(f"Failed to apply peer operations on {mikrotik_host}: {e}")
+        for result in results:
+            if not result["ok"] and result["error"] is None:
+                result["error"] = str(e)
+
+    return results
+
+
+def _track_peer_operation(mikrotik_host: str, mikrotik_port: int, wg_interface: str, operation: dict, peer_id: str | None):
+    if not peer_id:
+        return
+    if operation.get("op") == "remove":
+        peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, peer_id)
+    elif operation.get("op") == "add":
+        attrs = operation.get("attrs", {})
+        peer_id_index.remember(
+            mikrotik_host, mikrotik_port, wg_interface, peer_id,
+            attrs.get("public-key"), attrs.get("comment"), (attrs.get("allowed-address") or "").split("/")[0],
+        )
+
+
+async def apply_peer_operations_by_server(servers: dict, operations: list[dict]) -> list[dict]:
+    """
+    Run apply_peer_operations for operations spanning several routers.
+
+    servers maps server id -> Server; every operation carries a "server_id".
+    Routers are processed concurrently and results come back in input order.
+    """
+    results = [{"ok": False, "error": "server not found", "peer_id": None} for _ in operations]
+    grouped: dict[int, list[int]] = {}
+    for i, operation in enumerate(operations):
+        if operation.get("server_id") in servers:
+            grouped.setdefault(operation["server_id"], []).append(i)
+
+    async def _run(server_id: int, indexes: list[int]):
+        server = servers[server_id]
+        server_results = await apply_peer_operations(
+            mikrotik_host=server.host,
+            mikrotik_user=server.username,
+            mikrotik_pass=server.password,
+            mikrotik_port=server.api_port,
+            wg_interface=server.wg_interface,
+            operations=[operations[i] for i in indexes],
+        )
+        for i, result in zip(indexes, server_results):
+            results[i] = result
+
+    await asyncio.gather(*(_run(server_id, indexes) for server_id, indexes in grouped.items()))
+    return results
 
 
 def get_next_available_ip_from_db(
@@ -489,76 +663,55 @@ def get_next_available_ip_from_db(
     ip_range_start: int,
     ip_range_end: int,
     server_id: int = None,
-    used_ips_from_router: set[int] | None = None,
+    used_ips_from_router: set[str] | None = None,
 ) -> str:
     """
     Get next available IP from the database
-    Range: by default 10-250 (skipping 1-9 and 251+)
-    Can be customized with ip_range_start and ip_range_end
+    ip_range_start/ip_range_end are host offsets from the network base
+    address (for a /24 they equal the last octet).
+
+    With server_id the address is reserved in the server's ip_allocations pool
+    and must be bound (bind_ip) or released (release_ip) by the caller.
     """
     logger.info(f"[Step 2] Getting next available IP from database, network: {network_base}...")
-    
-    # Normalize network base (supports CIDR/plain IP/3-octet prefix)
-    raw_base = (network_base or "").strip()
-    if not raw_base:
-        raise ValueError("network_base is empty")
 
-    if "-" in raw_base and "/" not in raw_base:
-        # Legacy/manual: range kept in base field; use left-side prefix
-        raw_base = raw_base.split("-", 1)[0].strip()
-
-    if "/" in raw_base:
-        try:
-            network = ipaddress.ip_network(raw_base, strict=False)
-            if isinstance(network, ipaddress.IPv4Network):
-                raw_base = str(network.network_address)
-        except ValueError:
-            # Fallback to simple split logic below
-            pass
-
-    parts = raw_base.split(".")
-    if len(parts) == 3:
-        # Backward compatibility for values like "192.168.30"
-        prefix = f"{parts[0]}.{parts[1]}.{parts[2]}."
-    elif len(parts) == 4:
-        prefix = ".".join(parts[:3]) + "."
-    else:
+    # Normalize network base (supports CIDR/plain IP/3-octet prefix/IPv6)
+    if not (network_base or "").strip():
+        raise ValueError("network_base is empty")
+    try:
+        base = network_base_address(network_base)
+    except ValueError:
         raise ValueError(f"Invalid network_base: {network_base}")
-    
+
     start = ip_range_start
     end = ip_range_end
     
-    logger.info(f"[Step 2] Normalized prefix: {prefix} | IP range: {start}-{end}")
-    
+    logger.info(f"[Step 2] Normalized base: {base} | IP range: {offset_address(base, start)}-{offset_address(base, end)}")
+
+    if server_id is not None:
+        ip = allocate_ip(server_id, str(base), start, end, used_ips_from_router)
+        if ip:
+            logger.info(f"[Step 2] ✓ Reserved available IP: {ip}")
+        else:
+            logger.warning(f"[Step 2] ✗ No available IP found in range {start}-{end}")
+        return ip
+
     db = SessionLocal()
     try:
-        # Get all assigned configs from database for this server
-        query = db.query(WireGuardConfig)
-        if server_id is not None:
-            query = query.filter(WireGuardConfig.server_id == server_id)
-        configs = query.all()
+        # Get all assigned configs from database
+        configs = db.query(WireGuardConfig.client_ip).filter(WireGuardConfig.client_ip.isnot(None)).all()
         
         # Extract used IPs
-        used_ips = set()
-        for config in configs:
-            if config.client_ip:
-                ip = config.client_ip
-                if ip.count('.') == 3 and ip.startswith(prefix):  # IPv4 in the same network prefix
-                    try:
-                        last_octet = int(ip.rsplit('.', 1)[-1])
-                        used_ips.add(last_octet)
-                    except (ValueError, IndexError):
-                        pass
-        
+        used_ips = {canonical_ip(client_ip) for (client_ip,) in configs}
         if used_ips_from_router:
             used_ips.update(used_ips_from_router)
 
-        logger.info(f"[Step 2] Used IPs (database + router): {sorted(used_ips)}")
+        logger.info(f"[Step 2] Used IPs (database + router): {len(used_ips)}")
         
         # Find next available IP in the specified range
-        for i in range(start, end + 1):
-            if i not in used_ips:
-                ip = f"{prefix}{i}"
+        for offset in range(start, end + 1):
+            ip = offset_address(base, offset)
+            if ip not in used_ips:
                 logger.info(f"[Step 2] ✓ Selected available IP: {ip}")
                 return ip
         
@@ -617,6 +770,8 @@ def save_wireguard_config_to_db(
         )
         
         db.add(config)
+        db.flush()
+        refresh_effective_limits(db, config_ids=[config.id])
         db.commit()
         db.refresh(config)
         
@@ -667,51 +822,37 @@ def parse_mikrotik_byte_value(value) -> int:
         return 0
 
 
-def fetch_wireguard_peers_usage(
+async def fetch_wireguard_peers_usage(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
-    mikrotik_port: int
+    mikrotik_port: int,
+    wg_interface: str = None,
 ) -> dict:
     """Fetch WireGuard peers usage counters from MikroTik."""
-    if not ROUTEROS_API_AVAILABLE:
-        raise RuntimeError("routeros_api module not installed")
+    async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+        peers = await fetch_interface_peers(api, wg_interface, proplist=("public-key", "rx", "tx"))
 
-    pool = None
-    try:
-        pool = RouterOsApiPool(
-            mikrotik_host,
-            username=mikrotik_user,
-            password=mikrotik_pass,
-            port=mikrotik_port,
-            plaintext_login=True
-        )
-        api = pool.get_api()
-        peers = api.get_resource('/interface/wireguard/peers').get()
+    usage = {}
+    for peer in peers:
+        public_key = peer.get('public-key')
+        if not public_key:
+            continue
+        rx = parse_mikrotik_byte_value(peer.get('rx') or peer.get('rx-byte'))
+        tx = parse_mikrotik_byte_value(peer.get('tx') or peer.get('tx-byte'))
+        usage[public_key] = {'rx': rx, 'tx': tx}
 
-        usage = {}
-        for peer in peers:
-            public_key = peer.get('public-key')
-            if not public_key:
-                continue
-            rx = parse_mikrotik_byte_value(peer.get('rx') or peer.get('rx-byte'))
-            tx = parse_mikrotik_byte_value(peer.get('tx') or peer.get('tx-byte'))
-            usage[public_key] = {'rx': rx, 'tx': tx}
+    return usage
 
-        return usage
-    finally:
-        if pool:
-            pool.disconnect()
 
-
-def sync_wireguard_usage_to_db(
+async def sync_wireguard_usage_to_db(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
     mikrotik_port: int
 ) -> tuple[int, int]:
     """Sync usage from MikroTik to DB. Returns (updated_configs, total_active_configs)."""
-    usage_map = fetch_wireguard_peers_usage(
+    usage_map = await fetch_wireguard_peers_usage(
         mikrotik_host=mikrotik_host,
         mikrotik_user=mikrotik_user,
         mikrotik_pass=mikrotik_pass,
@@ -755,7 +896,227 @@ def sync_wireguard_usage_to_db(
         db.close()
 
 
-def create_wireguard_account(
+async def _claim_peer_slot(
+    mikrotik_host: str,
+    mikrotik_user: str,
+    mikrotik_pass: str,
+    mikrotik_port: int,
+    wg_interface: str,
+    server_id: int,
+    user_telegram_id: str,
+    peer_name_prefix: str = None,
+):
+    """
+    Enable a ready peer slot for a new account; returns (public_key, private_key,
+    client_ip, comment, slot_id, peer_id) or None. The slot stays claimed until
+    the caller saves the account and calls finish_slot().
+    """
+    slot = claim_slot(server_id, wg_interface)
+    if slot is None:
+        return None
+
+    client_ip = slot["client_ip"]
+    peer_name = build_peer_comment(user_telegram_id, client_ip, name_prefix=peer_name_prefix)
+    try:
+        async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+            await api.set(WG_PEERS_PATH, slot["peer_id"], disabled="no", comment=peer_name)
+    except RouterOsTrapError as e:
+        # The router refused the command, so the peer is still disabled
+        if _peer_gone(e):
+            logger.warning(f"Peer slot {client_ip} is gone on the router: {e.message}")
+            finish_slot(slot["id"])
+            peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, slot["peer_id"])
+            release_ip(server_id, client_ip)
+        else:
+            logger.warning(f"Router refused to enable peer slot {client_ip}: {e.message}")
+            finish_slot(slot["id"], reuse=True)
+        return None
+    except Exception as e:
+        # Timeout or dropped connection: the peer may be enabled already. Never hand
+        # the slot out again; it stays claimed (keeping its address reserved) until
+        # the refill worker removes the peer as an abandoned claim.
+        logger.warning(f"Could not enable peer slot {client_ip}, abandoning it: {e}")
+        peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, slot["peer_id"])
+        return None
+
+    peer_id_index.remember(mikrotik_host, mikrotik_port, wg_interface, slot["peer_id"], slot["public_key"], peer_name, client_ip)
+    return slot["public_key"], slot["private_key"], client_ip, peer_name, slot["id"], slot["peer_id"]
+
+
+async def _undo_unsaved_peer(
+    mikrotik_host: str,
+    mikrotik_user: str,
+    mikrotik_pass: str,
+    mikrotik_port: int,
+    wg_interface: str,
+    server_id: int,
+    client_ip: str,
+    peer_id: str = None,
+    slot_id: int = None,
+):
+    """
+    Take the router side of an account whose DB save failed back off: a claimed
+    slot is disabled and returned to the pool, an added peer is removed. The
+    address only goes back to the pool once the peer is known to be off.
+    """
+    if peer_id:
+        try:
+            async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+                if slot_id is not None:
+                    await api.set(WG_PEERS_PATH, peer_id, disabled="yes", comment=f"slot-{client_ip}")
+                else:
+                    await api.remove(WG_PEERS_PATH, peer_id)
+        except Exception as e:
+            # Slot: stays claimed and is cleaned up as an abandoned claim.
+            # Added peer: its address is skipped while the router still lists it.
+            logger.error(f"Could not take unsaved peer {client_ip} off the router, keeping its address reserved: {e}")
+            peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, peer_id)
+            return
+        if slot_id is None:
+            peer_id_index.forget(mikrotik_host, mikrotik_port, wg_interface, peer_id)
+    if slot_id is not None:
+        finish_slot(slot_id, reuse=True)
+    else:
+        release_ip(server_id, client_ip)
+
+
+def _peer_gone(reply) -> bool:
+    """A reply to remove/set saying the peer does not exist (any more)."""
+    return isinstance(reply, RouterOsTrapError) and "no such item" in (reply.message or "").lower()
+
+
+async def _remove_obsolete_slots(api, mikrotik_host: str, mikrotik_port: int, server_id: int, slots: list[dict]) -> int:
+    """
+    Remove obsolete slots' peers; only slots whose peer is confirmed off the
+    router are dropped and get their address back. Returns how many.
+    """
+    # Slots abandoned while being added never learned their .id: look the peer up by address
+    unknown = [slot for slot in slots if not slot["peer_id"]]
+    lookups = await _pipeline_in_windows(api, [
+        build_command(
+            f"{WG_PEERS_PATH}/print",
+            queries=[f"interface={slot['wg_interface']}", f"allowed-address={slot['client_ip']}/{128 if ':' in slot['client_ip'] else 32}"],
+            proplist=(".id", "comment"),
+        )
+        for slot in unknown
+    ])
+    done = []
+    to_remove = [slot for slot in slots if slot["peer_id"]]
+    for slot, rows in zip(unknown, lookups):
+        if isinstance(rows, Exception):
+            continue
+        peer = next((row for row in rows if row.get("comment") == f"slot-{slot['client_ip']}"), None)
+        if peer is None:
+            done.append(slot)  # the add never reached the router
+        else:
+            to_remove.append({**slot, "peer_id": peer[".id"]})
+
+    replies = await _pipeline_in_windows(api, [
+        build_command(f"{WG_PEERS_PATH}/remove", {".id": slot["peer_id"]}) for slot in to_remove
+    ])
+    for slot, reply in zip(to_remove, replies):
+        if isinstance(reply, Exception) and not _peer_gone(reply):
+            logger.warning(f"Failed to remove obsolete peer slot {slot['client_ip']}, keeping it: {reply}")
+            continue
+        peer_id_index.forget(mikrotik_host, mikrotik_port, slot["wg_interface"], slot["peer_id"])
+        done.append(slot)
+
+    drop_slots([slot["id"] for slot in done])
+    for slot in done:
+        release_ip(server_id, slot["client_ip"])
+    return len(done)
+
+
+async def refill_peer_slots(
+    mikrotik_host: str,
+    mikrotik_user: str,
+    mikrotik_pass: str,
+    mikrotik_port: int,
+    wg_interface: str,
+    wg_client_network_base: str,
+    wg_ip_range_start: int,
+    wg_ip_range_end: int,
+    server_id: int,
+    target: int,
+) -> int:
+    """
+    Top a server's peer slot pool up to `target` ready slots.
+
+    New slots are recorded first, then their peers are added disabled in one
+    pipelined round; returns how many slots became ready. A slot whose add was
+    refused is dropped; one whose outcome is unknown (error, cancellation) is
+    left "adding" and removed as obsolete later.
+    """
+    obsolete = obsolete_slots(server_id, wg_interface)
+    missing = target - ready_slot_count(server_id, wg_interface)
+    if missing <= 0 and not obsolete:
+        return 0
+
+    mask = 128 if ":" in wg_client_network_base else 32
+    async with router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port) as api:
+        if obsolete:
+            await _remove_obsolete_slots(api, mikrotik_host, mikrotik_port, server_id, obsolete)
+        if missing <= 0:
+            return 0
+
+        router_used_ips = set()
+        for peer in await fetch_interface_peers(api, wg_interface, proplist=("allowed-address",)):
+            for allowed_address in (peer.get("allowed-address") or "").split(","):
+                address = canonical_ip(allowed_address)
+                if address:
+                    router_used_ips.add(address)
+
+        pending = []
+        keypairs = keypair_buffer.take_many(missing)
+        for public_key, private_key in keypairs:
+            client_ip = get_next_available_ip_from_db(
+                wg_client_network_base,
+                wg_ip_range_start,
+                wg_ip_range_end,
+                server_id=server_id,
+                used_ips_from_router=router_used_ips,
+            )
+            if client_ip is None:
+                break
+            pending.append({"client_ip": client_ip, "public_key": public_key, "private_key": private_key})
+
+        try:
+            slot_ids = add_slots(server_id, wg_interface, pending)
+        except Exception:
+            for slot in pending:
+                release_ip(server_id, slot["client_ip"])
+            raise
+
+        replies = await _pipeline_in_windows(api, [
+            build_command(f"{WG_PEERS_PATH}/add", {
+                "interface": wg_interface,
+                "public-key": slot["public_key"],
+                "allowed-address": f"{slot['client_ip']}/{mask}",
+                "comment": f"slot-{slot['client_ip']}",
+                "disabled": True,
+            })
+            for slot in pending
+        ])
+
+    added = {}
+    refused = []
+    for slot_id, slot, reply in zip(slot_ids, pending, replies):
+        peer_id = reply[0].get("ret") if not isinstance(reply, Exception) and reply else None
+        if peer_id:
+            added[slot_id] = peer_id
+        elif isinstance(reply, RouterOsTrapError):
+            logger.warning(f"Router refused peer slot {slot['client_ip']}: {reply}")
+            refused.append((slot_id, slot["client_ip"]))
+        else:
+            logger.warning(f"Peer slot {slot['client_ip']} may or may not have been added, leaving it for cleanup: {reply}")
+    activate_slots(added)
+    drop_slots([slot_id for slot_id, _ in refused])
+    for _, client_ip in refused:
+        release_ip(server_id, client_ip)
+    return len(added)
+
+
+async def create_wireguard_account(
     mikrotik_host: str,
     mikrotik_user: str,
     mikrotik_pass: str,
@@ -788,7 +1149,7 @@ def create_wireguard_account(
         duration_days: Account duration in days
     
     Returns:
-        dict with keys: success, private_key, public_key, client_ip, config, qr_code, error
+        dict with keys: success, private_key, public_key, client_ip, config, peer_comment, config_id, expires_at, error
     """
     logger.info("=" * 60)
     logger.info(f"Starting WireGuard account creation for user: {user_telegram_id}")
@@ -797,20 +1158,10 @@ def create_wireguard_account(
     logger.info(f"Network: {wg_client_network_base}")
     
     # Check if required dependencies are available
-    if not ROUTEROS_API_AVAILABLE:
-        error_msg = "routeros_api module not installed. Please run: pip install routeros-api"
-        logger.error(f"✗ {error_msg}")
-        return {"success": False, "error": error_msg}
-    
     if not CRYPTO_AVAILABLE:
         error_msg = "cryptography module not installed"
         logger.error(f"✗ {error_msg}")
         return {"success": False, "error": error_msg}
-    
-    if not QRCODE_AVAILABLE:
-        error_msg = "qrcode module not installed"
-        logger.error(f"✗ {error_msg}")
-        return {"success": False, "error": error_msg}
 
     if not wg_client_network_base:
         error_msg = "wg_client_network_base is required and must come from server data"
@@ -827,122 +1178,123 @@ def create_wireguard_account(
         logger.error(f"✗ {error_msg}")
         return {"success": False, "error": error_msg}
     
-    pool = None
+    router_stack = AsyncExitStack()
+    reserved_ip = None
+    peer_id = None
+    slot_id = None
     try:
         # Determine if IPv6
         is_ipv6 = ":" in wg_client_network_base
         mask = 128 if is_ipv6 else 32
         
-        # Step 1: Generate keys
-        public_key, private_key = generate_wireguard_keypair()
-        
-        # Step 2: Connect to MikroTik
-        logger.info(f"[Step 2] Connecting to MikroTik {mikrotik_host}:{mikrotik_port}...")
-        try:
-            pool = RouterOsApiPool(
-                mikrotik_host,
-                username=mikrotik_user,
-                password=mikrotik_pass,
-                port=mikrotik_port,
-                plaintext_login=True
+        # Fast path: claim a pre-provisioned peer and just enable it
+        slot = None
+        if server_id is not None:
+            slot = await _claim_peer_slot(
+                mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port,
+                wg_interface, server_id, user_telegram_id, peer_name_prefix,
             )
-            api = pool.get_api()
-            logger.info("[Step 2] ✓ Connected to MikroTik API successfully")
-        except Exception as e:
-            error_msg = f"Failed to connect to MikroTik: {str(e)}"
-            logger.error(f"[Step 2] ✗ {error_msg}")
-            return {"success": False, "error": error_msg}
+        if slot:
+            public_key, private_key, client_ip, peer_name, slot_id, peer_id = slot
+            reserved_ip = client_ip
+            logger.info(f"[Step 1-6] ✓ Using pre-provisioned peer {client_ip}")
+        else:
+            # Step 1: Generate keys
+            public_key, private_key = generate_wireguard_keypair()
         
-        # Step 3: Check WireGuard interface
-        logger.info(f"[Step 3] Checking WireGuard interface '{wg_interface}'...")
-        try:
-            wgifs = api.get_resource('/interface/wireguard').get()
-            logger.info(f"[Step 3] Available interfaces: {[i.get('name') for i in wgifs]}")
+            # Step 2: Connect to MikroTik
+            logger.info(f"[Step 2] Connecting to MikroTik {mikrotik_host}:{mikrotik_port}...")
+            try:
+                api = await router_stack.enter_async_context(
+                    router_connection(mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port)
+                )
+                logger.info("[Step 2] ✓ Connected to MikroTik API successfully")
+            except Exception as e:
+                error_msg = f"Failed to connect to MikroTik: {str(e)}"
+                logger.error(f"[Step 2] ✗ {error_msg}")
+                return {"success": False, "error": error_msg}
+        
+            # Step 3: Check WireGuard interface
+            logger.info(f"[Step 3] Checking WireGuard interface '{wg_interface}'...")
+            try:
+                wgifs = await api.print('/interface/wireguard', proplist=("name",))
+                logger.info(f"[Step 3] Available interfaces: {[i.get('name') for i in wgifs]}")
+            
+                if not any(i.get('name') == wg_interface for i in wgifs):
+                    error_msg = f"WireGuard interface '{wg_interface}' not found on MikroTik!"
+                    logger.error(f"[Step 3] ✗ {error_msg}")
+                    return {"success": False, "error": error_msg}
             
-            if not any(i.get('name') == wg_interface for i in wgifs):
-                error_msg = f"WireGuard interface '{wg_interface}' not found on MikroTik!"
+                logger.info(f"[Step 3] ✓ WireGuard interface '{wg_interface}' found")
+            except Exception as e:
+                error_msg = f"Failed to check WireGuard interface: {str(e)}"
                 logger.error(f"[Step 3] ✗ {error_msg}")
                 return {"success": False, "error": error_msg}
-            
-            logger.info(f"[Step 3] ✓ WireGuard interface '{wg_interface}' found")
-        except Exception as e:
-            error_msg = f"Failed to check WireGuard interface: {str(e)}"
-            logger.error(f"[Step 3] ✗ {error_msg}")
-            return {"success": False, "error": error_msg}
-
-        # Step 4: Get next available IP by checking DB + router peers
-        peers = api.get_resource('/interface/wireguard/peers').get()
-        normalized_base = (wg_client_network_base or "").strip()
-        if "/" in normalized_base:
+
+            # Step 4: Get next available IP by checking DB + router peers
+            peers = await fetch_interface_peers(api, wg_interface, proplist=("allowed-address",))
             try:
-                normalized_base = str(ipaddress.ip_network(normalized_base, strict=False).network_address)
+                network_base_address(wg_client_network_base)
             except ValueError:
-                pass
-        base_parts = normalized_base.split('.')
-        if len(base_parts) == 3:
-            prefix = ".".join(base_parts) + "."
-        elif len(base_parts) >= 4:
-            prefix = ".".join(base_parts[:3]) + "."
-        else:
-            error_msg = f"Invalid wg_client_network_base: {wg_client_network_base}"
-            logger.error(f"[Step 4] ✗ {error_msg}")
-            return {"success": False, "error": error_msg}
+                error_msg = f"Invalid wg_client_network_base: {wg_client_network_base}"
+                logger.error(f"[Step 4] ✗ {error_msg}")
+                return {"success": False, "error": error_msg}
 
-        router_used_ips: set[int] = set()
-        for peer in peers:
-            if peer.get('interface') and peer.get('interface') != wg_interface:
-                continue
-            allowed_address = (peer.get("allowed-address") or "").split('/')[0].strip()
-            if allowed_address.count('.') == 3 and allowed_address.startswith(prefix):
-                try:
-                    router_used_ips.add(int(allowed_address.rsplit('.', 1)[-1]))
-                except (TypeError, ValueError):
+            router_used_ips: set[str] = set()
+            for peer in peers:
+                if peer.get('interface') and peer.get('interface') != wg_interface:
                     continue
+                for allowed_address in (peer.get("allowed-address") or "").split(","):
+                    address = canonical_ip(allowed_address)
+                    if address:
+                        router_used_ips.add(address)
+
+            client_ip = get_next_available_ip_from_db(
+                wg_client_network_base,
+                wg_ip_range_start,
+                wg_ip_range_end,
+                server_id=server_id,
+                used_ips_from_router=router_used_ips,
+            )
 
-        client_ip = get_next_available_ip_from_db(
-            wg_client_network_base,
-            wg_ip_range_start,
-            wg_ip_range_end,
-            server_id=server_id,
-            used_ips_from_router=router_used_ips,
-        )
-
-        if client_ip is None:
-            error_msg = f"No available IP in configured range {wg_ip_range_start}-{wg_ip_range_end}"
-            logger.error(f"[Step 4] ✗ {error_msg}")
-            return {"success": False, "error": error_msg}
+            if client_ip is None:
+                error_msg = f"No available IP in configured range {wg_ip_range_start}-{wg_ip_range_end}"
+                logger.error(f"[Step 4] ✗ {error_msg}")
+                return {"success": False, "error": error_msg}
+            if server_id is not None:
+                reserved_ip = client_ip
 
-        logger.info(f"[Step 4] ✓ Selected IP: {client_ip}")
+            logger.info(f"[Step 4] ✓ Selected IP: {client_ip}")
 
-        # Step 5: Add peer to MikroTik
-        logger.info("[Step 5] Adding peer to MikroTik...")
-        try:
-            peer_name = build_peer_comment(user_telegram_id, client_ip, name_prefix=peer_name_prefix)
+            # Step 5: Add peer to MikroTik
+            logger.info("[Step 5] Adding peer to MikroTik...")
+            try:
+                peer_name = build_peer_comment(user_telegram_id, client_ip, name_prefix=peer_name_prefix)
             
-            peer_data = {
-                'interface': wg_interface,
-                'public-key': public_key,
-                'allowed-address': f'{client_ip}/{mask}',
-                'comment': peer_name
-            }
+                peer_data = {
+                    'interface': wg_interface,
+                    'public-key': public_key,
+                    'allowed-address': f'{client_ip}/{mask}',
+                    'comment': peer_name
+                }
             
-            logger.info(f"[Step 5] Peer name: {peer_name}")
+                logger.info(f"[Step 5] Peer name: {peer_name}")
             
-            api.get_resource('/interface/wireguard/peers').add(**peer_data)
-            logger.info("[Step 5] ✓ Peer added successfully")
-        except Exception as e:
-            if 'already exists' not in str(e).lower():
-                error_msg = f"Failed to add peer: {str(e)}"
-                logger.error(f"[Step 5] ✗ {error_msg}")
-                return {"success": False, "error": error_msg}
-            logger.warning(f"[Step 5] Peer might already exist: {str(e)}")
+                peer_id = await api.add(WG_PEERS_PATH, **peer_data)
+                if peer_id:
+                    peer_id_index.remember(mikrotik_host, mikrotik_port, wg_interface, peer_id, public_key, peer_name, client_ip)
+                logger.info("[Step 5] ✓ Peer added successfully")
+            except Exception as e:
+                if 'already exists' not in str(e).lower():
+                    error_msg = f"Failed to add peer: {str(e)}"
+                    logger.error(f"[Step 5] ✗ {error_msg}")
+                    return {"success": False, "error": error_msg}
+                logger.warning(f"[Step 5] Peer might already exist: {str(e)}")
         
-        # Step 6: Disconnect
-        logger.info("[Step 6] Disconnecting from MikroTik...")
-        if pool:
-            pool.disconnect()
-            pool = None
-        logger.info("[Step 6] ✓ Disconnected successfully")
+            # Step 6: Hand the connection back to the pool
+            logger.info("[Step 6] Releasing MikroTik connection...")
+            await router_stack.aclose()
+            logger.info("[Step 6] ✓ Connection released")
         
         # Step 7: Save to database
         db_config = save_wireguard_config_to_db(
@@ -960,6 +1312,12 @@ def create_wireguard_account(
             traffic_limit_gb=traffic_limit_gb,
             server_id=server_id
         )
+        if reserved_ip:
+            bind_ip(server_id, reserved_ip, db_config.id)
+            reserved_ip = None
+        if slot_id is not None:
+            finish_slot(slot_id)
+            slot_id = None
         
         # Step 8: Generate config text
         logger.info("[Step 8] Generating WireGuard config text...")
@@ -979,17 +1337,7 @@ def create_wireguard_account(
         config = "\n".join(config_lines)
         logger.info("[Step 8] ✓ Config text generated")
         
-        # Step 9: Generate QR code
-        logger.info("[Step 9] Generating QR code...")
-        try:
-            qr = qrcode.make(config)
-            buffer = BytesIO()
-            qr.save(buffer, format="PNG")
-            qr_base64 = base64.b64encode(buffer.getvalue()).decode()
-            logger.info("[Step 9] ✓ QR code generated")
-        except Exception as e:
-            logger.warning(f"[Step 9] Failed to generate QR code: {e}")
-            qr_base64 = None
+        # Step 9: QR code is rendered on first send (services/config_artifacts)
         
         logger.info("=" * 60)
         logger.info(f"✓ WireGuard account created successfully!")
@@ -1003,7 +1351,6 @@ def create_wireguard_account(
             "public_key": public_key,
             "client_ip": client_ip,
             "config": config,
-            "qr_code": f"data:image/png;base64,{qr_base64}" if qr_base64 else None,
             "peer_comment": peer_name,
             "config_id": db_config.id,
             "expires_at": db_config.expires_at
@@ -1020,9 +1367,10 @@ def create_wireguard_account(
             "error": error_msg
         }
     finally:
-        if pool:
-            try:
-                pool.disconnect()
-                logger.info("Disconnected (cleanup)")
-            except:
-                pass
+        await router_stack.aclose()
+        if reserved_ip:
+            # Account was not created; take its peer off the router, then free the address
+            await _undo_unsaved_peer(
+                mikrotik_host, mikrotik_user, mikrotik_pass, mikrotik_port,
+                wg_interface, server_id, reserved_ip, peer_id, slot_id,
+            )
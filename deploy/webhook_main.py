@@ -1,13 +1,13 @@
 import asyncio
 import sys
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from aiohttp import web
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from config import (
+    THRESHOLD_CHECK_INTERVAL,
     TOKEN,
     WEBHOOK_BASE_URL,
     WEBHOOK_DROP_PENDING_UPDATES,
@@ -16,14 +16,15 @@ from config import (
     WEBHOOK_PORT,
     WEBHOOK_SECRET_TOKEN,
 )
-from database import SessionLocal, init_db
+from database import SessionLocal, async_engine, init_db
 from handlers import dp
-from models import Plan, Server, ServiceType, WireGuardConfig
-from wireguard import (
-    delete_wireguard_peer,
-    disable_expired_or_exhausted_configs,
-    sync_wireguard_usage_counters,
-)
+from models import WireGuardConfig
+from services.monitoring_service import cleanup_expired_test_accounts_worker, peer_slot_refill_worker, usage_sync_worker
+from services.config_limits import is_near_limit
+from services.keypair_buffer import keypair_buffer
+from services.router_pool import router_pool
+from services.usage_accumulator import usage_accumulator
+from services.usage_history import usage_history
 
 print("Starting bot in webhook mode...", file=sys.stderr)
 print("Initializing database...", file=sys.stderr)
@@ -31,20 +32,9 @@ init_db()
 
 bot = Bot(token=TOKEN)
 ONE_GB_IN_BYTES = 1 * (1024 ** 3)
-TEST_ACCOUNT_PLAN_NAME = "اکانت تست"
 background_tasks = []
 
 
-def _get_wireguard_servers(db):
-    wireguard_type = db.query(ServiceType).filter(ServiceType.code == "wireguard").first()
-    if not wireguard_type:
-        return []
-    return db.query(Server).filter(
-        Server.service_type_id == wireguard_type.id,
-        Server.is_active == True,
-    ).all()
-
-
 def build_webhook_url() -> str:
     base_url = WEBHOOK_BASE_URL.rstrip("/")
     if not base_url:
@@ -58,21 +48,14 @@ async def notify_plan_thresholds_worker():
         db = SessionLocal()
         try:
             now = datetime.utcnow()
-            configs = db.query(WireGuardConfig).filter(WireGuardConfig.status == "active").all()
+            # Only rows within 1 GB / 1 day of their limits (partial indexes on active rows)
+            configs = db.query(WireGuardConfig).filter(
+                WireGuardConfig.status == "active",
+                WireGuardConfig.threshold_alert_sent.isnot(True),
+                is_near_limit(now, bytes_left=ONE_GB_IN_BYTES),
+            ).all()
             for config in configs:
-                if not config.plan_id:
-                    continue
-                plan = db.query(Plan).filter(Plan.id == config.plan_id).first()
-                if not plan or not plan.duration_days or not plan.traffic_gb:
-                    continue
-
-                expires_at = config.expires_at or (config.created_at + timedelta(days=plan.duration_days))
-                plan_traffic_bytes = plan.traffic_gb * (1024 ** 3)
-                consumed_bytes = config.cumulative_rx_bytes or 0
-                remaining_bytes = max(plan_traffic_bytes - consumed_bytes, 0)
-                days_left = (expires_at - now).total_seconds() / 86400
-
-                if not config.threshold_alert_sent and (remaining_bytes <= ONE_GB_IN_BYTES or 0 <= days_left <= 1):
+                if not config.threshold_alert_sent:
                     try:
                         await bot.send_message(
                             chat_id=int(config.user_telegram_id),
@@ -88,80 +71,7 @@ async def notify_plan_thresholds_worker():
             db.rollback()
         finally:
             db.close()
-        await asyncio.sleep(180)
-
-
-async def cleanup_expired_test_accounts_worker():
-    while True:
-        db = SessionLocal()
-        try:
-            now = datetime.utcnow()
-            test_plan = db.query(Plan).filter(Plan.name == TEST_ACCOUNT_PLAN_NAME).first()
-            if not test_plan:
-                await asyncio.sleep(180)
-                continue
-            configs = db.query(WireGuardConfig).filter(
-                WireGuardConfig.status.in_(["active", "expired"]),
-                WireGuardConfig.plan_id == test_plan.id,
-            ).all()
-            for config in configs:
-                expires_at = config.expires_at or (config.created_at + timedelta(days=test_plan.duration_days))
-                traffic_limit_bytes = (test_plan.traffic_gb or 0) * (1024 ** 3)
-                consumed_bytes = config.cumulative_rx_bytes or 0
-                if not ((expires_at and expires_at <= now) or (traffic_limit_bytes and consumed_bytes >= traffic_limit_bytes)):
-                    continue
-                try:
-                    server = db.query(Server).filter(Server.id == config.server_id, Server.is_active == True).first()
-                    if server:
-                        delete_wireguard_peer(
-                            mikrotik_host=server.host,
-                            mikrotik_user=server.username,
-                            mikrotik_pass=server.password,
-                            mikrotik_port=server.api_port,
-                            wg_interface=server.wg_interface,
-                            client_ip=config.client_ip,
-                        )
-                except Exception:
-                    pass
-                user_tg_id = config.user_telegram_id
-                db.delete(config)
-                db.commit()
-                try:
-                    await bot.send_message(chat_id=int(user_tg_id), text="⛔ مهلت تست تمام شده است.")
-                except TelegramBadRequest:
-                    pass
-        except Exception:
-            db.rollback()
-        finally:
-            db.close()
-        await asyncio.sleep(180)
-
-
-async def usage_sync_worker():
-    while True:
-        db = SessionLocal()
-        try:
-            servers = _get_wireguard_servers(db)
-            for server in servers:
-                sync_wireguard_usage_counters(
-                    mikrotik_host=server.host,
-                    mikrotik_user=server.username,
-                    mikrotik_pass=server.password,
-                    mikrotik_port=server.api_port,
-                    wg_interface=server.wg_interface,
-                )
-                disable_expired_or_exhausted_configs(
-                    mikrotik_host=server.host,
-                    mikrotik_user=server.username,
-                    mikrotik_pass=server.password,
-                    mikrotik_port=server.api_port,
-                    wg_interface=server.wg_interface,
-                )
-        except Exception:
-            pass
-        finally:
-            db.close()
-        await asyncio.sleep(180)
+        await asyncio.sleep(THRESHOLD_CHECK_INTERVAL)
 
 
 def start_background_workers():
@@ -171,7 +81,8 @@ def start_background_workers():
     background_tasks = [
         asyncio.create_task(usage_sync_worker()),
         asyncio.create_task(notify_plan_thresholds_worker()),
-        asyncio.create_task(cleanup_expired_test_accounts_worker()),
+        asyncio.create_task(cleanup_expired_test_accounts_worker(bot)),
+        asyncio.create_task(peer_slot_refill_worker()),
     ]
 
 
@@ -185,6 +96,7 @@ async def stop_background_workers():
 
 
 async def on_webhook_startup(app: web.Application):
+    keypair_buffer.refill_if_low()
     start_background_workers()
     await bot.set_webhook(
         url=build_webhook_url(),
@@ -195,6 +107,10 @@ async def on_webhook_startup(app: web.Application):
 
 async def on_webhook_shutdown(app: web.Application):
     await stop_background_workers()
+    usage_accumulator.flush()
+    usage_history.flush(force=True)
+    await router_pool.close_all()
+    await async_engine.dispose()
     await bot.session.close()
 
 